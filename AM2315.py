@@ -3,22 +3,70 @@
 
 # MODULE IMPORTS
 import time
+import random
+import threading
+from collections import namedtuple
 
 # GLOBAL VARIABLES
 AM2315_I2CADDR = 0x5C
 AM2315_READREG = 0x03
-MAXREADATTEMPT = 100
+# sensor wake up and conversion time per attempt
+WAKE_DELAY = 0.09
+READ_DELAY = 0.09
 
 AM2315DEBUG = False
 
+
+def _build_crc_table():
+    """CRC-16/MODBUS (reflected polynomial 0xA001) value of every byte, computed once"""
+    table = []
+    for byte in range(256):
+        crc = byte
+        for i in range(8):
+            if crc & 0x01:
+                crc = (crc >> 1) ^ 0xA001
+            else:
+                crc = crc >> 1
+        table.append(crc)
+    return table
+
+CRC_TABLE = _build_crc_table()
+
+
+class RetryPolicy(object):
+    """Bounded retries: at most max_attempts reads, exponential backoff between them
+    (base_delay doubling up to max_delay) and no new attempt once deadline seconds have passed."""
+
+    def __init__(self, max_attempts=4, base_delay=0.02, max_delay=0.2, deadline=1.0):
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.deadline = deadline
+
+    def backoff(self, attempt):
+        """Delay after the given (1 based) failed attempt"""
+        return min(self.max_delay, self.base_delay * (2 ** (attempt - 1)))
+
+
+# result of one read, humidity/temperature are None unless ok is True
+# error is None, 'timeout' (I2C error/no answer) or 'crc' (corrupted frame)
+AM2315Reading = namedtuple('AM2315Reading', ['humidity', 'temperature', 'ok', 'error', 'attempts', 'elapsed'])
+
+
 class AM2315:
     """Base functionality for AM2315 humidity and temperature sensor. """
 
-    def __init__(self, address=AM2315_I2CADDR, i2c=None, **kwargs):
+    def __init__(self, address=AM2315_I2CADDR, i2c=None, retry=None, clock=time.monotonic, sleep=time.sleep, **kwargs):
         if i2c is None: 
             import Adafruit_GPIO.I2C as I2C
             i2c = I2C
         self._device = i2c.get_i2c_device(address, **kwargs)
+        self.retry = RetryPolicy() if retry is None else retry
+        # clock() times the reads against the retry deadline
+        self.clock = clock
+        self.sleep = sleep
+        self.wake_delay = WAKE_DELAY
+        self.read_delay = READ_DELAY
         self.humidity = 0
         self.temperature = 0
         self.crc = 0
@@ -26,96 +74,96 @@ class AM2315:
         self.goodreads = 0
         self.badreadings = 0
         self.badcrcs = 0
+        self.timeouts = 0
+        self.last_reading = None
 
 
     def verify_crc(self, char):
         """Returns the 16-bit CRC of sensor data"""
         crc = 0xFFFF
         for l in char:
-                crc = crc ^ l
-                for i in range(1,9):
-                    if(crc & 0x01):
-                         crc = crc >> 1
-                         crc = crc ^ 0xA001
-                    else:
-                         crc = crc >> 1
+            crc = (crc >> 8) ^ CRC_TABLE[(crc ^ l) & 0xFF]
         return crc
 
 
-    def _read_data(self):
-        count = 0
-        tmp = None
-        while count <= MAXREADATTEMPT:
-            try:
-                # WAKE UP
-                self._device.write8(AM2315_READREG,0x00)
-                time.sleep(0.09)
-                # TELL THE DEVICE WE WANT 4 BYTES OF DATA
-                self._device.writeList(AM2315_READREG,[0x00, 0x04])
-                time.sleep(0.09)
-                tmp = self._device.readList(AM2315_READREG,8)
-                self.temperature = (((tmp[4] & 0x7F) << 8) | tmp[5]) / 10.0
-                # check for > 10.0 degrees higher
-                if (self.AM2315PreviousTemp != -1000):   # ignore first time
-                        if (abs(self.AM2315PreviousTemp - self.temperature) > 10.0):
-                            # OK, temp is bad.  Ignore
-                            if (AM2315DEBUG == True):
-                                print (">>>>>>>>>>>>>")
-                                print ("Bad AM2315 Temperature = ", self.temperature)
-                                print (">>>>>>>>>>>>>")
-                                self.badreadings = self.badreadings+1
-                                tmp = None
-                        else:
-                            # Good Temperature
-                            self.AM2315PreviousTemp = self.temperature
-                else:
-                    # assume first is good temperature
-                    self.AM2315PreviousTemp = self.temperature
-                # IF WE HAVE DATA, LETS EXIT THIS LOOP
-                # if tmp != None:
-                    # break
-            except:
-                if (AM2315DEBUG == True):
-                    print ("AM2315readCount = ", count)
-                count += 1
-                time.sleep(0.01)
-                
-            # IF WE HAVE DATA, LETS EXIT THIS LOOP
-            if tmp != None:
-                break
-       
-        # GET THE DATA OUT OF THE LIST WE READ
+    def _read_frame(self):
+        """Wakes the sensor and reads the raw 8 byte frame"""
+        # WAKE UP, the sensor does not acknowledge this write so errors are expected
         try:
-            self.humidity = ((tmp[2] << 8) | tmp[3]) / 10.0
-            self.temperature = (((tmp[4] & 0x7F) << 8) | tmp[5]) / 10.0
-
-            if (tmp[4] & 0x80):
-                self.temperature = -self.temperature
-
-            self.crc = ((tmp[7] << 8) | tmp[6]) 
-            # Verify CRC here
-            # force CRC error with the next line
-            #tmp[0] = tmp[0]+1
-            t = bytearray([tmp[0], tmp[1], tmp[2], tmp[3], tmp[4], tmp[5]])
-            c = self.verify_crc(t)
-
-            if (AM2315DEBUG == True):
-                print("AM2315temperature=",self.temperature)
-                print("AM2315humdity=",self.humidity)
-                print("AM2315crc=",self.crc)
-                print("AM2315c=",c)
-
-            if self.crc != c:
+            self._device.write8(AM2315_READREG,0x00)
+        except IOError:
+            pass
+        self.sleep(self.wake_delay)
+        # TELL THE DEVICE WE WANT 4 BYTES OF DATA
+        self._device.writeList(AM2315_READREG,[0x00, 0x04])
+        self.sleep(self.read_delay)
+        return self._device.readList(AM2315_READREG,8)
+
+
+    def read(self):
+        """Reads the sensor under the retry policy, returns an AM2315Reading"""
+        start = self.clock()
+        attempt = 0
+        error = None
+        while attempt < self.retry.max_attempts:
+            attempt += 1
+            try:
+                tmp = self._read_frame()
+            except Exception:
                 if (AM2315DEBUG == True):
-                    print ("AM2314 BAD CRC")
-                self.badcrcs = self.badcrcs + 1
-                self.crc = -1
+                    print ("AM2315readCount = ", attempt)
+                self.timeouts = self.timeouts + 1
+                error = 'timeout'
             else:
-                self.goodreads = self.goodreads+1
+                # Verify CRC here
+                self.crc = ((tmp[7] << 8) | tmp[6])
+                c = self.verify_crc(bytearray(tmp[0:6]))
+                if self.crc != c:
+                    if (AM2315DEBUG == True):
+                        print ("AM2314 BAD CRC")
+                    self.badcrcs = self.badcrcs + 1
+                    self.crc = -1
+                    error = 'crc'
+                else:
+                    # GET THE DATA OUT OF THE LIST WE READ
+                    humidity = ((tmp[2] << 8) | tmp[3]) / 10.0
+                    temperature = (((tmp[4] & 0x7F) << 8) | tmp[5]) / 10.0
+                    if (tmp[4] & 0x80):
+                        temperature = -temperature
+                    # count > 10.0 degree jumps, the reading is still used like before
+                    if (self.AM2315PreviousTemp != -1000) and (abs(self.AM2315PreviousTemp - temperature) > 10.0):
+                        if (AM2315DEBUG == True):
+                            print ("Bad AM2315 Temperature = ", temperature)
+                        self.badreadings = self.badreadings+1
+                    else:
+                        # only a good temperature (or the first one) is the reference for the next check
+                        self.AM2315PreviousTemp = temperature
+                    self.humidity = humidity
+                    self.temperature = temperature
+                    self.goodreads = self.goodreads+1
+                    if (AM2315DEBUG == True):
+                        print("AM2315temperature=",self.temperature)
+                        print("AM2315humdity=",self.humidity)
+                        print("AM2315crc=",self.crc)
+                    self.last_reading = AM2315Reading(humidity, temperature, True, None, attempt, self.clock() - start)
+                    return self.last_reading
+            if attempt >= self.retry.max_attempts:
+                break
+            # back off, but never start an attempt that would overrun the deadline
+            delay = self.retry.backoff(attempt)
+            attempt_time = delay + self.wake_delay + self.read_delay
+            if self.clock() - start + attempt_time > self.retry.deadline:
+                break
+            self.sleep(delay)
+        self.humidity = None
+        self.temperature = None
+        self.last_reading = AM2315Reading(None, None, False, error, attempt, self.clock() - start)
+        return self.last_reading
+
 
-        except TypeError:
-            self.humidity = 'Error'
-            self.temperature = 'Error'
+    def _read_data(self):
+        # legacy entry point, values end up in self.humidity/self.temperature (None on failure)
+        self.read()
 
     def read_temperature(self):
         self._read_data()
@@ -129,6 +177,11 @@ class AM2315:
         self._read_data()
         return (self.humidity, self.temperature)
 
+    def read_humidity_temperature_time(self):
+        """Fresh reading with the time.time() it was taken"""
+        reading = self.read()
+        return (reading.humidity, reading.temperature, time.time())
+
     def read_humidity_temperature_crc(self):
         self._read_data()
         return (self.humidity, self.temperature, self.crc)
@@ -136,6 +189,126 @@ class AM2315:
     def read_status_info(self):
         return  (self.goodreads, self.badreadings, self.badcrcs)
 
+
+class CachedAM2315(object):
+    """Caching layer in front of an AM2315. Readings younger than ttl seconds are served from memory,
+    a background thread refreshes them before they expire so callers rarely wait on the I2C bus.
+    Drop-in for the read_humidity_temperature* methods of AM2315."""
+
+    def __init__(self, sensor, ttl=60.0, background=True, clock=time.time):
+        self.sensor = sensor
+        self.ttl = ttl
+        self.clock = clock
+        self.lock = threading.Lock()
+        # last good (humidity, temperature, timestamp), None until the first good read
+        self.cached = None
+        self.reads = 0
+        self.hits = 0
+        self.stop_event = threading.Event()
+        self.thread = None
+        if background:
+            self.start()
+
+    def start(self):
+        if self.thread is None or not self.thread.is_alive():
+            self.stop_event.clear()
+            self.thread = threading.Thread(target=self.run, daemon=True)
+            self.thread.start()
+
+    def stop(self):
+        self.stop_event.set()
+        if self.thread is not None:
+            self.thread.join(2.0)
+
+    def run(self):
+        # refresh at half the TTL so a cached value is always available
+        while not self.stop_event.is_set():
+            self.refresh()
+            self.stop_event.wait(self.ttl / 2.0)
+
+    def refresh(self):
+        """Reads the sensor now, keeps the previous value if the read fails"""
+        with self.lock:
+            reading = self.sensor.read()
+            self.reads += 1
+            if reading.ok:
+                self.cached = (reading.humidity, reading.temperature, self.clock())
+            return reading.ok
+
+    def age(self):
+        if self.cached is None:
+            return None
+        return self.clock() - self.cached[2]
+
+    def read_humidity_temperature_time(self):
+        """(humidity, temperature, timestamp of the reading), (None, None, None) if the sensor fails"""
+        age = self.age()
+        if age is not None and age <= self.ttl:
+            self.hits += 1
+            return self.cached
+        # stale or empty cache, read synchronously
+        if self.refresh():
+            return self.cached
+        return (None, None, None)
+
+    def read_humidity_temperature(self):
+        reading = self.read_humidity_temperature_time()
+        return (reading[0], reading[1])
+
+    def read_temperature(self):
+        return self.read_humidity_temperature()[1]
+
+    def read_humidity(self):
+        return self.read_humidity_temperature()[0]
+
+
+class FakeI2CDevice(object):
+    """Stand-in for an Adafruit_GPIO I2C device answering like an AM2315.
+    Injects corrupted CRCs and timeouts (IOError after timeout_delay) at the given rates.
+    source() can return (humidity, temperature) to follow a simulated environment, None values time out."""
+
+    def __init__(self, humidity=45.0, temperature=21.5, crc_error_rate=0.0, timeout_rate=0.0, timeout_delay=0.0, seed=None, source=None):
+        self.humidity = humidity
+        self.temperature = temperature
+        self.source = source
+        self.crc_error_rate = crc_error_rate
+        self.timeout_rate = timeout_rate
+        self.timeout_delay = timeout_delay
+        self.random = random.Random(seed)
+        self.requests = 0
+
+    def write8(self, register, value):
+        pass
+
+    def writeList(self, register, data):
+        self.requests += 1
+        if self.source is not None:
+            self.humidity, self.temperature = self.source()
+        if self.random.random() < self.timeout_rate or self.humidity is None or self.temperature is None:
+            time.sleep(self.timeout_delay)
+            raise IOError("AM2315 did not answer")
+
+    def readList(self, register, length):
+        humidity = int(round(self.humidity * 10))
+        temperature = int(round(abs(self.temperature) * 10))
+        if self.temperature < 0:
+            temperature |= 0x8000
+        frame = [AM2315_READREG, 0x04, humidity >> 8, humidity & 0xFF, temperature >> 8, temperature & 0xFF]
+        crc = AM2315.verify_crc(None, bytearray(frame))
+        if self.random.random() < self.crc_error_rate:
+            crc ^= 0x0101
+        return frame + [crc & 0xFF, crc >> 8]
+
+
+class FakeI2C(object):
+    """Replaces the Adafruit_GPIO.I2C module passed to AM2315(i2c=...)"""
+
+    def __init__(self, device):
+        self.device = device
+
+    def get_i2c_device(self, address, **kwargs):
+        return self.device
+
 if __name__ == "__main__":
     am2315 = AM2315()
     print (am2315.read_temperature())
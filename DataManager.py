@@ -6,17 +6,226 @@ Started: September 2018
 Version 2 (Change activation times with json file)
 =============================
 '''
-import RPi.GPIO as GPIO
+from HardwareManager import GPIO
 import time
 import os
 import subprocess
 import csv
+import io
+import json
+import re
+import zlib
+import shutil
+import gzip
+import tempfile
+import numpy as np
 from math import cos, sin
+from datetime import date
 from numpy import deg2rad
 
 # necessary constants
-HEADER_CSV = ["Date", "Time", "Temperature(C)", "Humidity(%)", "GPOA(W/M2)", "EDS/CTRL(#)", "Voc_Before(V)", "Voc_After(V)", "Isc_Before(A)", "Isc_After(A)", "Pout_Before(W)","Pout_After(W)", "PR_Before","PR_After", "SI_Before","SI_After"]
-HEADER_TXT = "Date Time Temperature(C) Humidity(%) GPOA(W/M2) EDS/CTRL(#) Voc_Before(V) Voc_After(V) Isc_Before(A) Isc_After(A) Pout_Before(W) Pout_After(W) PR_Before PR_After SI_Before SI_After"
+HEADER_CSV = ["Date", "Time", "Temperature(C)", "Humidity(%)", "GPOA(W/M2)", "EDS/CTRL(#)", "Voc_Before(V)", "Voc_After(V)", "Isc_Before(A)", "Isc_After(A)", "Pout_Before(W)","Pout_After(W)", "PR_Before","PR_After", "SI_Before","SI_After", "Weather_Time"]
+HEADER_TXT = "Date Time Temperature(C) Humidity(%) GPOA(W/M2) EDS/CTRL(#) Voc_Before(V) Voc_After(V) Isc_Before(A) Isc_After(A) Pout_Before(W) Pout_After(W) PR_Before PR_After SI_Before SI_After Weather_Time"
+# optional uncertainty columns from the oversampled ADC readings
+HEADER_STATS = ["Voc_Before_Std(V)", "Voc_After_Std(V)", "Isc_Before_Std(A)", "Isc_After_Std(A)", "Samples(#)"]
+# last two columns of checksummed data files: row sequence number and CRC-32 of the row up to and including it
+HEADER_FRAME = ["Seq", "CRC32"]
+
+# fixed width binary record of one panel measurement, same columns as HEADER_CSV + HEADER_STATS
+# times are epoch seconds, missing values ('Error', 'N/A') are NaN, samples 0 when not measured
+RECORD_DTYPE = np.dtype([
+    ('timestamp', '<f8'), ('temp', '<f4'), ('humid', '<f4'), ('gpoa', '<f4'), ('panel', 'S8'),
+    ('ocv_pre', '<f4'), ('ocv_post', '<f4'), ('scc_pre', '<f4'), ('scc_post', '<f4'),
+    ('pwr_pre', '<f4'), ('pwr_post', '<f4'), ('pr_pre', '<f4'), ('pr_post', '<f4'),
+    ('si_pre', '<f4'), ('si_post', '<f4'), ('weather_time', '<f8'),
+    ('ocv_pre_std', '<f4'), ('ocv_post_std', '<f4'), ('scc_pre_std', '<f4'), ('scc_post_std', '<f4'),
+    ('samples', '<u2')])
+# file header: magic and record size, keeps the records aligned for np.memmap
+RECORD_MAGIC = b'EDSREC01'
+RECORD_HEADER_SIZE = 16
+# measurement columns written as plain numbers
+RECORD_VALUES = ['ocv_pre', 'ocv_post', 'scc_pre', 'scc_post', 'pwr_pre', 'pwr_post', 'pr_pre', 'pr_post', 'si_pre', 'si_post']
+RECORD_STATS = ['ocv_pre_std', 'ocv_post_std', 'scc_pre_std', 'scc_post_std']
+
+# sidecar index of eds_data.csv, one entry per data row: byte offset, day (date ordinal) and panel
+INDEX_DTYPE = np.dtype([('offset', '<u8'), ('day', '<u4'), ('panel', 'S8')])
+# magic, bytes of the csv file indexed, number of entries
+INDEX_MAGIC = b'EDSIDX01'
+INDEX_HEADER_SIZE = 24
+
+# time the temperature/humidity reading was taken, readings are cached so it can differ from the row time
+def weather_time(dt):
+    if not dt:
+        return 'N/A'
+    return str(dt.tm_hour) + ':' + str(dt.tm_min) + ':' + str(dt.tm_sec)
+
+# failed AM2315 readings are None, keep writing them as 'Error' in the data files
+def sensor_value(value):
+    if value is None:
+        return 'Error'
+    return value
+
+# partition the USB drive shows up as
+USB_DEVICE = 'sda1'
+# uuid and label of every USB registered with this field unit
+USB_NAMES_PATH = '/home/pi/Desktop/usb_names.txt'
+
+# LogMaster levels, lines below the configured level are not written
+LOG_LEVELS = {'DEBUG': 10, 'INFO': 20, 'WARNING': 30, 'ERROR': 40}
+
+'''
+USB Probe Class:
+Functionality:
+1) Detects the USB drive from /sys/block without shelling out to blkid
+2) Reads UUID, label and filesystem type from /dev/disk and the udev database, cached until they change
+3) Reads /proc/mounts to tell where the drive is mounted
+'''
+
+class USBProbe:
+    def __init__(self, root='/', device=USB_DEVICE):
+        # root is '/' on the RasPi, a FakeUSBTree directory off it
+        self.root = root
+        self.device = device
+        self.disk = device.rstrip('0123456789')
+        self.signature = None
+        self.state = None
+        # full probes done, everything else came from the cache
+        self.probes = 0
+
+    def path(self, *parts):
+        return os.path.join(self.root, *parts)
+
+    # cheap change check: device present and mtimes of the udev symlink directories
+    def current_signature(self):
+        signature = [os.path.exists(self.path('sys', 'block', self.disk, self.device))]
+        for name in ['by-uuid', 'by-label']:
+            try:
+                signature.append(os.stat(self.path('dev', 'disk', name)).st_mtime_ns)
+            except OSError:
+                signature.append(None)
+        return tuple(signature)
+
+    # {'uuid', 'label', 'fstype'} of the drive (None if unknown), None if no drive is plugged in
+    def get_state(self):
+        signature = self.current_signature()
+        if signature != self.signature:
+            self.state = self.probe() if signature[0] else None
+            self.signature = signature
+        return self.state
+
+    def present(self):
+        return self.get_state() is not None
+
+    def probe(self):
+        self.probes += 1
+        return {'uuid': self.link_name('by-uuid'), 'label': self.link_name('by-label'), 'fstype': self.fstype()}
+
+    # name of the /dev/disk/<kind> symlink pointing at the device, udev escapes characters as \xNN
+    def link_name(self, kind):
+        folder = self.path('dev', 'disk', kind)
+        try:
+            names = os.listdir(folder)
+        except OSError:
+            return None
+        for name in names:
+            try:
+                if os.path.basename(os.readlink(os.path.join(folder, name))) == self.device:
+                    return re.sub(r'\\x([0-9a-fA-F]{2})', lambda m: chr(int(m.group(1), 16)), name)
+            except OSError:
+                continue
+        return None
+
+    # filesystem type from the udev database (block device major:minor), /proc/mounts as a fallback
+    def fstype(self):
+        try:
+            with open(self.path('sys', 'block', self.disk, self.device, 'dev'), 'r') as f:
+                devnum = f.read().strip()
+            with open(self.path('run', 'udev', 'data', 'b' + devnum), 'r') as f:
+                for line in f:
+                    if line.startswith('E:ID_FS_TYPE='):
+                        return line.strip().split('=', 1)[1]
+        except (IOError, OSError):
+            pass
+        mount = self.mount_entry()
+        return mount[1] if mount else None
+
+    # (mount point, fstype) of the device from /proc/mounts, None if not mounted
+    def mount_entry(self):
+        try:
+            with open(self.path('proc', 'mounts'), 'r') as f:
+                for line in f:
+                    fields = line.split()
+                    if len(fields) >= 3 and fields[0] == '/dev/' + self.device:
+                        # spaces in mount points are written as \040
+                        return (fields[1].replace('\\040', ' '), fields[2])
+        except (IOError, OSError):
+            pass
+        return None
+
+    def mount_point(self):
+        mount = self.mount_entry()
+        return mount[0] if mount else None
+
+
+'''
+Fake USB Tree Class:
+Functionality:
+1) Builds the /sys/block, /dev/disk, /run/udev and /proc/mounts files USBProbe reads in a temp directory
+2) Plugs, unplugs, relabels and mounts a fake drive so detection can be checked off the RasPi
+'''
+
+class FakeUSBTree:
+    def __init__(self, root=None):
+        self.root = tempfile.mkdtemp(prefix='fake_usb_') if root is None else root
+        for folder in [('sys', 'block'), ('dev', 'disk', 'by-uuid'), ('dev', 'disk', 'by-label'), ('run', 'udev', 'data'), ('proc',)]:
+            os.makedirs(os.path.join(self.root, *folder), exist_ok=True)
+        self.mounts = []
+        self.write_mounts()
+        self.device = None
+
+    def write_mounts(self):
+        with open(os.path.join(self.root, 'proc', 'mounts'), 'w') as f:
+            f.write('/dev/mmcblk0p2 / ext4 rw,noatime 0 0\n')
+            for line in self.mounts:
+                f.write(line)
+
+    def plug(self, uuid, label, fstype='vfat', device=USB_DEVICE):
+        self.unplug()
+        disk = device.rstrip('0123456789')
+        os.makedirs(os.path.join(self.root, 'sys', 'block', disk, device))
+        with open(os.path.join(self.root, 'sys', 'block', disk, device, 'dev'), 'w') as f:
+            f.write('8:1\n')
+        with open(os.path.join(self.root, 'run', 'udev', 'data', 'b8:1'), 'w') as f:
+            f.write('E:ID_FS_UUID=' + uuid + '\nE:ID_FS_LABEL=' + label + '\nE:ID_FS_TYPE=' + fstype + '\n')
+        os.symlink('../../' + device, os.path.join(self.root, 'dev', 'disk', 'by-uuid', uuid))
+        if label:
+            os.symlink('../../' + device, os.path.join(self.root, 'dev', 'disk', 'by-label', label.replace(' ', '\\x20')))
+        self.device = device
+
+    def unplug(self):
+        if self.device is None:
+            return
+        shutil.rmtree(os.path.join(self.root, 'sys', 'block', self.device.rstrip('0123456789')))
+        for kind in ['by-uuid', 'by-label']:
+            folder = os.path.join(self.root, 'dev', 'disk', kind)
+            for name in os.listdir(folder):
+                os.remove(os.path.join(folder, name))
+        os.remove(os.path.join(self.root, 'run', 'udev', 'data', 'b8:1'))
+        self.mounts = []
+        self.write_mounts()
+        self.device = None
+
+    def mount(self, mount_point, fstype='vfat'):
+        self.mounts.append('/dev/' + self.device + ' ' + mount_point.replace(' ', '\\040') + ' ' + fstype + ' rw 0 0\n')
+        self.write_mounts()
+
+    def unmount(self):
+        self.mounts = []
+        self.write_mounts()
+
+    def close(self):
+        shutil.rmtree(self.root)
+
 
 '''
 USB Master Class:
@@ -27,7 +236,9 @@ Functionality:
 '''
 
 class USBMaster:
-    def __init__(self):
+    def __init__(self, probe=None):
+        # drive detection from sysfs/udev, cached between calls
+        self.probe = USBProbe() if probe is None else probe
         self.USB_name = None
         self.USB_path = None
         self.uuid = None
@@ -45,12 +256,12 @@ class USBMaster:
 
     # setting the USB name by its UUID
     def set_USB_name(self):
-        # check if USB mounted
-        dir = str(subprocess.check_output("sudo blkid", shell=True))
-        if "/dev/sda1:" in dir:
-            check_label = dir.split('/dev/sda1:')[1].split('LABEL=')[1].split('"')[1]
-            check_uuid = dir.split('/dev/sda1:')[1].split('UUID=')[1].split('"')[1]
-            check_fstype = dir.split('/dev/sda1:')[1].split('TYPE=')[1].split('"')[1]
+        # check if USB plugged in
+        state = self.probe.get_state()
+        if state is not None:
+            check_label = state['label']
+            check_uuid = state['uuid']
+            check_fstype = state['fstype']
             # check if one either uuid label or fstype is not available 
             if check_label == None or check_uuid == None or check_fstype == None:
                 print("Invalid USB either label, uuid or fstype is not listed for the drive! Please inset a new USB or reformat this one to Fat32")
@@ -98,43 +309,36 @@ class USBMaster:
             print("USB not mounted! Please insert USB!")
             return False
 
-    # check if it is a new USB
+    # check if it is a new USB, a new one is registered in place (no reboot)
     def check_new_USB(self):
         # get the uuid and labels from usb_names.txt
-        f=open("/home/pi/Desktop/usb_names.txt", "r")
-        usb_names = f.read().splitlines()
-        f.close()
-        # if empty list
-        if not usb_names:
-            print("Empty List! Configurating new USB drive in FTU system!")
-            f = open("/home/pi/Desktop/usb_names.txt", "a+")
-            f.write(str(self.uuid)+" "+str(self.label)+"\n")
-            f.close()
-            self.set_USB_path()
-            self.update_fstab_file()
-            self.reset()
-        # non empty list, already existing registered usbs
-        else:
-            # check if current usb is registered
-            uuid_list = []
-            label_list = []
-            for x in usb_names:
+        try:
+            with open(USB_NAMES_PATH, "r") as f:
+                usb_names = f.read().splitlines()
+        except IOError:
+            usb_names = []
+        # check if current usb is registered
+        uuid_list = []
+        label_list = []
+        for x in usb_names:
+            if len(x.split()) >= 2:
                 uuid_list.append(x.split()[0])
                 label_list.append(x.split()[1])
-            # current usb is registered
-            if self.label in label_list and self.uuid in uuid_list:
-                print("USB Already Registered!")
-                self.set_USB_path()
-            # current usb is not registered
-            else:
-                print("Configurating new USB drive in FTU system!")
-                f = open("/home/pi/Desktop/usb_names.txt", "a+")
-                f.write(str(self.uuid)+" "+str(self.label)+"\n")
-                f.close()
-                self.set_USB_path()
-                self.update_fstab_file()
-                self.reset()
+        # current usb is registered
+        if self.label in label_list and self.uuid in uuid_list:
+            print("USB Already Registered!")
+            self.set_USB_path()
+        # current usb is not registered
+        else:
+            self.register_USB()
 
+    # add the current usb to usb_names.txt and fstab
+    def register_USB(self):
+        print("Configurating new USB drive in FTU system!")
+        with open(USB_NAMES_PATH, "a+") as f:
+            f.write(str(self.uuid)+" "+str(self.label)+"\n")
+        self.set_USB_path()
+        self.update_fstab_file()
 
     # set the USB path for data writing in MasterManager.py
     def set_USB_path(self):
@@ -142,36 +346,55 @@ class USBMaster:
         if self.uuid is not None:
             self.USB_path = "/media/" + str(self.uuid)+"/"+str(self.label)
 
-    # mount USB
+    # mount USB, returns False if there is no usable USB
+    # a different USB is registered and mounted at its own path, callers compare get_USB_path() to follow it
     def setup_usb_mount(self):
         print(" Mounting USB")
         # get current usb label
-        dir = str(subprocess.check_output("sudo blkid", shell=True))
-        cur_label = dir.split('/dev/sda1:')[1].split('LABEL=')[1].split('"')[1]
-        cur_uuid = dir.split('/dev/sda1:')[1].split('UUID=')[1].split('"')[1]
+        state = self.probe.get_state()
+        if state is None:
+            print("USB not found, cannot mount")
+            return False
+        cur_label = state['label']
+        cur_uuid = state['uuid']
         # check if it is the same usb or not
-        if self.label != cur_label:
-            # reboot to reinitialize the usb, csv, and log classes
+        if self.label != cur_label or self.uuid != cur_uuid:
+            # switch to the new usb in place of a reboot
             print("Different USB Detected")
-            self.reset()
+            if not self.set_USB_name():
+                return False
+            self.check_new_USB()
+        # already mounted where the data goes, nothing to do
+        if self.probe.mount_point() == self.USB_path:
+            return True
         # mount the usb
-        if not os.path.exists("/media/"+str(self.label)):
-            subprocess.call("sudo mkdir /media/"+str(self.label), shell=True)
+        if not os.path.exists(self.USB_path):
+            subprocess.call("sudo mkdir -p " + self.USB_path, shell=True)
         subprocess.call("sudo chown -R pi:pi /media/" + str(self.uuid)+"/"+str(self.label), shell=True)
         if self.fstype == 'hfsplus':
             print("Mounting Apple USB")
             subprocess.call("sudo mount -t hfsplus -o force,rw /dev/sda1 /media/" + str(self.uuid)+"/"+str(self.label)+" -o uid=pi,gid=pi", shell=True)
         else:
             subprocess.call("sudo mount /dev/sda1 /media/" + str(self.uuid)+"/"+str(self.label)+" -o uid=pi,gid=pi", shell=True)
+        return True
 
     # un-mount all USBs
     def reset_usb_mounts(self):
         print("Un-Mounting USB")
+        if self.probe.mount_point() is None:
+            return
         time.sleep(0.1)
         subprocess.call("sudo umount /media/" + str(self.uuid)+"/"+str(self.label), shell=True)
 
     # edit fstab file to auto-mount when boot
     def update_fstab_file(self):
+        # only one entry per usb
+        try:
+            with open("/etc/fstab", "r") as f:
+                if "UUID="+str(self.uuid)+" " in f.read():
+                    return
+        except IOError:
+            pass
         print("Updating fstab file for new USB")
         # edit the stab file
         subprocess.call("sudo chown -R pi:pi /etc/fstab", shell=True)
@@ -184,12 +407,8 @@ class USBMaster:
 
     # check if there is a usb or not
     def check_usb(self):
-        # check if USB mounted
-        dir = str(subprocess.check_output("sudo blkid", shell=True))
-        if "/dev/sda1:" in dir:
-            return True
-        else:
-            return False
+        # check if USB plugged in, only re-probes when the device state changed
+        return self.probe.present()
     
     # get the USB path
     def get_USB_path(self):
@@ -197,6 +416,184 @@ class USBMaster:
         return self.USB_path
     
 
+'''
+Local USB Master Class:
+Functionality:
+1) Same methods as USBMaster for a plain directory standing in for the USB drive
+2) Used by simulated runs off the RasPi, nothing is mounted and nothing reboots
+'''
+
+class LocalUSBMaster:
+    def __init__(self, path):
+        self.USB_path = path
+        self.label = os.path.basename(path)
+        self.uuid = None
+        self.fstype = None
+
+    # no reboot off the RasPi, the loop carries on with the same directory
+    def reset(self):
+        print("USB reset requested, keeping " + self.USB_path)
+
+    def set_USB_name(self):
+        return True
+
+    def check_new_USB(self):
+        pass
+
+    def setup_usb_mount(self):
+        if not os.path.exists(self.USB_path):
+            os.makedirs(self.USB_path)
+        return True
+
+    def reset_usb_mounts(self):
+        pass
+
+    def check_usb(self):
+        return os.path.isdir(self.USB_path)
+
+    def get_USB_path(self):
+        return self.USB_path
+
+
+'''
+Panel Record Class:
+Functionality:
+1) One panel measurement: pre/post Voc, Isc, power, PR and SI with the weather, irradiance and uncertainty,
+   a fresh record is started from the PANEL_DATA entry for every sweep
+2) Fixed fields in __slots__ (no dict per record), a misspelled field is an error instead of a new key
+3) Values not measured are 'N/A', RecordLog.pack turns a list of records into a NumPy array
+'''
+
+class PanelRecord:
+    __slots__ = ['name', 'num', 'type', 'date_time', 'temp', 'humid', 'gpoa'] + RECORD_VALUES + RECORD_STATS + ['samples', 'weather_dt']
+
+    def __init__(self, name, num, panel_type):
+        self.name = name
+        self.num = num
+        self.type = panel_type
+        self.date_time = None
+        self.weather_dt = None
+        for key in ['temp', 'humid', 'gpoa'] + RECORD_VALUES + RECORD_STATS + ['samples']:
+            setattr(self, key, 'N/A')
+
+    # new record for a StaticManager.PANEL_DATA entry
+    @classmethod
+    def from_template(cls, panel):
+        return cls(panel['name'], panel['num'], panel['type'])
+
+    # plain dict for the journal
+    def to_dict(self):
+        return dict((key, getattr(self, key)) for key in self.__slots__)
+
+    # record from a journal dict, keys that are not record fields are ignored
+    @classmethod
+    def from_dict(cls, data):
+        record = cls(data['name'], data.get('num', 0), data.get('type', 'eds'))
+        for key in cls.__slots__:
+            if key in data:
+                setattr(record, key, data[key])
+        return record
+
+
+'''
+Row Formatter Class:
+Functionality:
+1) Turns a panel record or a manual test into the cells of one data file row, one formatting pass per row
+2) Builds the csv and txt lines from the same cells so eds_data.csv and eds_data.txt never diverge
+3) Column formats are chosen once, decimals maps record keys (e.g. 'ocv_pre') to a fixed number of decimals,
+   columns not listed are written as measured
+'''
+
+class RowFormatter:
+    # record keys of the value columns, in file order
+    KEYS = ['gpoa', 'name'] + RECORD_VALUES
+    STAT_KEYS = RECORD_STATS + ['samples']
+    # position of the Weather_Time cell, left out for data files started before that column
+    WEATHER_CELL = HEADER_CSV.index('Weather_Time')
+
+    def __init__(self, uncertainty=False, decimals=None):
+        self.uncertainty = uncertainty
+        decimals = decimals or {}
+        self.formats = dict((key, self.number_format(decimals.get(key))) for key in ['temp', 'humid'] + self.KEYS + self.STAT_KEYS)
+        # (key, format) pairs walked for every row
+        self.columns = [(key, self.formats[key]) for key in self.KEYS]
+        self.stat_columns = [(key, self.formats[key]) for key in self.STAT_KEYS]
+
+    # str() for a column written as measured, fixed decimals otherwise ('Error', 'N/A' are kept as they are)
+    @staticmethod
+    def number_format(decimals):
+        if decimals is None:
+            return str
+        pattern = '%.' + str(int(decimals)) + 'f'
+        def fixed(value):
+            if isinstance(value, (float, int)) and not isinstance(value, bool):
+                return pattern % value
+            return str(value)
+        return fixed
+
+    @staticmethod
+    def date_cells(dt):
+        return ['%d/%d/%d' % (dt.tm_mon, dt.tm_mday, dt.tm_year), '%d:%d:%d' % (dt.tm_hour, dt.tm_min, dt.tm_sec)]
+
+    # cells of a PanelRecord (same columns as HEADER_CSV, plus HEADER_STATS with uncertainty)
+    def cells(self, data):
+        row = self.date_cells(data.date_time)
+        row.append(self.formats['temp'](sensor_value(data.temp)))
+        row.append(self.formats['humid'](sensor_value(data.humid)))
+        for key, fmt in self.columns:
+            row.append(fmt(getattr(data, key)))
+        row.append(weather_time(data.weather_dt))
+        # uncertainty of the oversampled readings, N/A when not measured (e.g. CTRL post)
+        if self.uncertainty:
+            for key, fmt in self.stat_columns:
+                row.append(fmt(getattr(data, key)))
+        return row
+
+    # cells of a manual test, power, pr and si are [before, after] lists
+    def manual_cells(self, dt, temp, humid, g_poa, eds_num, eds_ocv_before, eds_ocv_after, eds_scc_before, eds_scc_after, eds_power, pr_data, si_data, weather_dt=None):
+        row = self.date_cells(dt)
+        row.append(self.formats['temp'](sensor_value(temp)))
+        row.append(self.formats['humid'](sensor_value(humid)))
+        row.append(self.formats['gpoa'](g_poa))
+        row.append(str(eds_num))
+        cells = [('ocv_pre', eds_ocv_before), ('ocv_post', eds_ocv_after), ('scc_pre', eds_scc_before), ('scc_post', eds_scc_after),
+                 ('pwr_pre', eds_power[0]), ('pwr_post', eds_power[1]), ('pr_pre', pr_data[0]), ('pr_post', pr_data[1]),
+                 ('si_pre', si_data[0]), ('si_post', si_data[1])]
+        for key, value in cells:
+            row.append(self.formats[key](value))
+        row.append(weather_time(weather_dt))
+        return row
+
+    @classmethod
+    def without_weather(cls, row):
+        return row[:cls.WEATHER_CELL] + row[cls.WEATHER_CELL + 1:]
+
+    # add the sequence number and CRC-32 columns, the crc covers the cells joined by commas in both files
+    @staticmethod
+    def frame(row, seq):
+        row = row + [str(seq)]
+        row.append('%08x' % (zlib.crc32(','.join(row).encode()) & 0xffffffff))
+        return row
+
+    # True if the last cell is the CRC-32 of the ones before it
+    @staticmethod
+    def check(row):
+        if len(row) < 3:
+            return False
+        return row[-1] == '%08x' % (zlib.crc32(','.join(row[:-1]).encode()) & 0xffffffff)
+
+    # csv line (as csv.writer writes it) and txt line (space delimited) of the same cells
+    @staticmethod
+    def lines(row):
+        csv_line = ','.join(row) + '\r\n'
+        # cells with delimiters or quotes need csv quoting, none of the measured values do
+        if '"' in csv_line or csv_line.count(',') != len(row) - 1 or csv_line.count('\n') != 1 or csv_line.count('\r') != 1:
+            out = io.StringIO()
+            csv.writer(out, delimiter=',', quotechar='"', quoting=csv.QUOTE_MINIMAL).writerow(row)
+            csv_line = out.getvalue()
+        return csv_line, ' '.join(row) + ' \n'
+
+
 '''
 CSV Master Class:
 Functionality:
@@ -206,10 +603,43 @@ Functionality:
 
 class CSVMaster:
     # initialize all file names to write to
-    def __init__(self, usb_path):
+    def __init__(self, usb_path, uncertainty=False, queue_rows=64, record_log=True, legacy=True, index=True, decimals=None, checksum=True):
+        # scheduled rows waiting to be written, flushed once per sweep or when queue_rows are waiting
+        self.queue_rows = queue_rows
+        self.pending_records = []
+        self.pending_txt = []
+        self.pending_csv = []
+        self.use_record_log = record_log
+        self.legacy = legacy
+        self.use_index = index
+        # write the std/sample count columns in the scheduled data files
+        self.uncertainty = uncertainty
+        if uncertainty:
+            self.header_csv = HEADER_CSV + HEADER_STATS
+            self.header_txt = HEADER_TXT + ' ' + ' '.join(HEADER_STATS)
+        else:
+            self.header_csv = HEADER_CSV
+            self.header_txt = HEADER_TXT
+        self.header_manual_csv = HEADER_CSV
+        self.header_manual_txt = HEADER_TXT
+        # sequence number and CRC-32 on every row of new data files, see recover_data.py
+        self.checksum = checksum
+        if checksum:
+            self.header_csv = self.header_csv + HEADER_FRAME
+            self.header_txt = self.header_txt + ' ' + ' '.join(HEADER_FRAME)
+            self.header_manual_csv = HEADER_CSV + HEADER_FRAME
+            self.header_manual_txt = HEADER_TXT + ' ' + ' '.join(HEADER_FRAME)
+        # one formatting pass per row for both data files
+        self.formatter = RowFormatter(uncertainty, decimals)
+        self.set_path(usb_path)
+
+    # point every data file at a (new) usb path, queued rows go to the new path
+    def set_path(self, usb_path):
         # usb path
         self.location_path = usb_path + '/'
-        
+        # eds_data.bin is the primary copy of the scheduled data, the csv/txt files can be exported from it
+        self.record_log = RecordLog(self.location_path + 'eds_data.bin') if self.use_record_log else None
+
         # path for manual mode
         self.txt_manual_data = self.location_path + 'manual_data.txt'
         self.csv_manual_data = self.location_path + 'manual_data.csv'
@@ -217,180 +647,875 @@ class CSVMaster:
         # path for normal scheduled measurements
         self.csv_location = self.location_path + 'eds_data.csv'
         self.txt_location = self.location_path + 'eds_data.txt'
+        # eds_data.idx, date and panel offsets into eds_data.csv for query_data.py
+        self.csv_index = CSVIndex(self.csv_location) if self.legacy and self.use_index else None
 
         # set up base csv and txt files if they don't exist
         self.check_empty_usb()
+        # rows cut off by a pulled USB must not run into the next row
+        for name in [self.csv_location, self.txt_location, self.csv_manual_data, self.txt_manual_data]:
+            self.end_torn_line(name)
+        # files started before the Weather_Time column or before checksums keep their columns
+        self.weather_column = self.has_weather_time(self.csv_location)
+        self.weather_manual = self.has_weather_time(self.csv_manual_data)
+        self.framed = self.checksum and self.has_frame(self.csv_location)
+        self.framed_manual = self.checksum and self.has_frame(self.csv_manual_data)
+        self.seq = self.last_seq(self.csv_location) if self.framed else 0
+        self.manual_seq = self.last_seq(self.csv_manual_data) if self.framed_manual else 0
+
+    def get_path(self):
+        return self.location_path.rstrip('/')
     
     # set up all initial csv and txt files if they don't exist
     def check_empty_usb(self):
         # for scheduled mode
-        self.check_for_csv_file(self.csv_location)
-        self.check_for_csv_file(self.txt_location)
+        self.check_for_csv_file(self.csv_location, self.header_csv)
+        self.check_for_csv_file(self.txt_location, self.header_csv)
         # for manual mode
-        self.check_for_txt_file(self.txt_manual_data)
-        self.check_for_csv_file(self.csv_manual_data)
+        self.check_for_txt_file(self.txt_manual_data, self.header_manual_txt)
+        self.check_for_csv_file(self.csv_manual_data, self.header_manual_csv)
+
+    # True if the header of a data file has the Seq and CRC32 columns
+    @staticmethod
+    def has_frame(name):
+        try:
+            with open(name, 'r') as f:
+                return f.readline().rstrip().endswith(HEADER_FRAME[-1])
+        except (IOError, OSError):
+            return False
+
+    # False for a data file with the original 16 column header (no Weather_Time), files that cannot be read count as new
+    @staticmethod
+    def has_weather_time(name):
+        try:
+            with open(name, 'r') as f:
+                header = f.readline()
+        except (IOError, OSError):
+            return True
+        return not header.strip() or HEADER_CSV[RowFormatter.WEATHER_CELL] in header
+
+    # finish a row that was cut off in the middle (USB pulled while writing) with a newline
+    @staticmethod
+    def end_torn_line(name):
+        try:
+            with open(name, 'rb+') as f:
+                f.seek(0, os.SEEK_END)
+                if f.tell() == 0:
+                    return
+                f.seek(-1, os.SEEK_END)
+                if f.read(1) != b'\n':
+                    f.write(b'\n')
+                    print("Ended a torn row in " + name)
+        except (IOError, OSError):
+            pass
+
+    # sequence number of the last intact row of a checksummed file, 0 if there is none
+    @staticmethod
+    def last_seq(name):
+        try:
+            with open(name, 'rb') as f:
+                f.seek(0, os.SEEK_END)
+                f.seek(max(0, f.tell() - 8192))
+                tail = f.read().decode(errors='replace')
+        except (IOError, OSError):
+            return 0
+        for line in reversed(tail.splitlines()):
+            row = line.replace(',', ' ').split()
+            if RowFormatter.check(row):
+                try:
+                    return int(row[-2])
+                except ValueError:
+                    pass
+        return 0
 
     # checks for existing data file, and creates it if none exist
-    def check_for_txt_file(self, name):
+    def check_for_txt_file(self, name, header=HEADER_TXT):
         if not os.path.isfile(name):
             try:
                 with open(name, 'a+') as f:
-                    f.writelines(HEADER_TXT + '\n')
+                    f.writelines(header + '\n')
             except:
                 print("Error creating txt file! Please check.")
     
-    def check_for_csv_file(self, name):
+    def check_for_csv_file(self, name, header=HEADER_CSV):
         if not os.path.isfile(name):
             try:
                 with open(name, 'a+') as f:
                     writer = csv.writer(f, delimiter=',', quotechar='"', quoting=csv.QUOTE_MINIMAL)
-                    writer.writerow(HEADER_CSV)
+                    writer.writerow(header)
             except:
                 print("Error creating csv file! Please check.")
     
     # construct object of data to be inserted in csv/txt file
     def data_row(self, data):
-        # deconstruct the dictionary
-        panel_name = data['name']
-        dt = data['date_time']
-        temp = data['temp']
-        humid = data['humid']
-        g_poa = data['gpoa']
-        ocv_pre = data['ocv_pre']
-        ocv_post = data['ocv_post']
-        scc_pre = data['scc_pre']
-        scc_post = data['scc_post']
-        pwr_pre = data['pwr_pre']
-        pwr_post = data['pwr_post']
-        pr_pre = data['pr_pre']
-        pr_post = data['pr_post']
-        si_pre = data['si_pre']
-        si_post = data['si_post']
-        # create date and time 
-        date = str(dt.tm_mon) + '/' + str(dt.tm_mday) + '/' + str(dt.tm_year)
-        time = str(dt.tm_hour) + ':' + str(dt.tm_min) + ':' + str(dt.tm_sec)
-        return [date, time, str(temp), str(humid), str(g_poa),panel_name, str(ocv_pre), str(ocv_post), str(scc_pre), str(scc_post), str(pwr_pre), str(pwr_post), str(pr_pre), str(pr_post), str(si_pre), str(si_post)]
+        return self.formatter.cells(data)
 
-    def data_row_manual(self, dt, temp, humid, g_poa, eds_num, eds_ocv_before, eds_ocv_after, eds_scc_before, eds_scc_after, eds_power, pr_data, si_data):
-        date = str(dt.tm_mon) + '/' + str(dt.tm_mday) + '/' + str(dt.tm_year)
-        time = str(dt.tm_hour) + ':' + str(dt.tm_min) + ':' + str(dt.tm_sec)
-        out = [date, time, str(temp), str(humid), str(g_poa), str(eds_num), str(eds_ocv_before), str(eds_ocv_after), str(eds_scc_before), str(eds_scc_after)]
-        #Append power data
-        for x in eds_power:
-            out.append(str(x))
-        #Append PR data
-        for x in pr_data:
-            out.append(str(x))
-        #Append SI data
-        for x in si_data:
-            out.append(str(x))
-
-        return out
+    def data_row_manual(self, dt, temp, humid, g_poa, eds_num, eds_ocv_before, eds_ocv_after, eds_scc_before, eds_scc_after, eds_power, pr_data, si_data, weather_dt=None):
+        return self.formatter.manual_cells(dt, temp, humid, g_poa, eds_num, eds_ocv_before, eds_ocv_after, eds_scc_before, eds_scc_after, eds_power, pr_data, si_data, weather_dt)
         
     # write to csv version of manual testing data log file
-    def write_csv_manual_data(self, dt, temp, humid, g_poa, eds_num, eds_ocv_before, eds_ocv_after, eds_scc_before, eds_scc_after, eds_power,pr_data,si_data):
-        row = self.data_row_manual(dt, temp, humid, g_poa, eds_num, eds_ocv_before, eds_ocv_after, eds_scc_before, eds_scc_after, eds_power,pr_data,si_data)
+    def write_csv_manual_data(self, dt, temp, humid, g_poa, eds_num, eds_ocv_before, eds_ocv_after, eds_scc_before, eds_scc_after, eds_power,pr_data,si_data, weather_dt=None):
+        row = self.data_row_manual(dt, temp, humid, g_poa, eds_num, eds_ocv_before, eds_ocv_after, eds_scc_before, eds_scc_after, eds_power,pr_data,si_data, weather_dt)
         try:
             # attempt to open csv file in append mode (don't want to create lots of files)
             with open(self.csv_manual_data, mode='a') as f_csv:
-                # write data to csv file
-                writer = csv.writer(f_csv, delimiter=',', quotechar='"', quoting=csv.QUOTE_MINIMAL)
-                writer.writerow(row)
+                f_csv.write(self.formatter.lines(self.manual_file_row(row))[0])
         except:
             print("Error writing csv manual testing data!")
     
     # write to txt version of manual  testing data log file
-    def write_txt_manual_data(self, dt, temp, humid, g_poa, eds_num, eds_ocv_before, eds_ocv_after, eds_scc_before, eds_scc_after, eds_power, pr_data, si_data):
+    def write_txt_manual_data(self, dt, temp, humid, g_poa, eds_num, eds_ocv_before, eds_ocv_after, eds_scc_before, eds_scc_after, eds_power, pr_data, si_data, weather_dt=None):
         # process raw data into txt dump format with space delimiters
-        row_raw = self.data_row_manual(dt, temp, humid, g_poa, eds_num, eds_ocv_before, eds_ocv_after, eds_scc_before, eds_scc_after, eds_power, pr_data, si_data)
-        row = ""
-        for param in row_raw:
-            row += param
-            row += " "
-        row += '\n'
-        
+        row = self.data_row_manual(dt, temp, humid, g_poa, eds_num, eds_ocv_before, eds_ocv_after, eds_scc_before, eds_scc_after, eds_power, pr_data, si_data, weather_dt)
         try:
             with open(self.txt_manual_data, 'a+') as f_txt:
-                f_txt.writelines(row)
+                f_txt.write(self.formatter.lines(self.manual_file_row(row))[1])
         except:
             print("Error writing txt manual data!")
     
-    # write to manual data files
-    def write_manual_data(self, dt, temp, humid, g_poa, eds_num, eds_ocv_before, eds_ocv_after, eds_scc_before, eds_scc_after, eds_power, pr_data, si_data):
-        self.write_txt_manual_data(dt, temp, humid, g_poa, eds_num, eds_ocv_before, eds_ocv_after, eds_scc_before, eds_scc_after, eds_power, pr_data, si_data)
-        self.write_csv_manual_data(dt, temp, humid, g_poa, eds_num, eds_ocv_before, eds_ocv_after, eds_scc_before, eds_scc_after, eds_power, pr_data, si_data)
+    # write to manual data files, the row is formatted once for both
+    def write_manual_data(self, dt, temp, humid, g_poa, eds_num, eds_ocv_before, eds_ocv_after, eds_scc_before, eds_scc_after, eds_power, pr_data, si_data, weather_dt=None):
+        self.write_manual_rows([self.data_row_manual(dt, temp, humid, g_poa, eds_num, eds_ocv_before, eds_ocv_after, eds_scc_before, eds_scc_after, eds_power, pr_data, si_data, weather_dt)])
+
+    # manual row with the columns of the manual files: no Weather_Time in files started before it,
+    # next manual sequence number and crc if the manual files are checksummed
+    def manual_file_row(self, row):
+        if not self.weather_manual:
+            row = RowFormatter.without_weather(row)
+        if not self.framed_manual:
+            return row
+        self.manual_seq += 1
+        return self.formatter.frame(row, self.manual_seq)
+
+    # write rows made by data_row_manual (e.g. from the journal), returns False if a file could not be written
+    def write_manual_rows(self, rows):
+        first_seq = self.manual_seq
+        lines = [self.formatter.lines(self.manual_file_row(row)) for row in rows]
+        try:
+            with open(self.txt_manual_data, 'a+') as f_txt:
+                f_txt.write(''.join(txt_line for csv_line, txt_line in lines))
+                f_txt.flush()
+                os.fsync(f_txt.fileno())
+            with open(self.csv_manual_data, mode='a') as f_csv:
+                f_csv.write(''.join(csv_line for csv_line, txt_line in lines))
+                f_csv.flush()
+                os.fsync(f_csv.fileno())
+            return True
+        except (IOError, OSError):
+            print("Error writing manual testing data!")
+            # the rows are written again with the same numbers
+            self.manual_seq = first_seq
+            return False
      
     # write data to designated panel folder
     def write_data(self, data):
-        # write the txt file
-        self.write_txt_data(data)
-        # write the csv file
-        self.write_csv_data(data)
-    
-    # write to txt version of EDS testing data log file (two copies of data for fidelity)
-    def write_txt_data(self, data):
-        # process raw data into txt dump format with space delimiters
-        row_raw = self.data_row(data)
-        print("TXT: ", row_raw)
-        row = ""
-        for param in row_raw:
-            row += param
-            row += " "
-        row += '\n'
+        self.write_batch([data])
+
+    # write a whole sweep, one open, write and fsync per file instead of two opens per panel
+    # returns False if a record could not be queued or written
+    def write_batch(self, records):
+        queued = [self.queue_data(data) for data in records]
+        return self.flush() and all(queued)
+
+    # add a record to the in-memory queue, the queue is flushed when it reaches queue_rows
+    # returns False if the queue is full and cannot be written (USB gone), the record is then not queued at all
+    def queue_data(self, data):
+        if max(len(self.pending_records), len(self.pending_txt), len(self.pending_csv)) >= self.queue_rows and not self.flush():
+            # refuse the new row in every file rather than trimming, the queued rows keep their sequence numbers
+            print("Data queue full, dropping " + data.name + " measurement")
+            return False
+        if self.record_log is not None:
+            self.pending_records.append(data)
+        if self.legacy:
+            row = self.formatter.cells(data)
+            if not self.weather_column:
+                row = RowFormatter.without_weather(row)
+            if self.framed:
+                self.seq += 1
+                row = self.formatter.frame(row, self.seq)
+            # both lines from one formatting pass, txt version has space delimiters
+            csv_line, txt_line = self.formatter.lines(row)
+            self.pending_txt.append(txt_line)
+            self.pending_csv.append(csv_line)
+        if max(len(self.pending_records), len(self.pending_txt), len(self.pending_csv)) >= self.queue_rows:
+            self.flush()
+        return True
+
+    # commit queued rows to eds_data.bin, eds_data.txt and eds_data.csv, rows are only dropped from
+    # the queue once they are fsynced, a failed write keeps them for the next flush
+    def flush(self):
+        if self.pending_records and self.record_log.append(self.pending_records):
+            self.pending_records = []
+        if self.pending_txt:
+            try:
+                with open(self.txt_location, 'a') as f_txt:
+                    f_txt.write(''.join(self.pending_txt))
+                    f_txt.flush()
+                    os.fsync(f_txt.fileno())
+                print("TXT: wrote " + str(len(self.pending_txt)) + " rows")
+                self.pending_txt = []
+            except (IOError, OSError):
+                print("Error writing txt EDS data!")
+        if self.pending_csv:
+            try:
+                # attempt to open csv file in append mode (don't want to create lots of files)
+                with open(self.csv_location, mode='a') as f_csv:
+                    # write data to csv file
+                    f_csv.write(''.join(self.pending_csv))
+                    f_csv.flush()
+                    os.fsync(f_csv.fileno())
+                print("CSV: wrote " + str(len(self.pending_csv)) + " rows")
+                self.pending_csv = []
+            except (IOError, OSError):
+                print("Error writing csv EDS data!")
+            # index the rows just written
+            if self.csv_index is not None:
+                self.csv_index.update()
+        return not self.pending_records and not self.pending_txt and not self.pending_csv
+
+    # forget queued rows that could not be written, used when the caller keeps its own copy (journal)
+    def clear_queue(self):
+        self.pending_records = []
+        self.pending_txt = []
+        self.pending_csv = []
+        # numbers of the dropped rows are used again
+        if self.framed:
+            self.seq = self.last_seq(self.csv_location)
+
+    # regenerate eds_data.csv/txt from eds_data.bin (e.g. when the legacy files are switched off)
+    def export_legacy(self):
+        count = self.record_log.export(self.csv_location, self.txt_location, self.uncertainty, self.framed)
+        # exported files always have the Weather_Time column
+        self.weather_column = True
+        if self.framed:
+            self.seq = count
+        if self.csv_index is not None:
+            self.csv_index.rebuild()
+        return count
         
+            
+'''
+Record Log Class:
+Functionality:
+1) Appends panel records to a binary file of RECORD_DTYPE records (one write and fsync per batch)
+2) Maps the file into a NumPy array for analysis without parsing
+3) Exports the records to the legacy csv and txt formats
+'''
+
+class RecordLog:
+    def __init__(self, path):
+        self.path = path
+        self.check_for_record_file()
+
+    # create the file with its header if it does not exist
+    def check_for_record_file(self):
+        if not os.path.isfile(self.path):
+            try:
+                with open(self.path, 'wb') as f:
+                    f.write(RECORD_MAGIC + np.uint32(RECORD_DTYPE.itemsize).tobytes() + bytes(4))
+            except:
+                print("Error creating record file! Please check.")
+
+    # numeric value of a record field, NaN for 'Error', 'N/A', None and blanks
+    @staticmethod
+    def number(value):
         try:
-            with open(self.txt_location, 'a') as f_txt:
-                f_txt.writelines(row)
-        except:
-            print("Error writing txt EDS data!")
-    
-    # write to csv version of EDS testing data log file
-    def write_csv_data(self, data):
-        row = self.data_row(data)
-        print("CSV: ", row)
+            return float(value)
+        except (TypeError, ValueError):
+            return float('nan')
+
+    @staticmethod
+    def epoch(dt):
+        if not dt:
+            return float('nan')
+        return time.mktime(tuple(dt))
+
+    # pack PanelRecords into a structured array
+    def pack(self, records):
+        out = np.zeros(len(records), dtype=RECORD_DTYPE)
+        for i, data in enumerate(records):
+            row = out[i]
+            row['timestamp'] = self.epoch(data.date_time)
+            row['temp'] = self.number(data.temp)
+            row['humid'] = self.number(data.humid)
+            row['gpoa'] = self.number(data.gpoa)
+            row['panel'] = data.name.encode()
+            for key in RECORD_VALUES + RECORD_STATS:
+                row[key] = self.number(getattr(data, key))
+            row['weather_time'] = self.epoch(data.weather_dt)
+            row['samples'] = data.samples if isinstance(data.samples, int) else 0
+        return out
+
+    # append records with a single write, returns False if the file could not be written
+    def append(self, records):
+        if not records:
+            return True
         try:
-            # attempt to open csv file in append mode (don't want to create lots of files)
-            with open(self.csv_location, mode='a') as f_csv:
-                # write data to csv file
-                writer = csv.writer(f_csv, delimiter=',', quotechar='"', quoting=csv.QUOTE_MINIMAL)
+            with open(self.path, 'r+b') as f:
+                # a torn record at the end (power cut) is cut off so the new ones start on a record boundary
+                count = max(0, (f.seek(0, os.SEEK_END) - RECORD_HEADER_SIZE) // RECORD_DTYPE.itemsize)
+                f.truncate(RECORD_HEADER_SIZE + count * RECORD_DTYPE.itemsize)
+                f.seek(0, os.SEEK_END)
+                f.write(self.pack(records).tobytes())
+                f.flush()
+                os.fsync(f.fileno())
+            return True
+        except (IOError, OSError):
+            print("Error writing EDS record file!")
+            return False
+
+    # read only view of every complete record, a torn record at the end (power cut) is ignored
+    def read(self):
+        with open(self.path, 'rb') as f:
+            header = f.read(RECORD_HEADER_SIZE)
+        if header[:8] != RECORD_MAGIC or np.frombuffer(header[8:12], dtype='<u4')[0] != RECORD_DTYPE.itemsize:
+            raise ValueError(self.path + " is not an EDS record file of this version")
+        count = (os.path.getsize(self.path) - RECORD_HEADER_SIZE) // RECORD_DTYPE.itemsize
+        if count == 0:
+            return np.zeros(0, dtype=RECORD_DTYPE)
+        return np.memmap(self.path, dtype=RECORD_DTYPE, mode='r', offset=RECORD_HEADER_SIZE, shape=(count,))
+
+    # legacy text of a stored number, shortest form float32 keeps
+    @staticmethod
+    def text(value, missing='N/A'):
+        if np.isnan(value):
+            return missing
+        return str(float('%.7g' % value))
+
+    # one record as a row of the legacy data files (same as CSVMaster.data_row)
+    def legacy_row(self, rec, uncertainty=False):
+        dt = time.localtime(rec['timestamp'])
+        date = str(dt.tm_mon) + '/' + str(dt.tm_mday) + '/' + str(dt.tm_year)
+        clock = str(dt.tm_hour) + ':' + str(dt.tm_min) + ':' + str(dt.tm_sec)
+        row = [date, clock, self.text(rec['temp'], 'Error'), self.text(rec['humid'], 'Error'), self.text(rec['gpoa']),
+               rec['panel'].decode()]
+        for key in RECORD_VALUES:
+            row.append(self.text(rec[key]))
+        row.append('N/A' if np.isnan(rec['weather_time']) else weather_time(time.localtime(rec['weather_time'])))
+        if uncertainty:
+            for key in RECORD_STATS:
+                row.append(self.text(rec[key]))
+            row.append(str(int(rec['samples'])) if rec['samples'] else 'N/A')
+        return row
+
+    # regenerate eds_data.csv/txt style files from the records
+    def export(self, csv_path, txt_path, uncertainty=False, framed=False):
+        header_csv = HEADER_CSV + HEADER_STATS if uncertainty else HEADER_CSV
+        if framed:
+            header_csv = header_csv + HEADER_FRAME
+        records = self.read()
+        with open(csv_path, 'w') as f_csv, open(txt_path, 'w') as f_txt:
+            writer = csv.writer(f_csv, delimiter=',', quotechar='"', quoting=csv.QUOTE_MINIMAL)
+            writer.writerow(header_csv)
+            # the legacy txt file starts with the csv header
+            writer_txt = csv.writer(f_txt, delimiter=',', quotechar='"', quoting=csv.QUOTE_MINIMAL)
+            writer_txt.writerow(header_csv)
+            for seq, rec in enumerate(records):
+                row = self.legacy_row(rec, uncertainty)
+                if framed:
+                    row = RowFormatter.frame(row, seq + 1)
                 writer.writerow(row)
-        except:
-            print("Error writing csv EDS data!")
-        
-            
+                f_txt.write(' '.join(row) + ' \n')
+        return len(records)
+
+
+'''
+CSV Index Class:
+Functionality:
+1) Keeps eds_data.idx next to eds_data.csv, the byte offset, day and panel of every data row
+2) Updates incrementally, only the bytes appended to the csv since the last update are read
+3) Answers panel and date range queries by seeking to the matching rows instead of parsing the whole csv
+'''
+
+class CSVIndex:
+    def __init__(self, csv_path, index_path=None):
+        self.csv_path = csv_path
+        self.path = os.path.splitext(csv_path)[0] + '.idx' if index_path is None else index_path
+
+    # bytes of the csv indexed and number of entries, (0, 0) for a missing or foreign index
+    def read_header(self):
+        try:
+            with open(self.path, 'rb') as f:
+                header = f.read(INDEX_HEADER_SIZE)
+        except (IOError, OSError):
+            return 0, 0
+        if len(header) < INDEX_HEADER_SIZE or header[:8] != INDEX_MAGIC:
+            return 0, 0
+        indexed, count = np.frombuffer(header[8:], dtype='<u8')
+        return int(indexed), int(count)
+
+    # start the index over, the next update reads the whole csv
+    def rebuild(self):
+        try:
+            with open(self.path, 'wb') as f:
+                f.write(INDEX_MAGIC + np.array([0, 0], dtype='<u8').tobytes())
+        except (IOError, OSError):
+            print("Error creating csv index! Please check.")
+            return False
+        return self.update()
+
+    # date ordinal of a m/d/y date cell, None for the header or a damaged row
+    @staticmethod
+    def day(cell):
+        try:
+            month, day, year = cell.split(b'/')
+            return date(int(year), int(month), int(day)).toordinal()
+        except ValueError:
+            return None
+
+    # index the rows appended to the csv since the last update, returns False on a file error
+    def update(self):
+        indexed, count = self.read_header()
+        try:
+            size = os.path.getsize(self.csv_path)
+        except OSError:
+            return False
+        # csv rewritten or cut short (export, restore), index it again from the start
+        if size < indexed or not os.path.isfile(self.path):
+            indexed, count = 0, 0
+        if size == indexed:
+            return True
+        try:
+            with open(self.csv_path, 'rb') as f:
+                f.seek(indexed)
+                tail = f.read(size - indexed)
+            entries = []
+            offset = indexed
+            # a row without its newline is still being written, it is picked up next time
+            for line in tail.splitlines(True):
+                if not line.endswith(b'\n'):
+                    break
+                cells = line.split(b',', 6)
+                day = self.day(cells[0]) if len(cells) > 6 else None
+                if day is not None:
+                    entries.append((offset, day, cells[5].strip(b'"')))
+                offset += len(line)
+            with open(self.path, 'r+b' if indexed else 'wb') as f:
+                # entries past the header count are from an interrupted update
+                f.truncate(INDEX_HEADER_SIZE + count * INDEX_DTYPE.itemsize)
+                f.seek(0, os.SEEK_END)
+                f.write(np.array(entries, dtype=INDEX_DTYPE).tobytes())
+                f.seek(0)
+                f.write(INDEX_MAGIC + np.array([offset, count + len(entries)], dtype='<u8').tobytes())
+            return True
+        except (IOError, OSError):
+            print("Error updating csv index!")
+            return False
+
+    # every index entry as an array
+    def read(self):
+        indexed, count = self.read_header()
+        if count == 0:
+            return np.zeros(0, dtype=INDEX_DTYPE)
+        return np.fromfile(self.path, dtype=INDEX_DTYPE, count=count, offset=INDEX_HEADER_SIZE)
+
+    # csv rows of a panel (all panels if None) between two dates (datetime.date, inclusive, open if None)
+    def query(self, panel=None, start=None, end=None):
+        entries = self.read()
+        match = np.ones(len(entries), dtype=bool)
+        if panel is not None:
+            match &= entries['panel'] == panel.encode()
+        if start is not None:
+            match &= entries['day'] >= start.toordinal()
+        if end is not None:
+            match &= entries['day'] <= end.toordinal()
+        rows = []
+        with open(self.csv_path, 'rb') as f:
+            for offset in entries['offset'][match]:
+                f.seek(int(offset))
+                rows.append(f.readline().decode())
+        return [row for row in csv.reader(rows)]
+
+
+'''
+Data Recovery Class:
+Functionality:
+1) Scans a data file (eds_data.csv/txt, manual_data.csv/txt) one line at a time, memory does not grow with the file
+2) Keeps rows whose CRC-32 matches, repairs rows a torn write ran into (NUL bytes, cut off row in front)
+   and drops what cannot be repaired, files without checksums are checked by their number of columns
+3) Reports gaps and repeats in the sequence numbers
+'''
+
+class DataRecovery:
+    # start of a row, m/d/yyyy followed by a delimiter (lookahead, so overlapping starts are all found)
+    ROW_START = re.compile(rb'(?=\d{1,2}/\d{1,2}/\d{4}[, ])')
+    # longer lines are garbage (e.g. a run of NUL bytes), they are skipped without being held in memory
+    MAX_LINE = 65536
+
+    def __init__(self, path, max_gaps=1000):
+        self.path = path
+        # txt rows are space delimited, their header can be either
+        self.txt = path.endswith('.txt')
+        self.max_gaps = max_gaps
+        self.reset()
+
+    def reset(self):
+        self.lines = 0
+        self.good = 0
+        self.repaired = 0
+        self.dropped = 0
+        self.repeated = 0
+        self.missing = 0
+        self.gaps = []
+        self.last_seq = 0
+        self.framed = False
+        self.columns = 0
+
+    # cells of a line, None if it is not text
+    def split(self, text):
+        try:
+            text = text.decode('ascii').rstrip('\r\n')
+        except UnicodeDecodeError:
+            return None
+        return text.split() if self.txt else text.split(',')
+
+    # intact cells of a line and whether it had to be repaired, (None, False) if it cannot be
+    def recover(self, line):
+        text = line.replace(b'\x00', b'')
+        row = self.split(text)
+        if self.valid(row):
+            return row, text != line
+        # a cut off row with a complete one behind it on the same line
+        for match in self.ROW_START.finditer(text, 1):
+            row = self.split(text[match.start():])
+            if self.valid(row):
+                return row, True
+        return None, False
+
+    def valid(self, row):
+        if row is None or len(row) != self.columns or not self.ROW_START.match((row[0] + ',').encode()):
+            return False
+        if self.framed:
+            return RowFormatter.check(row) and row[-2].isdigit()
+        return True
+
+    # next line of the file, None for an over long line, b'' at the end
+    def read_line(self, f):
+        line = f.readline(self.MAX_LINE)
+        if len(line) < self.MAX_LINE or line.endswith(b'\n'):
+            return line
+        while line and not line.endswith(b'\n'):
+            line = f.readline(self.MAX_LINE)
+        return None
+
+    def add_gap(self, first, last):
+        self.missing += last - first + 1
+        if len(self.gaps) < self.max_gaps:
+            self.gaps.append((first, last))
+
+    # scan the file, intact and repaired rows are written to out_path (if given), returns the summary
+    def scan(self, out_path=None):
+        self.reset()
+        out = open(out_path, 'wb') if out_path else None
+        try:
+            with open(self.path, 'rb') as f:
+                header = f.readline()
+                if out:
+                    out.write(header)
+                names = header.decode('ascii', 'replace').strip()
+                names = names.split(',') if ',' in names else names.split()
+                self.columns = len(names)
+                self.framed = names[-1] == HEADER_FRAME[-1]
+                while True:
+                    line = self.read_line(f)
+                    if line == b'':
+                        break
+                    self.lines += 1
+                    row, repaired = self.recover(line) if line is not None else (None, False)
+                    if row is None:
+                        self.dropped += 1
+                        continue
+                    if self.framed:
+                        seq = int(row[-2])
+                        # journal redelivery or a copied file, keep the first copy
+                        if seq <= self.last_seq:
+                            self.repeated += 1
+                            continue
+                        if seq > self.last_seq + 1:
+                            self.add_gap(self.last_seq + 1, seq - 1)
+                        self.last_seq = seq
+                    if repaired:
+                        self.repaired += 1
+                    else:
+                        self.good += 1
+                    if out:
+                        out.write(((' '.join(row) + ' \n') if self.txt else (','.join(row) + '\r\n')).encode())
+        finally:
+            if out:
+                out.close()
+        return self.summary()
+
+    def summary(self):
+        return {'lines': self.lines, 'good': self.good, 'repaired': self.repaired, 'dropped': self.dropped,
+                'repeated': self.repeated, 'missing': self.missing, 'gaps': self.gaps, 'last_seq': self.last_seq,
+                'checksummed': self.framed}
+
+
+'''
+Journal Master Class:
+Functionality:
+1) Commits measurements to a journal on the RasPi SD card first (one write and fsync per sweep)
+2) Drains everything not yet acknowledged to the USB data files in one mounted session
+3) Acknowledges drained entries by sequence number and compacts the journal once all are on the USB
+'''
+
+class JournalMaster:
+    # record fields holding struct_time, stored as lists in the journal
+    TIME_FIELDS = ['date_time', 'weather_dt']
+
+    def __init__(self, journal_dir):
+        self.journal_dir = journal_dir
+        if not os.path.exists(journal_dir):
+            os.makedirs(journal_dir)
+        self.journal_file = os.path.join(journal_dir, 'journal.jsonl')
+        self.ack_file = os.path.join(journal_dir, 'journal.ack')
+        # highest sequence number written to the USB
+        self.acked = self.read_ack()
+        # highest sequence number in the journal
+        self.last_seq = self.acked
+        for entry in self.entries():
+            self.last_seq = max(self.last_seq, entry['seq'])
+
+    def read_ack(self):
+        try:
+            with open(self.ack_file, 'r') as f:
+                return int(f.read().strip() or 0)
+        except (IOError, OSError, ValueError):
+            return 0
+
+    # the ack file is replaced atomically so a power cut leaves the old or the new value
+    def write_ack(self, seq):
+        tmp = self.ack_file + '.tmp'
+        with open(tmp, 'w') as f:
+            f.write(str(seq))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, self.ack_file)
+        self.acked = seq
+
+    # every complete entry in the journal, a torn last line (power cut) is skipped
+    def entries(self):
+        out = []
+        if not os.path.isfile(self.journal_file):
+            return out
+        with open(self.journal_file, 'r') as f:
+            for line in f:
+                try:
+                    out.append(json.loads(line))
+                except ValueError:
+                    print("Skipping damaged journal entry")
+        return out
+
+    # entries not yet acknowledged by a drain
+    def pending(self):
+        return [entry for entry in self.entries() if entry['seq'] > self.acked]
+
+    def pending_count(self):
+        return self.last_seq - self.acked
+
+    # append entries of one kind ('data' panel records or 'manual' rows), returns False if the SD write failed
+    def append(self, kind, items):
+        lines = []
+        seq = self.last_seq
+        for item in items:
+            seq += 1
+            lines.append(json.dumps({'seq': seq, 'kind': kind, 'item': item}) + '\n')
+        try:
+            with open(self.journal_file, 'a+') as f:
+                # start on a fresh line if the last write was cut off
+                if f.tell() > 0:
+                    f.seek(f.tell() - 1)
+                    if f.read(1) != '\n':
+                        lines.insert(0, '\n')
+                f.write(''.join(lines))
+                f.flush()
+                os.fsync(f.fileno())
+        except (IOError, OSError):
+            print("Error writing the SD card journal!")
+            return False
+        self.last_seq = seq
+        return True
+
+    def append_records(self, records):
+        return self.append('data', [record.to_dict() for record in records])
+
+    def append_manual(self, row):
+        return self.append('manual', [row])
+
+    # rebuild a PanelRecord from its journal copy
+    def record(self, item):
+        data = dict(item)
+        for key in self.TIME_FIELDS:
+            if data.get(key):
+                data[key] = time.struct_time(tuple(data[key]))
+        return PanelRecord.from_dict(data)
+
+    # write pending entries through csv_master (USB must be mounted), returns the number drained or -1 on failure
+    # entries are acknowledged only after the USB files are fsynced, a failed drain is retried in full next time
+    def drain(self, csv_master):
+        pending = self.pending()
+        if not pending:
+            return 0
+        records = [self.record(entry['item']) for entry in pending if entry['kind'] == 'data']
+        manual = [entry['item'] for entry in pending if entry['kind'] == 'manual']
+        ok = csv_master.write_batch(records) if records else True
+        if ok and manual:
+            ok = csv_master.write_manual_rows(manual)
+        if not ok:
+            csv_master.clear_queue()
+            return -1
+        self.write_ack(pending[-1]['seq'])
+        self.compact()
+        return len(pending)
+
+    # everything is on the USB, start a fresh journal (the ack file keeps the sequence going)
+    def compact(self):
+        if self.acked >= self.last_seq:
+            with open(self.journal_file, 'w') as f:
+                f.flush()
+                os.fsync(f.fileno())
+
+
 '''
 Log Master Class:
 Functionality:
 1) Checks if log file exists, creates it if not
-2) Has method for writing to log file with current date/time
+2) Buffers log lines with current date/time in memory, lines below the log level are dropped
+3) Writes the buffer to log.txt and log.jsonl (one json object per line) in one go,
+   when buffer_lines are waiting, every flush_seconds or on flush()
+4) Starts new log files on a new day or past max_bytes, the old ones are gzipped and the newest keep_segments kept
 '''
             
 class LogMaster:
     # initialize log file name to write to
-    def __init__(self, usb_path, dt):
+    def __init__(self, usb_path, dt, level='INFO', buffer_lines=200, flush_seconds=300, max_bytes=1048576,
+                 keep_segments=60, json_log=True, clock=time.time):
+        self.date_created = dt
+        self.level = LOG_LEVELS.get(str(level).upper(), LOG_LEVELS['INFO'])
+        self.buffer_lines = max(1, int(buffer_lines))
+        self.flush_seconds = flush_seconds
+        self.max_bytes = max_bytes
+        self.keep_segments = int(keep_segments)
+        self.json_log = json_log
+        self.clock = clock
+        # (dt, log.txt line, log.jsonl line) waiting to be written
+        self.pending = []
+        self.last_flush = clock()
+        # the USB is only mounted now and then, lines are held in memory while it is not
+        self.writable = True
+        self.set_path(usb_path, dt)
+
+    # called when the USB is mounted (True) or un-mounted (False)
+    def set_writable(self, writable):
+        self.writable = writable
+
+    # point the log at a (new) usb path, creating the log file there if needed
+    def set_path(self, usb_path, dt):
         self.location_path = usb_path + '/'
         self.log_file = self.location_path + 'log.txt'
-        self.date_created = dt
-        
-        # set up base csv and txt files if they don't exist
-        self.check_for_log_file(self.date_created)
+        self.json_file = self.location_path + 'log.jsonl'
+        self.check_for_log_file(dt)
+        self.segment_day = self.read_segment_day(dt)
+
+    @staticmethod
+    def log_time(dt):
+        return str(dt.tm_mon) + '/' + str(dt.tm_mday) + '/' + str(dt.tm_year) + ' ' + str(dt.tm_hour) + ':' + str(dt.tm_min) + ':' + str(dt.tm_sec)
+
+    @staticmethod
+    def day(dt):
+        return (dt.tm_year, dt.tm_mon, dt.tm_mday)
         
     # checks for existing log file, and creates it if none exist
     def check_for_log_file(self, dt):
         if not os.path.isfile(self.log_file):
-            datetime = str(dt.tm_mon) + '/' + str(dt.tm_mday) + '/' + str(dt.tm_year) + ' ' + str(dt.tm_hour) + ':' + str(dt.tm_min) + ':' + str(dt.tm_sec)
             try:
                 with open(self.log_file, 'a') as f:
-                    f.writelines("Log File of Field Unit Activity. Created on: " + datetime + '\n')
+                    f.writelines("Log File of Field Unit Activity. Created on: " + self.log_time(dt) + '\n')
             except:
                 print("Error creating log file! Please check.")
+
+    # day the current log.txt was started, from its first line
+    def read_segment_day(self, dt):
+        try:
+            with open(self.log_file, 'r') as f:
+                month, day, year = f.readline().split('Created on: ')[1].split()[0].split('/')
+            return (int(year), int(month), int(day))
+        except (IOError, OSError, IndexError, ValueError):
+            return self.day(dt)
                 
-    # write phrase to log file
-    def write_log(self, dt, phrase):
+    # queue phrase for the log files, level is one of LOG_LEVELS
+    def write_log(self, dt, phrase, level='INFO'):
+        level = str(level).upper()
+        if LOG_LEVELS.get(level, LOG_LEVELS['INFO']) < self.level:
+            return
+        # create datetime phrase to log data
+        line = self.log_time(dt) + ' - ' + phrase + '\n'
+        entry = json.dumps({'time': '%04d-%02d-%02dT%02d:%02d:%02d' % tuple(dt[:6]), 'level': level, 'message': phrase}) + '\n'
+        self.pending.append((dt, line, entry))
+        if not self.writable:
+            # wait for the next mounted session, but not forever
+            del self.pending[:-self.buffer_lines * 10]
+        elif len(self.pending) >= self.buffer_lines or self.clock() - self.last_flush >= self.flush_seconds:
+            self.flush()
+
+    # write the queued lines, one open per file and day, returns False if the files could not be written
+    def flush(self):
+        if not self.writable:
+            return False
+        self.last_flush = self.clock()
         try:
-            # create datetime phrase to log data
-            datetime = str(dt.tm_mon) + '/' + str(dt.tm_mday) + '/' + str(dt.tm_year) + ' ' + str(dt.tm_hour) + ':' + str(dt.tm_min) + ':' + str(dt.tm_sec)
-            with open(self.log_file, 'a+') as f_log:
-                f_log.writelines(datetime + ' - ' + phrase + '\n')
-        except:
-            print("Error writing to existing log file! Please check.")
\ No newline at end of file
+            while self.pending:
+                # lines of the same day go to the same log file
+                day = self.day(self.pending[0][0])
+                end = 1
+                while end < len(self.pending) and self.day(self.pending[end][0]) == day:
+                    end += 1
+                if day != self.segment_day or (os.path.isfile(self.log_file) and os.path.getsize(self.log_file) >= self.max_bytes):
+                    self.rotate(self.pending[0][0])
+                lines = self.pending[:end]
+                with open(self.log_file, 'a+') as f_log:
+                    f_log.writelines([line for dt, line, entry in lines])
+                if self.json_log:
+                    with open(self.json_file, 'a+') as f_json:
+                        f_json.writelines([entry for dt, line, entry in lines])
+                del self.pending[:end]
+            return True
+        except (IOError, OSError):
+            print("Error writing to existing log file! Please check.")
+            # keep the lines for the next try, but not forever
+            del self.pending[:-self.buffer_lines * 10]
+            return False
+
+    # gzip the current log files and start new ones dated dt
+    def rotate(self, dt):
+        stamp = '%04d%02d%02d' % self.segment_day
+        for path in [self.log_file, self.json_file]:
+            if not os.path.isfile(path) or os.path.getsize(path) == 0:
+                continue
+            base, ext = os.path.splitext(path)
+            target = base + '_' + stamp + ext + '.gz'
+            n = 0
+            while os.path.exists(target):
+                n += 1
+                target = base + '_' + stamp + '_' + str(n) + ext + '.gz'
+            with open(path, 'rb') as src, gzip.open(target, 'wb') as dst:
+                shutil.copyfileobj(src, dst)
+            os.remove(path)
+        self.segment_day = self.day(dt)
+        self.check_for_log_file(dt)
+        self.remove_old_segments()
+
+    # only keep the newest keep_segments gzipped logs of each kind, 0 keeps all
+    def remove_old_segments(self):
+        if self.keep_segments <= 0:
+            return
+        for ext in ['.txt', '.jsonl']:
+            pattern = re.compile(r'^log_(\d{8})(?:_(\d+))?' + re.escape(ext) + r'\.gz$')
+            segments = []
+            for name in os.listdir(self.location_path):
+                match = pattern.match(name)
+                if match:
+                    segments.append((match.group(1), int(match.group(2) or 0), name))
+            segments.sort()
+            for stamp, n, name in segments[:-self.keep_segments]:
+                os.remove(self.location_path + name)
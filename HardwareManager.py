@@ -0,0 +1,582 @@
+'''
+=============================
+Title: Hardware Backends - EDS Field Control
+=============================
+'''
+
+import os
+import csv
+import time
+import math
+import bisect
+import datetime
+import tempfile
+import threading
+import MCP3008
+import AM2315
+import SP420
+
+# which hardware the controller talks to: 'pi' (default), 'sim' (synthetic clear sky days) or 'replay'
+MODE_ENV = 'EDS_HARDWARE'
+# recorded eds_data.csv fed through the control loop in replay mode
+TRACE_ENV = 'EDS_TRACE'
+# directory standing in for the USB drive and the RasPi Desktop off the Pi
+SIM_DIR_ENV = 'EDS_SIM_DIR'
+# simulated start time ('YYYY-MM-DD HH:MM') and run length in hours
+SIM_START_ENV = 'EDS_SIM_START'
+SIM_HOURS_ENV = 'EDS_SIM_HOURS'
+# simulated manual button presses, comma separated 'YYYY-MM-DD HH:MM' times
+SIM_PRESS_ENV = 'EDS_SIM_PRESS'
+
+# solar panel specifications, same panel as PowerMaster
+PANEL_VOC = 21.5
+PANEL_ISC = 0.68
+PANEL_NOCT = 47
+# simulated SPI transfer time of one MCP3008 reading
+SIM_ADC_READ_DELAY = 0.0001
+
+
+def hardware_mode():
+    return os.environ.get(MODE_ENV, 'pi').lower()
+
+def is_simulated():
+    return hardware_mode() != 'pi'
+
+# parse a number from a data file cell, None for 'Error', 'N/A' and blanks
+def number(cell):
+    try:
+        return float(cell)
+    except (TypeError, ValueError):
+        return None
+
+
+'''
+Simulated GPIO Class:
+Functionality:
+1) Same calls and constants as RPi.GPIO, keeps pin directions and levels in memory
+2) Lets a simulation drive input pins (manual button), with RPi.GPIO style edge detection callbacks
+3) Notifies listeners on every output so relay state can drive the simulated sensors
+'''
+
+class SimulatedGPIO(object):
+    # constants matching RPi.GPIO
+    BCM = 11
+    BOARD = 10
+    OUT = 0
+    IN = 1
+    LOW = 0
+    HIGH = 1
+    PUD_OFF = 20
+    PUD_DOWN = 21
+    PUD_UP = 22
+    RISING = 31
+    FALLING = 32
+    BOTH = 33
+
+    def __init__(self):
+        self.mode = None
+        self.directions = {}
+        self.levels = {}
+        # levels driven onto input pins from outside
+        self.inputs = {}
+        self.listeners = []
+        self.outputs = 0
+        # pin: [edge, callback] from add_event_detect
+        self.edges = {}
+
+    def setmode(self, mode):
+        self.mode = mode
+
+    def setwarnings(self, flag):
+        pass
+
+    def setup(self, pin, direction, pull_up_down=None, initial=None):
+        self.directions[pin] = direction
+        if direction == self.OUT:
+            self.set_level(pin, self.LOW if initial is None else initial)
+        else:
+            self.levels.pop(pin, None)
+
+    def output(self, pin, value):
+        if self.directions.get(pin) != self.OUT:
+            raise RuntimeError("The GPIO channel has not been set up as an OUTPUT")
+        self.outputs += 1
+        self.set_level(pin, self.HIGH if value else self.LOW)
+
+    def input(self, pin):
+        if self.directions.get(pin) == self.OUT:
+            return self.levels[pin]
+        return self.inputs.get(pin, self.LOW)
+
+    def cleanup(self, pin=None):
+        # cleaned up pins go back to inputs, like on the RasPi
+        if pin is None:
+            pins = list(self.directions)
+        elif isinstance(pin, (list, tuple)):
+            pins = pin
+        else:
+            pins = [pin]
+        for p in pins:
+            if self.levels.get(p):
+                self.set_level(p, self.LOW)
+            self.directions.pop(p, None)
+            self.levels.pop(p, None)
+
+    def add_event_detect(self, pin, edge, callback=None, bouncetime=None):
+        if self.directions.get(pin) != self.IN:
+            raise RuntimeError("You must setup() the GPIO channel as an input first")
+        self.edges[pin] = [edge, callback]
+
+    def remove_event_detect(self, pin):
+        self.edges.pop(pin, None)
+
+    def set_level(self, pin, level):
+        self.levels[pin] = level
+        for listener in self.listeners:
+            listener(pin, level)
+
+    # simulation helpers
+    def is_output(self, pin):
+        return self.directions.get(pin) == self.OUT
+
+    def press(self, pin):
+        self.drive(pin, self.HIGH)
+
+    def release(self, pin):
+        self.drive(pin, self.LOW)
+
+    # level on an input pin, runs the edge detection callback like the RPi.GPIO event thread
+    def drive(self, pin, level):
+        old = self.inputs.get(pin, self.LOW)
+        self.inputs[pin] = level
+        detect = self.edges.get(pin)
+        if detect is None or old == level or detect[1] is None:
+            return
+        if detect[0] == self.BOTH or (detect[0] == self.RISING) == (level == self.HIGH):
+            detect[1](pin)
+
+
+def load_gpio():
+    # the real library only imports on a RasPi
+    if is_simulated():
+        return SimulatedGPIO()
+    import RPi.GPIO as GPIO
+    return GPIO
+
+# GPIO module (or simulated stand-in) used by every manager
+GPIO = load_gpio()
+
+
+'''
+System Clock Class:
+Functionality:
+1) Wall clock of the RasPi (network time or RTC)
+'''
+
+class SystemClock(object):
+
+    def now(self):
+        return datetime.datetime.now()
+
+    def time(self):
+        return time.time()
+
+    def monotonic(self):
+        return time.monotonic()
+
+    def localtime(self, secs=None):
+        return time.localtime(secs)
+
+    def sleep(self, seconds):
+        time.sleep(seconds)
+
+    # block until event is set or seconds have passed, True if the event was set
+    def wait(self, event, seconds):
+        return event.wait(seconds)
+
+
+class SimulationFinished(SystemExit):
+    # raised from the simulated clock when the run length is used up, ends the control loop like an exit
+    pass
+
+
+'''
+Simulated Clock Class:
+Functionality:
+1) Keeps simulated time, sleeping advances it instantly
+2) Same methods as SystemClock, handed to the managers and sensors (clock=/sleep= arguments) instead of the time module
+3) Runs callbacks registered with call_at as simulated time passes them (e.g. button presses)
+4) Ends the run with SimulationFinished when the end time is reached
+'''
+
+class SimulatedClock(object):
+
+    def __init__(self, start, end=None):
+        self.start = start
+        self.end = end
+        self.t = start
+        # [time, order, callback] sorted by time
+        self.timers = []
+        self.timer_count = 0
+
+    def time(self):
+        return self.t
+
+    def monotonic(self):
+        return self.t - self.start
+
+    def call_at(self, t, callback):
+        self.timer_count += 1
+        bisect.insort(self.timers, [t, self.timer_count, callback])
+
+    # move time forward, stops early once event is set by a callback, True if it was
+    def advance(self, seconds, event=None):
+        target = self.t + seconds
+        while self.timers and self.timers[0][0] <= target:
+            t, order, callback = self.timers.pop(0)
+            self.t = max(self.t, t)
+            self.check_end()
+            callback()
+            if event is not None and event.is_set():
+                return True
+        self.t = target
+        self.check_end()
+        return False
+
+    def check_end(self):
+        if self.end is not None and self.t >= self.end:
+            print("Simulation reached " + str(self.now()))
+            raise SimulationFinished(0)
+
+    def sleep(self, seconds):
+        if seconds < 0:
+            raise ValueError("sleep length must be non-negative")
+        self.advance(seconds)
+
+    def wait(self, event, seconds):
+        if event.is_set():
+            return True
+        return self.advance(seconds, event)
+
+    def localtime(self, secs=None):
+        return time.localtime(self.t if secs is None else secs)
+
+    def now(self):
+        return datetime.datetime.fromtimestamp(self.t)
+
+
+'''
+Wake Event Class:
+Functionality:
+1) Lets the control loop sleep until a deadline or a manual button press, whichever comes first
+2) Button presses come from GPIO edge detection (interrupt driven), no polling while asleep
+3) Waits on the hardware clock, so a simulated run jumps straight to the deadline
+'''
+
+class WakeEvent(object):
+
+    def __init__(self, gpio, clock):
+        self.gpio = gpio
+        self.clock = clock
+        self.event = threading.Event()
+        self.pressed = False
+        # without edge detection this pin is read every poll_seconds while waiting
+        self.poll_pin = None
+        self.poll_seconds = 1.0
+
+    # wake on rising edges of an input pin, False if edge detection is not available and the pin is polled instead
+    def watch_button(self, pin, bouncetime=200, poll_seconds=1.0):
+        try:
+            self.gpio.add_event_detect(pin, self.gpio.RISING, callback=self.press, bouncetime=bouncetime)
+            return True
+        except (RuntimeError, AttributeError):
+            self.poll_pin = pin
+            self.poll_seconds = poll_seconds
+            return False
+
+    def press(self, pin=None):
+        self.pressed = True
+        self.event.set()
+
+    # True once per button press
+    def take_press(self):
+        pressed = self.pressed
+        self.pressed = False
+        self.event.clear()
+        return pressed
+
+    # sleep up to seconds, True if a button press cut it short
+    def wait(self, seconds):
+        if self.poll_pin is not None:
+            return self.poll(seconds)
+        if seconds > 0:
+            woken = self.clock.wait(self.event, seconds)
+        else:
+            woken = self.event.is_set()
+        self.event.clear()
+        return woken
+
+    # wait in poll_seconds steps, reading the button pin after each one
+    def poll(self, seconds):
+        end = self.clock.time() + seconds
+        while True:
+            if self.gpio.input(self.poll_pin):
+                self.press()
+            remaining = end - self.clock.time()
+            if self.event.is_set() or remaining <= 0:
+                break
+            self.clock.wait(self.event, min(self.poll_seconds, remaining))
+        woken = self.event.is_set()
+        self.event.clear()
+        return woken
+
+
+'''
+Synthetic Weather Class:
+Functionality:
+1) Clear sky days: irradiance follows the sun between sunrise and sunset
+2) Temperature rises and humidity falls with the sun
+3) Panels lose Isc to soiling every day, an EDS activation cleans the panel
+'''
+
+class SyntheticWeather(object):
+
+    def __init__(self, peak_gpoa=1000.0, sunrise=6.0, sunset=18.0, soiling_per_day=0.02):
+        self.peak_gpoa = peak_gpoa
+        self.sunrise = sunrise
+        self.sunset = sunset
+        self.soiling_per_day = soiling_per_day
+        self.origin = None
+
+    def at(self, t):
+        # {'gpoa', 'temp', 'humid'} at time t
+        lt = datetime.datetime.fromtimestamp(t)
+        hour = lt.hour + lt.minute / 60.0 + lt.second / 3600.0
+        sun = 0.0
+        if self.sunrise < hour < self.sunset:
+            sun = math.sin(math.pi * (hour - self.sunrise) / (self.sunset - self.sunrise))
+        return {'gpoa': round(self.peak_gpoa * sun, 1), 'temp': round(18.0 + 10.0 * sun, 1), 'humid': round(70.0 - 30.0 * sun, 1)}
+
+    def panel(self, name, t, cleaned_at):
+        # (Voc, Isc) of a panel at time t, cleaned_at is the last EDS activation of the panel
+        if self.origin is None:
+            self.origin = t
+        gpoa = self.at(t)['gpoa']
+        if gpoa <= 1:
+            return (0.0, 0.0)
+        dirty_since = self.origin if cleaned_at is None else cleaned_at
+        soiling = min(0.5, self.soiling_per_day * (t - dirty_since) / 86400.0)
+        voc = PANEL_VOC * (1 + 0.05 * math.log(gpoa / 1000.0))
+        isc = PANEL_ISC * gpoa / 1000.0 * (1 - soiling)
+        return (voc, isc)
+
+
+'''
+Replay Trace Class:
+Functionality:
+1) Loads an eds_data.csv recorded by a field unit
+2) Serves the recorded irradiance, temperature and humidity at any time (last row at or before it)
+3) Serves each panel's recorded Voc/Isc, after-activation values while the panel was recently activated
+'''
+
+class ReplayTrace(object):
+
+    def __init__(self, path, after_window=3600):
+        self.path = path
+        # recorded post activation values are used this many seconds after an activation
+        self.after_window = after_window
+        self.times = []
+        self.weather = []
+        self.panels = {}
+        rows = []
+        with open(path, 'r') as f:
+            reader = csv.reader(f)
+            next(reader, None)
+            for row in reader:
+                if len(row) < 10:
+                    continue
+                try:
+                    t = time.mktime(time.strptime(row[0] + ' ' + row[1], '%m/%d/%Y %H:%M:%S'))
+                except ValueError:
+                    continue
+                rows.append((t, row))
+        rows.sort(key=lambda r: r[0])
+        for (t, row) in rows:
+            self.times.append(t)
+            gpoa = number(row[4])
+            # the data files hold the panel temperature, undo PowerMaster.get_panel_temp to get the ambient back
+            temp = number(row[2])
+            if temp is not None and gpoa is not None and gpoa > 0:
+                temp = round(temp - (PANEL_NOCT - 20) * gpoa / 800, 2)
+            self.weather.append({'gpoa': gpoa, 'temp': temp, 'humid': number(row[3])})
+            panel = self.panels.setdefault(row[5], ([], []))
+            panel[0].append(t)
+            panel[1].append(((number(row[6]), number(row[8])), (number(row[7]), number(row[9]))))
+        if not self.times:
+            raise ValueError("no data rows in " + path)
+
+    def start_time(self):
+        return self.times[0]
+
+    def end_time(self):
+        return self.times[-1]
+
+    @staticmethod
+    def index(times, t):
+        return max(0, bisect.bisect_right(times, t) - 1)
+
+    def at(self, t):
+        return self.weather[self.index(self.times, t)]
+
+    def panel(self, name, t, cleaned_at):
+        if name not in self.panels:
+            return (0.0, 0.0)
+        times, values = self.panels[name]
+        [before, after] = values[self.index(times, t)]
+        recently_cleaned = cleaned_at is not None and t - cleaned_at <= self.after_window
+        if recently_cleaned and after[0] is not None and after[1] is not None:
+            return after
+        return tuple(0.0 if v is None else v for v in before)
+
+
+'''
+Panel Bench Class:
+Functionality:
+1) Follows the relay GPIOs: which PV relay is switched in, Voc or Isc selected, EDS films activated
+2) Gives the simulated MCP3008 the voltage the divider/shunt of the selected panel would produce
+'''
+
+class PanelBench(object):
+
+    def __init__(self, gpio, clock, environment, config):
+        import TestingManager as TM
+        self.clock = clock
+        self.environment = environment
+        self.gpio = gpio
+        self.adc_pin = int(config['ADC'])
+        self.pv_channel = TM.PV_CHANNEL
+        # PV relay pin -> (panel name, Isc scale), EDS activation pin -> panel name
+        self.pv_pins = {}
+        self.eds_pins = {}
+        for eds_num in range(1, len(config['EDSIDS']) + 1):
+            self.pv_pins[int(config['EDS' + str(eds_num) + 'PV'])] = ('EDS-PV' + str(eds_num), 1)
+            self.eds_pins[int(config['EDS' + str(eds_num)])] = 'EDS-PV' + str(eds_num)
+        for ctrl_num in range(1, len(config['CTRLIDS']) + 1):
+            self.pv_pins[int(config['CTRL' + str(ctrl_num) + 'PV'])] = ('CTRL-PV' + str(ctrl_num), 100)
+        # inverse of ADCMaster.ocv_from_raw / scc_from_raw
+        self.voc_gain = (TM.R2 + TM.R1) / TM.R1 * TM.VOC_CORRECTION
+        self.isc_gain = TM.ISC_CORRECTION
+        self.cleaned_at = {}
+        self.activations = 0
+        gpio.listeners.append(self.on_output)
+
+    def on_output(self, pin, level):
+        if pin in self.eds_pins and level:
+            self.cleaned_at[self.eds_pins[pin]] = self.clock.time()
+            self.activations += 1
+
+    def voltage(self, pin):
+        if pin != self.pv_channel:
+            return 0.0
+        selected = [self.pv_pins[p] for p in self.pv_pins if self.gpio.is_output(p)]
+        if len(selected) != 1:
+            # nothing (or a short between panels) on the measurement line
+            return 0.0
+        [name, scale] = selected[0]
+        [voc, isc] = self.environment.panel(name, self.clock.time(), self.cleaned_at.get(name))
+        if self.gpio.is_output(self.adc_pin):
+            return isc / scale / self.isc_gain
+        return voc / self.voc_gain
+
+
+'''
+Hardware Master Class:
+Functionality:
+1) Picks the RasPi hardware or the simulated backends from the EDS_HARDWARE environment variable
+2) Simulated runs use a simulated clock driven by synthetic weather or a recorded trace (replay)
+3) Builds the ADC session, temperature/humidity sensor and pyranometer for the control loop
+'''
+
+class HardwareMaster(object):
+
+    def __init__(self, mode=None, trace=None, sim_dir=None, start=None, hours=None):
+        self.mode = hardware_mode() if mode is None else mode
+        self.environment = None
+        self.fake_sp420 = None
+        self.bench = None
+        if self.mode == 'pi':
+            self.clock = SystemClock()
+            self.sim_dir = None
+            return
+        if self.mode == 'replay':
+            self.environment = ReplayTrace(os.environ[TRACE_ENV] if trace is None else trace)
+        else:
+            self.environment = SyntheticWeather()
+        # files the field unit keeps on the USB drive and the Desktop go here
+        self.sim_dir = os.environ.get(SIM_DIR_ENV) if sim_dir is None else sim_dir
+        if not self.sim_dir:
+            self.sim_dir = tempfile.mkdtemp(prefix='eds_sim_')
+        os.makedirs(self.path('usb'), exist_ok=True)
+        start = os.environ.get(SIM_START_ENV) if start is None else start
+        hours = os.environ.get(SIM_HOURS_ENV) if hours is None else hours
+        if start:
+            start_t = time.mktime(time.strptime(start, '%Y-%m-%d %H:%M'))
+        elif self.mode == 'replay':
+            start_t = self.environment.start_time()
+        else:
+            # 8AM today, an hour before the unit starts measuring
+            today = datetime.date.today()
+            start_t = time.mktime(datetime.datetime(today.year, today.month, today.day, 8).timetuple())
+        if hours:
+            end_t = start_t + float(hours) * 3600
+        elif self.mode == 'replay':
+            end_t = self.environment.end_time()
+        else:
+            end_t = start_t + 24 * 3600
+        self.clock = SimulatedClock(start_t, end_t)
+
+    def is_simulated(self):
+        return self.mode != 'pi'
+
+    # press and release the manual button at the EDS_SIM_PRESS times of a simulated run
+    def simulate_button(self, pin):
+        if not self.is_simulated():
+            return
+        for press in os.environ.get(SIM_PRESS_ENV, '').split(','):
+            if press.strip():
+                t = time.mktime(time.strptime(press.strip(), '%Y-%m-%d %H:%M'))
+                self.clock.call_at(t, lambda: GPIO.press(pin))
+                self.clock.call_at(t + 0.5, lambda: GPIO.release(pin))
+
+    def path(self, name):
+        return os.path.join(self.sim_dir, name)
+
+    def make_adc_session(self, config):
+        if not self.is_simulated():
+            return MCP3008.ADCSession()
+        self.bench = PanelBench(GPIO, self.clock, self.environment, config)
+        return MCP3008.ADCSession(MCP3008.SimulatedSPI(self.bench.voltage, read_delay=SIM_ADC_READ_DELAY, sleep=self.clock.sleep))
+
+    def make_weather_sensor(self):
+        if not self.is_simulated():
+            return AM2315.AM2315()
+        device = AM2315.FakeI2CDevice(source=self.weather_reading)
+        return AM2315.AM2315(i2c=AM2315.FakeI2C(device), clock=self.clock.monotonic, sleep=self.clock.sleep)
+
+    def make_irradiance(self):
+        if not self.is_simulated():
+            return SP420.Irradiance()
+        # real serial I/O against a pseudo-terminal sensor
+        self.fake_sp420 = SP420.FakeSP420(source=self.sp420_voltage)
+        return SP420.Irradiance([self.fake_sp420.port], clock=self.clock.monotonic, sleep=self.clock.sleep)
+
+    def weather_reading(self):
+        weather = self.environment.at(self.clock.time())
+        return (weather['humid'], weather['temp'])
+
+    def sp420_voltage(self):
+        # inverse of Irradiance.get_irradiance with the fake sensor's calibration
+        gpoa = self.environment.at(self.clock.time())['gpoa']
+        if gpoa is None or gpoa < 0:
+            return 0.0
+        return (gpoa / self.fake_sp420.multiplier + self.fake_sp420.offset) / 1000.0
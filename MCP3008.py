@@ -0,0 +1,196 @@
+'''
+=============================
+Title: ADC Session Module - EDS Field Control
+=============================
+'''
+
+import time
+import random
+import numpy as np
+
+# MCP3008 reference voltage, the chip is powered from the RasPi 3.3V rail
+REF_VOLTAGE = 3.3
+# the adafruit driver reports the 10 bit reading scaled up to 16 bits
+MAX_VALUE = 65535
+
+'''
+Simulated SPI Class:
+Functionality:
+1) Stands in for the SPI bus, chip select and MCP3008 on a plain Linux box
+2) Charges a configurable cost for opening the bus and for every read
+3) Returns 16 bit readings from a source function so sessions can be benchmarked
+'''
+
+class SimulatedSPI:
+
+    def __init__(self, source=None, open_delay=0.0, read_delay=0.0, noise=0.0, sleep=time.sleep):
+        # source(pin) returns the voltage seen on the ADC pin, defaults to a quiet 1V
+        self.source = source
+        self.open_delay = open_delay
+        self.read_delay = read_delay
+        self.noise = noise
+        self.sleep = sleep
+        # bookkeeping so bus lifetime can be checked after a run
+        self.opens = 0
+        self.closes = 0
+        self.reads = 0
+        self.is_open = False
+
+    def open(self):
+        # emulates busio.SPI + DigitalInOut + MCP3008 construction
+        self.sleep(self.open_delay)
+        self.opens += 1
+        self.is_open = True
+
+    def close(self):
+        self.closes += 1
+        self.is_open = False
+
+    def channel(self, pin):
+        return SimulatedChannel(self, pin)
+
+    def read_value(self, pin):
+        if not self.is_open:
+            raise OSError("SPI bus is closed")
+        self.sleep(self.read_delay)
+        self.reads += 1
+        volts = 1.0 if self.source is None else self.source(pin)
+        if self.noise:
+            volts += random.gauss(0, self.noise)
+        # quantize to the 10 bit resolution of the chip, then scale like the driver does
+        code = min(max(int(round(volts / REF_VOLTAGE * 1023)), 0), 1023)
+        return code << 6
+
+
+class SimulatedChannel:
+    # same value/voltage properties as adafruit_mcp3xxx.analog_in.AnalogIn
+
+    def __init__(self, backend, pin):
+        self.backend = backend
+        self.pin = pin
+
+    @property
+    def value(self):
+        return self.backend.read_value(self.pin)
+
+    @property
+    def voltage(self):
+        return self.value * REF_VOLTAGE / MAX_VALUE
+
+
+'''
+MCP3008 Hardware Class:
+Functionality:
+1) Opens the SPI bus and chip select (GPIO 18) for the MCP3008
+2) Creates AnalogIn channels on the opened chip
+3) Releases the bus and chip select handles when closed
+'''
+
+class MCP3008Hardware:
+
+    def __init__(self):
+        self.spi = None
+        self.cs = None
+        self.mcp = None
+
+    def open(self):
+        # imported here so the session can be used off the RasPi with the simulated backend
+        import busio
+        import digitalio
+        import board
+        import adafruit_mcp3xxx.mcp3008 as MCP
+        self.spi = busio.SPI(clock=board.SCK, MISO=board.MISO, MOSI=board.MOSI)
+        self.cs = digitalio.DigitalInOut(board.D18)
+        self.mcp = MCP.MCP3008(self.spi, self.cs)
+
+    def close(self):
+        # release the handles, ignore errors from a bus that already faulted
+        for handle in (self.cs, self.spi):
+            try:
+                if handle is not None:
+                    handle.deinit()
+            except Exception:
+                pass
+        self.spi = None
+        self.cs = None
+        self.mcp = None
+
+    def channel(self, pin):
+        from adafruit_mcp3xxx.analog_in import AnalogIn
+        return AnalogIn(self.mcp, pin)
+
+
+'''
+ADC Session Class:
+Functionality:
+1) Opens the ADC bus once and keeps it for every reading
+2) Hands out cached per-channel readers
+3) Closes and re-opens the bus when a read faults
+'''
+
+class ADCSession:
+
+    def __init__(self, backend=None):
+        # default to the real chip, the simulated backend is passed in for benchmarks
+        if backend is None:
+            backend = MCP3008Hardware()
+        self.backend = backend
+        self.channels = {}
+        self.is_open = False
+        self.opens = 0
+
+    def __enter__(self):
+        self.open()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def open(self):
+        if not self.is_open:
+            self.backend.open()
+            self.is_open = True
+            self.opens += 1
+
+    def close(self):
+        if self.is_open:
+            self.backend.close()
+        self.channels = {}
+        self.is_open = False
+
+    def reopen(self):
+        # used after a fault, drops cached channels so they bind to the new bus
+        self.close()
+        self.open()
+
+    def channel(self, pin):
+        # per-channel reader, created once per bus lifetime
+        self.open()
+        if pin not in self.channels:
+            self.channels[pin] = self.backend.channel(pin)
+        return self.channels[pin]
+
+    def read_voltage(self, pin):
+        # read the pin, re-open the bus once if the read faults
+        try:
+            return self.channel(pin).voltage
+        except (OSError, RuntimeError, ValueError) as e:
+            print("ADC read failed (" + str(e) + "), re-opening SPI bus")
+            self.reopen()
+            return self.channel(pin).voltage
+
+    def read_burst(self, pin, samples):
+        # back to back readings of one pin as fast as the bus allows, returned in volts
+        raw = np.empty(samples, dtype=np.float64)
+        try:
+            chan = self.channel(pin)
+            for i in range(samples):
+                raw[i] = chan.value
+        except (OSError, RuntimeError, ValueError) as e:
+            print("ADC burst failed (" + str(e) + "), re-opening SPI bus")
+            self.reopen()
+            chan = self.channel(pin)
+            for i in range(samples):
+                raw[i] = chan.value
+        # scale the 16 bit values in one pass instead of per reading
+        return raw * (REF_VOLTAGE / MAX_VALUE)
@@ -8,15 +8,13 @@ Version 2 (Json Act)
 '''
 
 # dependencies
-import RPi.GPIO as GPIO
 import logging
 import subprocess
 import json
 import datetime
 import time
-import busio
-from board import *
-import adafruit_pcf8523
+import HardwareManager as HM
+from HardwareManager import GPIO
 import AM2315
 import SP420
 import StaticManager as SM
@@ -31,13 +29,25 @@ logging.basicConfig(format='%(asctime)s %(message)s', filename = 'Error.log', le
 logging.info('Code started')
 # read config, get constants, etc
 static_master = SM.StaticMaster()
-test_master = TM.TestingMaster(static_master.get_config())
-usb_master = DM.USBMaster()
+# RasPi hardware, or simulated/replayed sensors and clock when EDS_HARDWARE is set
+hardware = HM.HardwareMaster()
+test_master = TM.TestingMaster(static_master.get_config(),
+                               TM.ADCMaster(hardware.make_adc_session(static_master.get_config()), hardware.clock),
+                               hardware.clock)
+if hardware.is_simulated():
+    # USB drive and Desktop files live in the simulation directory
+    SM.EDS_JSON_PATH = hardware.path('eds.json')
+    SM.JOURNAL_DIR = hardware.path('journal')
+    SM.SOLAR_NOON_DIR = hardware.path('solar_noon')
+    SM.SCHEDULE_LOG_PATH = hardware.path('eds_schedule.csv')
+    usb_master = DM.LocalUSBMaster(hardware.path('usb'))
+else:
+    usb_master = DM.USBMaster()
 
 #loop until a usb drive is inputted
 while usb_master.check_usb() == False:
     print("USB not found! plug in a USB to continue")
-    time.sleep(1)
+    hardware.clock.sleep(1)
 print("USB found continuing to set up... \n")
 #set up usb
 while usb_master.set_USB_name() == False:
@@ -46,26 +56,71 @@ usb_master.check_new_USB()
 print(usb_master.get_USB_path())
 
 # setup sensors
-weather = AM2315.AM2315()
-i2c_bus = busio.I2C(SCL, SDA)
-
-# set up network or rtc time in a tuple format
+# temperature/humidity readings are cached for weatherTTLSeconds and refreshed in the background
+# simulated runs refresh inline so they stay deterministic
+weather = AM2315.CachedAM2315(hardware.make_weather_sensor(), test_master.get_param('weatherTTLSeconds'),
+                              not hardware.is_simulated(), hardware.clock.time)
+# one pyranometer connection for the whole run, calibration is cached and it reconnects by itself
+irr_master = hardware.make_irradiance()
+# background sampler keeps a time indexed irradiance history for tagging measurements
+# it only runs with a connected pyranometer, otherwise measurements read it directly (reconnecting at most once a minute)
+irr_sampler = SP420.IrradianceSampler(irr_master, test_master.get_param('irradianceSampleHz'),
+                                      test_master.get_param('irradianceBufferSeconds'), hardware.clock.time)
+if not hardware.is_simulated() and irr_master.is_connected():
+    irr_sampler.start()
+
+
+# the background sensor threads only run during the day, at night they are stopped to save power
+def stop_sampling():
+    weather.stop()
+    irr_sampler.stop()
+
+
+# restart them in the morning, trying the pyranometer again if it was missing
+def start_sampling():
+    if hardware.is_simulated():
+        return
+    weather.start()
+    if irr_master.is_connected() or irr_master.connect_to_device():
+        irr_sampler.start()
+
+# set up network or rtc time in a tuple format, with the real week day and day of year
 def current_time():
-    current_date = datetime.datetime.now()
+    current_date = hardware.clock.now()
     current_clock = time.struct_time((current_date.year, current_date.month,current_date.day, 
                                      current_date.hour, current_date.minute,
-                                     current_date.second, 0, -1, -1))
+                                     current_date.second, current_date.weekday(),
+                                     current_date.timetuple().tm_yday, -1))
     return current_clock
 
+# activation state of every EDS, read from eds.json once and only written when it changes
+activation_store = SM.ActivationStore(SM.EDS_JSON_PATH)
+activation_store.load(current_time())
+
 # creating initial csv and txt files to usb
 print("Setting up initial CSV and TXT files in USB if not exist yet")
 usb_master.setup_usb_mount()
-csv_master = DM.CSVMaster(usb_master.get_USB_path())
-log_master = DM.LogMaster(usb_master.get_USB_path(), current_time())
+csv_master = DM.CSVMaster(usb_master.get_USB_path(), test_master.get_config()['csvUncertainty'],
+                          test_master.get_config()['csvQueueRows'], test_master.get_config()['recordLog'],
+                          test_master.get_config()['csvLegacyFiles'], test_master.get_config()['csvIndex'],
+                          test_master.get_config()['csvDecimals'], test_master.get_config()['csvChecksum'])
+# log lines are held in memory and written while the USB is mounted, when full or every logFlushSeconds
+log_master = DM.LogMaster(usb_master.get_USB_path(), current_time(), test_master.get_config()['logLevel'],
+                          test_master.get_config()['logBufferLines'], test_master.get_param('logFlushSeconds'),
+                          test_master.get_config()['logMaxBytes'], test_master.get_config()['logKeepSegments'],
+                          test_master.get_config()['logJsonLines'], hardware.clock.time)
+# measurements go to the SD card journal first, copy anything left from the last run while the USB is mounted
+journal = DM.JournalMaster(SM.JOURNAL_DIR)
+if journal.drain(csv_master) > 0:
+    print("Copied measurements left in the journal to the USB")
+last_drain = hardware.clock.time()
+log_master.flush()
 usb_master.reset_usb_mounts()
+log_master.set_writable(False)
 
 # initialize measurement classes
-adc_master = TM.ADCMaster()
+# the testing master owns the ADC session, keep a handle to close it on faults
+adc_master = test_master.adc_m
 pow_master = TM.PowerMaster()
 pr_master = TM.PerformanceRatio()
 soil_master = TM.Soiling()
@@ -80,6 +135,13 @@ panel_data = static_master.get_panel_data()
 gmt_offset = test_master.get_param('offsetGMT')
 longitude = test_master.get_param('degLongitude')
 latitude = 1  # latitude currently unused
+# the day's activations and the noon sweep as a sorted timeline of deadlines, the loop sleeps between them
+scheduler = SM.EventScheduler(panel_data, eds_ids, longitude, gmt_offset, test_master.get_config()['solarNoonMethod'],
+                              test_master.get_param('scheduleGraceMinutes'),
+                              lambda phrase, level: print_l(current_time(), phrase, level))
+# longest sleep between loop passes, the green LED flips at every pass
+heartbeat = test_master.get_param('heartbeatSeconds')
+night_heartbeat = test_master.get_param('nightHeartbeatSeconds')
 
 # RasPi board setup
 GPIO.setmode(GPIO.BCM)
@@ -92,8 +154,11 @@ GPIO.output(test_master.get_pin('outPinLEDGreen'), 0)
 
 # manual button port setup
 GPIO.setup(test_master.get_pin('inPinManualActivate'), GPIO.IN, pull_up_down=GPIO.PUD_DOWN)
-# old button setup
-# GPIO.add_event_detect(test_master.get_pin('inPinManualActivate'), GPIO.RISING)
+# the button edge wakes the loop while it sleeps until the next scheduled event
+waker = HM.WakeEvent(GPIO, hardware.clock)
+if not waker.watch_button(test_master.get_pin('inPinManualActivate'), poll_seconds=test_master.get_param('buttonPollSeconds')):
+    print("Button edge detection unavailable, the button is read every buttonPollSeconds")
+hardware.simulate_button(test_master.get_pin('inPinManualActivate'))
 
 # adc chip port setup
 GPIO.setup(test_master.get_pin('ADC'), GPIO.OUT)
@@ -114,7 +179,13 @@ weather_pass = False
 auto_pass = False
 schedule_pass = False
 frequency_pass = False
-json_reset = False
+# reset the activation flags once when the night starts, also when the code starts at night
+night_reset_pending = True
+# manual button pressed while an activation was running
+manual_request = False
+# RTC reading before the last sleep and how long the loop slept
+rtc_before = None
+slept = 0
 
 # error handling initialization
 error_list = []
@@ -128,10 +199,10 @@ def print_time(dt):
 
 
 # function to print formatted log into the log file
-def print_l(dt, phrase):
+def print_l(dt, phrase, level='INFO'):
     print_time(dt)
     print(" " + phrase)
-    log_master.write_log(dt, phrase)
+    log_master.write_log(dt, phrase, level)
 
 
 # function to add error to errot list
@@ -140,12 +211,123 @@ def add_error(error):
     if error not in error_list:
         error_list.append(error)
     try:
-        print_l(current_time(), "ERROR FOUND: " + error)
+        print_l(current_time(), "ERROR FOUND: " + error, 'ERROR')
     except Exception as e:
         # current_time() = time.struct_time((1,1,1,1,1,1,1,1,1))
         logging.exception( "Bad error %s",e)
-        print_l(current_time(), "ERROR FOUND: " + error)
-
+        print_l(current_time(), "ERROR FOUND: " + error, 'ERROR')
+
+
+# keep the loop alive while an EDS film is energized: blink the green LED, latch manual button presses
+# and report the irradiance over the activation window, returns once the activation duration has passed
+def service_activation(job, irr_master):
+    global manual_request
+    blink = True
+    window_start = hardware.clock.time()
+    gpoa = []
+    while not job.is_done():
+        GPIO.output(test_master.get_pin('outPinLEDGreen'), 1 if blink else 0)
+        blink = not blink
+        # without the background sampler take the readings here, about a second each
+        if not irr_sampler.is_running() and job.remaining() > 1:
+            g_poa = irr_master.get_irradiance()
+            if g_poa >= 0:
+                gpoa.append(g_poa)
+        if waker.take_press() or GPIO.input(test_master.get_pin('inPinManualActivate')):
+            if not manual_request:
+                print_l(current_time(), "Manual button pressed during EDS activation, will run after it")
+            manual_request = True
+        hardware.clock.sleep(min(0.5, job.remaining()))
+    GPIO.output(test_master.get_pin('outPinLEDGreen'), 1)
+    if irr_sampler.is_running():
+        mean_gpoa = irr_sampler.mean_between(window_start, hardware.clock.time())
+    elif gpoa:
+        mean_gpoa = round(sum(gpoa) / len(gpoa), 3)
+    else:
+        mean_gpoa = None
+    if mean_gpoa is not None:
+        print_l(current_time(), "Mean GPOA during EDS activation: " + str(mean_gpoa))
+    return mean_gpoa
+
+
+# mount the USB for writing, a swapped in USB is registered on the fly and the data and log files follow it
+def mount_usb():
+    if not usb_master.setup_usb_mount():
+        return False
+    if usb_master.get_USB_path() != csv_master.get_path():
+        csv_master.set_path(usb_master.get_USB_path())
+        log_master.set_path(usb_master.get_USB_path(), current_time())
+        print_l(current_time(), "New USB found, writing data to " + usb_master.get_USB_path())
+    log_master.set_writable(True)
+    return True
+
+
+# write the held log lines and un-mount the USB, the log is held in memory until the next mount_usb()
+def unmount_usb():
+    log_master.flush()
+    usb_master.reset_usb_mounts()
+    log_master.set_writable(False)
+
+
+# commit a batch of panel records to the SD card journal, written to the USB by drain_journal()
+def save_batch(batch):
+    if journal.append_records(batch):
+        print_l(current_time(), "Saved " + str(len(batch)) + " measurements to the journal")
+        return
+    add_error("SD-Journal")
+    # journal unusable, write straight to the USB
+    if usb_master.check_usb() and mount_usb():
+        if not csv_master.write_batch(batch):
+            add_error("USB-Write")
+            print_l(current_time(), "Measurements could not be written to the journal or the USB", 'ERROR')
+        unmount_usb()
+
+
+# commit a manual test row to the SD card journal
+def save_manual(row):
+    if journal.append_manual(row):
+        print_l(current_time(), "Saved Manual Testing Mode Measurements to the journal")
+        return
+    add_error("SD-Journal")
+    if usb_master.check_usb() and mount_usb():
+        csv_master.write_manual_rows([row])
+        unmount_usb()
+
+
+# copy journaled measurements to the USB in one mounted session, at most every journalDrainSeconds unless forced
+def drain_journal(force=False):
+    global last_drain
+    if journal.pending_count() == 0:
+        return
+    if not force and hardware.clock.time() - last_drain < test_master.get_param('journalDrainSeconds'):
+        return
+    last_drain = hardware.clock.time()
+    if not usb_master.check_usb():
+        print_l(current_time(), "No USB Detected! " + str(journal.pending_count()) + " measurements kept in the journal")
+        return
+    if not mount_usb():
+        print_l(current_time(), "USB could not be mounted! " + str(journal.pending_count()) + " measurements kept in the journal")
+        return
+    # red LED on means USB should not be unplugged
+    GPIO.output(test_master.get_pin('outPinLEDRed'), 1)
+    drained = journal.drain(csv_master)
+    # un-mount the usb drive
+    unmount_usb()
+    # turn of RED LED, indicating USB can be swapped
+    GPIO.output(test_master.get_pin('outPinLEDRed'), 0)
+    if drained < 0:
+        add_error("USB-Write")
+        return
+    if "USB-Write" in error_list:
+        error_list.remove("USB-Write")
+    print_l(current_time(), "Writing " + str(drained) + " Journaled Results To CSV and TXT Files")
+    # time to swap USB if desired
+    hardware.clock.sleep(10)
+
+
+# sweep engine, measures a list of panels back to back and returns one batch of records
+sweep_master = TM.SweepMaster(test_master, pow_master, pr_master, soil_master, current_time,
+                              lambda phrase: print_l(current_time(), phrase), irr_sampler)
 
 print("Starting FTU code Written by Aditya Brian and Ben...")
 print_time(current_time())
@@ -186,32 +368,27 @@ while True:
         Checking if RTC is working (initial check)
         --------------------------------------------------------------------------
         '''
-        #get time in sec
-        sec_old = current_time().tm_sec
-        time.sleep(2)
-        # get time in sec after 2 seconds
-        sec_new = current_time().tm_sec
-        # if the two times match there is an error
-        if sec_old == sec_new :
-            add_error("Sensor-RTC-1")
-        else:
-            # remove error if corrected and proceed to next code
-            if "Sensor-RTC-1" in error_list:
-                error_list.remove("Sensor-RTC-1")
+        # the RTC must have moved on while the loop slept, only checked after an undisturbed sleep of 2 s or more
+        if slept >= 2:
+            # if the two times match there is an error
+            if current_time()[0:6] == rtc_before[0:6]:
+                add_error("Sensor-RTC-1")
+            else:
+                # remove error if corrected and proceed to next code
+                if "Sensor-RTC-1" in error_list:
+                    error_list.remove("Sensor-RTC-1")
 
         '''
         --------------------------------------------------------------------------
         Green LED Blinks if loop working, Red LED Off
         --------------------------------------------------------------------------
         '''
-        # flip indicator GREEN LED to show proper working
+        # flip indicator GREEN LED to show proper working, once per wake up
         if flip_on:
             GPIO.output(test_master.get_pin('outPinLEDGreen'), 1)
-            time.sleep(1)
             flip_on = False
         else:
             GPIO.output(test_master.get_pin('outPinLEDGreen'), 0)
-            time.sleep(1)
             flip_on = True
 
         # code for power savings
@@ -224,374 +401,128 @@ while True:
         #Get time from RTC or time sync from internet 
         current_dt = current_time()
 
-        #Make this a while loop to reduce power consumtion
+        # at night the loop sleeps for nightHeartbeatSeconds at a time to reduce power consumtion
         if current_dt.tm_hour > 16 or current_dt.tm_hour < 9:
             day = False
-            json_reset = True
         else:
             day = True
-            json_reset = False
-
-        if (current_dt.tm_hour == 12) and (current_dt.tm_min >= 0 and current_dt.tm_min < 2):
-            noon = True
-        else:
-            noon = False
+            if not night_reset_pending:
+                # first pass of the day after a night
+                start_sampling()
+                print_l(current_time(), "Day mode, sensor sampling started", 'DEBUG')
+            night_reset_pending = True
 
         '''
         --------------------------------------------------------------------------
-        Field Test Unit Schedule for Measurement only
+        Field Test Unit Schedule, run queue of the noon measurement sweep and the EDS activations
+        Jobs run in priority order (earliest planned start first), a job held up by a slow sweep
+        still runs within scheduleGraceMinutes of its scheduled time
         --------------------------------------------------------------------------
         '''
-        if noon: 
-            print_l(current_time(), "Measurement only process starting...")
-            # initialize weather and gpoa reading functions
-            w_read = weather.read_humidity_temperature()
-            # initialize panel data for measuerement
-            data = panel_data
-            # Control Measurements
-            for ctrl in ctrl_ids:
-
-                if usb_master.check_usb() == True:
-                    # mounts the usb
-                    usb_master.setup_usb_mount()
-                else:
-                    # if not, then reboot
-                    print_l(current_time(), "No USB Detected!")
-                    usb_master.reset()
-
-                # turn green and red LED on to show automatic testing is operating
-                # red LED on means USB should not be unplugged
-                GPIO.output(test_master.get_pin('outPinLEDRed'), 1)
+        for event in scheduler.due(current_dt):
+            # a job that waited behind the others until its grace window was over is missed
+            if scheduler.expired(event, current_time()):
+                scheduler.finish(event, current_time(), 'missed')
+                continue
+            '''
+            --------------------------------------------------------------------------
+            Field Test Unit Schedule for Measurement only
+            --------------------------------------------------------------------------
+            '''
+            if event['kind'] == 'noon':
+                started = current_time()
+                print_l(started, "Measurement only process starting...")
+                # turn green LED on to show automatic testing is operating
                 GPIO.output(test_master.get_pin('outPinLEDGreen'), 1)
 
-                # start the measurement process
-                print_l(current_time(), "Time checked. Measurement procedure for " + ctrl + " panel")
-                # check the eds_number
-                panel_num = data[ctrl]['num']
-                # get the date and time
-                data[ctrl]['date_time'] = current_time()
-                # measure global irradiance data from pyranometer
-                irr_master = SP420.Irradiance()
-                g_poa = irr_master.get_irradiance()
-                data[ctrl]['gpoa'] = g_poa
-                print_l(current_time(), "GPOA Irradiance for " + ctrl + ": " + str(g_poa))
-                # get the panel temperature using ambient temperature
-                amb_temp = w_read[1]
-                pan_temp = pow_master.get_panel_temp(amb_temp, g_poa)
-                data[ctrl]['temp'] = pan_temp
-                # get humidity data
-                data[ctrl]['humid'] = w_read[0]
-                '''PRE EDS ACTIVATION MEASUREMENT'''
-                # measure PRE EDS activation ocv and scc
-                ocv_pre = 0
-                scc_pre = 0
-                [ocv_pre, scc_pre] = test_master.run_measure_CTRL(panel_num)
-                print_l(current_time(), "PRE EDS OCV for " + ctrl + ": " + str(ocv_pre))
-                print_l(current_time(), "PRE EDS SCC for " + ctrl + ": " + str(scc_pre))
-                data[ctrl]['ocv_pre'] = ocv_pre
-                data[ctrl]['scc_pre'] = scc_pre
-                # compute the PRE EDS activation power measurements for each panel
-                power_pre = pow_master.get_power_out(ocv_pre, scc_pre, pan_temp)
-                print_l(current_time(), "PRE EDS Power for " + ctrl + ": " + str(power_pre))
-                data[ctrl]['pwr_pre'] = power_pre
-                # compute the PRE EDS activation PR measurements for each panel
-                pr_pre = pr_master.get_pr(ocv_pre, scc_pre, pan_temp, power_pre, g_poa)
-                print_l(current_time(), "PRE EDS PR for " + ctrl + ": " + str(pr_pre))
-                data[ctrl]['pr_pre'] = pr_pre
-                # compute the PRE EDS activation SI measurements for each panel
-                si_pre = soil_master.get_si(scc_pre, g_poa)
-                print_l(current_time(), "PRE EDS SI for " + ctrl + ": " + str(si_pre))
-                data[ctrl]['si_pre'] = si_pre
-
-                # NO EDS ACTIVATION AND POST MEASUREMENTS FOR CTRL PANELS
-                print_l(current_time(), "Not Activating EDS for " + ctrl + " panel")
-
-                # SAVE DATA TO USB
-                # write data to csv file
-                csv_master.write_data(data[ctrl])
-                print_l(current_time(), "Writing Results To CSV and TXT Files")
-                # delay before changing to next EDS panel
-                time.sleep(10)
-
-            # Pre EDS Activation Panel Measurements for all eds
-            for eds in eds_ids:
-                # mount the usb for data collection if there is a USB plugged
-                if usb_master.check_usb() == True:
-                    # mounts the usb
-                    usb_master.setup_usb_mount()
-                else:
-                    # if not, then reboot
-                    print_l(current_time(), "No USB Detected!")
-                    usb_master.reset()
-
-                # turn green and red LED on to show automatic testing is operating
-                # red LED on means USB should not be unplugged
-                GPIO.output(test_master.get_pin('outPinLEDRed'), 1)
-                GPIO.output(test_master.get_pin('outPinLEDGreen'), 1)
-
-                # start the measurement process
-                print_l(current_time(), "Time check passed. Measurement procedure for " + eds + " panel")
-                # check the eds_number
-                panel_num = data[eds]['num']
-                # get the date and time
-                data[eds]['date_time'] = current_time()
-                # measure global irradiance data from pyranometer
-                irr_master = SP420.Irradiance()
-                g_poa = irr_master.get_irradiance()
-                data[eds]['gpoa'] = g_poa
-                print_l(current_time(), "GPOA Irradiance for " + eds + ": " + str(g_poa))
-                # get the panel temperature using ambient temperature
-                amb_temp = w_read[1]
-                pan_temp = pow_master.get_panel_temp(amb_temp, g_poa)
-                data[eds]['temp'] = pan_temp
-                # get humidity data
-                data[eds]['humid'] = w_read[0]
-
-                # PRE EDS ACTIVATION MEASUREMENT
-                # measure PRE EDS activation ocv and scc
-                ocv_pre = 0
-                scc_pre = 0
-                [ocv_pre, scc_pre] = test_master.run_measure_EDS(panel_num)
-                print_l(current_time(), "PRE EDS OCV for " + eds + ": " + str(ocv_pre))
-                print_l(current_time(), "PRE EDS SCC for " + eds + ": " + str(scc_pre))
-                data[eds]['ocv_pre'] = ocv_pre
-                data[eds]['scc_pre'] = scc_pre
-                # compute the PRE EDS activation power measurements for each panel
-                power_pre = pow_master.get_power_out(ocv_pre, scc_pre, pan_temp)
-                print_l(current_time(), "PRE EDS Power for " + eds + ": " + str(power_pre))
-                data[eds]['pwr_pre'] = power_pre
-                # compute the PRE EDS activation PR measurements for each panel
-                pr_pre = pr_master.get_pr(ocv_pre, scc_pre, pan_temp, power_pre, g_poa)
-                print_l(current_time(), "PRE EDS PR for " + eds + ": " + str(pr_pre))
-                data[eds]['pr_pre'] = pr_pre
-                # compute the PRE EDS activation SI measurements for each panel
-                si_pre = soil_master.get_si(scc_pre, g_poa)
-                print_l(current_time(), "PRE EDS SI for " + eds + ": " + str(si_pre))
-                data[eds]['si_pre'] = si_pre
-
+                # measure all panels back to back, one irradiance and weather reading bracketing the sweep
+                batch = sweep_master.run_sweep(panel_ids, panel_data, irr_master, weather)
                 # POST EDS ACTIVATION MEASUREMENT Not used instead put N/A
-                ocv_post = 'N/A'
-                scc_post = 'N/A'
-                data[eds]['ocv_post'] = ocv_post
-                data[eds]['scc_post'] = scc_post
-                data[eds]['pwr_post'] = 'N/A'
-                data[eds]['pr_post'] = 'N/A'
-                data[eds]['si_post'] = 'N/A'
-
-                # WRITE DATA TO USB
-                # write data to csv file
-                csv_master.write_data(data[eds])
-                print_l(current_time(), "Writing Results To CSV and TXT Files")
-                # delay before changing to control panels
-                time.sleep(10)
-
-            # un-mount the usb drive
-            usb_master.reset_usb_mounts()
-            # turn of RED LED, indicating USB can be swapped
-            GPIO.output(test_master.get_pin('outPinLEDRed'), 0)
-            GPIO.output(test_master.get_pin('outPinLEDGreen'), 0)
-            # time to swap USB if desired
-            time.sleep(10)
-
-        '''
-        --------------------------------------------------------------------------
-        Field Test Unit Schedule for Measurement and Activation
-        --------------------------------------------------------------------------
-        '''
-        # first check, if it is during the day
-        if day:
-            # Temperature Humidity Sensor Check
+                for record in batch:
+                    if record.type == 'eds':
+                        sweep_master.no_post(record)
+
+                # SAVE DATA TO THE JOURNAL
+                save_batch(batch)
+                # only one measurement only sweep per day
+                scheduler.finish(event, started, 'run')
+                GPIO.output(test_master.get_pin('outPinLEDGreen'), 0)
+                continue
+
+            '''
+            --------------------------------------------------------------------------
+            Field Test Unit Schedule for Measurement and Activation
+            --------------------------------------------------------------------------
+            '''
+            # first check, if it is during the day, activations only run then
+            if not day:
+                scheduler.finish(event, current_time(), 'night')
+                continue
+            eds = event['panel']
+            # Temperature Humidity Sensor Check, the weather is only read when an activation is due
             w_read = weather.read_humidity_temperature()
             temp_pass = test_master.check_temp(w_read[1])
             humid_pass = test_master.check_humid(w_read[0])
             weather_pass = temp_pass and humid_pass
-            # if weather and time checks pass, proceed to next check
-            if weather_pass:
-                # initialize panel data
-                data = panel_data
-                # Pre EDS Activation Panel Measurements
-                for eds in eds_ids:
-                    print_l(current_time(), " Weather check passed. Now proceeding for time check for " + eds + " panel")
-                    # get data for frequency and schedule check for the current eds panel
-                    freq = data[eds]['frequency']
-                    sched = data[eds]['schedule']
-                    # declare panel class, which gives the frequency and schedule checks
-                    eds_panel = SM.ScheduleMaster(eds, freq, sched, longitude, gmt_offset)
-                    # check for the schedule check
-                    schedule_pass = eds_panel.check_time(current_time())
-                    # check for frequency check only if it meets schedule check
-                    if schedule_pass:
-                        schedule_pass = True
-                        print_l(current_time()," schedule passed for " + eds + " panel")
-                        frequency_pass = eds_panel.check_frequency(eds, current_time())
-                    # proceed to EDS measurement and activation process
-                    if schedule_pass and frequency_pass:
-                        print_l(current_time()," schedule and frequency passed for " + eds + " panel")
-                        # mount the usb for data collection if there is a USB plugged
-                        if usb_master.check_usb() == True:
-                            # mounts the usb
-                            usb_master.setup_usb_mount()
-                        else:
-                            # if not, then reboot
-                            print_l(current_time(), "No USB Detected!")
-                            usb_master.reset()
-                        # turn green and red LED on to show automatic testing is operating
-                        # red LED on means USB should not be unplugged
-                        GPIO.output(test_master.get_pin('outPinLEDRed'), 1)
-                        GPIO.output(test_master.get_pin('outPinLEDGreen'), 1)
-                        # start the measurement process
-                        print_l(current_time(),
-                                " Weather, schedule, and frequency checks passed. Initiating testing procedure for " + eds + " panel")
-                        # check the eds_number
-                        panel_num = data[eds]['num']
-                        # get the date and time
-                        data[eds]['date_time'] = current_time()
-                        # measure global irradiance data from pyranometer
-                        irr_master = SP420.Irradiance()
-                        g_poa = irr_master.get_irradiance()
-                        data[eds]['gpoa'] = g_poa
-                        print_l(current_time(), "GPOA Irradiance for " + eds + ": " + str(g_poa))
-                        # get the panel temperature using ambient temperature
-                        amb_temp = w_read[1]
-                        pan_temp = pow_master.get_panel_temp(amb_temp, g_poa)
-                        data[eds]['temp'] = pan_temp
-                        # get humidity data
-                        data[eds]['humid'] = w_read[0]
-
-                        # PRE EDS ACTIVATION MEASUREMENT
-                        # measure PRE EDS activation ocv and scc
-                        ocv_pre = 0
-                        scc_pre = 0
-                        [ocv_pre, scc_pre] = test_master.run_measure_EDS(panel_num)
-                        print_l(current_time(), "PRE EDS OCV for " + eds + ": " + str(ocv_pre))
-                        print_l(current_time(), "PRE EDS SCC for " + eds + ": " + str(scc_pre))
-                        data[eds]['ocv_pre'] = ocv_pre
-                        data[eds]['scc_pre'] = scc_pre
-                        # compute the PRE EDS activation power measurements for each panel
-                        power_pre = pow_master.get_power_out(ocv_pre, scc_pre, pan_temp)
-                        print_l(current_time(), "PRE EDS Power for " + eds + ": " + str(power_pre))
-                        data[eds]['pwr_pre'] = power_pre
-                        # compute the PRE EDS activation PR measurements for each panel
-                        pr_pre = pr_master.get_pr(ocv_pre, scc_pre, pan_temp, power_pre, g_poa)
-                        print_l(current_time(), "PRE EDS PR for " + eds + ": " + str(pr_pre))
-                        data[eds]['pr_pre'] = pr_pre
-                        # compute the PRE EDS activation SI measurements for each panel
-                        si_pre = soil_master.get_si(scc_pre, g_poa)
-                        print_l(current_time(), "PRE EDS SI for " + eds + ": " + str(si_pre))
-                        data[eds]['si_pre'] = si_pre
-
-                        # EDS ACTIVATION
-                        test_master.run_test(panel_num)
-                        print_l(current_time(), "Activating EDS for " + eds + " panel")
-
-                        # POST EDS ACTIVATION MEASUREMENT
-                        # measure POST EDS activation ocv and scc
-                        ocv_post = 0
-                        scc_post = 0
-                        [ocv_post, scc_post] = test_master.run_measure_EDS(panel_num)
-                        print_l(current_time(), "POST EDS OCV for " + eds + ": " + str(ocv_post))
-                        print_l(current_time(), "POST EDS SCC for " + eds + ": " + str(scc_post))
-                        data[eds]['ocv_post'] = ocv_post
-                        data[eds]['scc_post'] = scc_post
-                        # compute the POST EDS activation power measurements for each panel
-                        power_post = pow_master.get_power_out(ocv_post, scc_post, pan_temp)
-                        print_l(current_time(), "POST EDS Power for " + eds + ": " + str(power_post))
-                        data[eds]['pwr_post'] = power_post
-                        # compute the POST EDS activation PR measurements for each panel
-                        pr_post = pr_master.get_pr(ocv_post, scc_post, pan_temp, power_post, g_poa)
-                        print_l(current_time(), "POST EDS PR for " + eds + ": " + str(pr_post))
-                        data[eds]['pr_post'] = pr_post
-                        # compute the POST EDS activation SI measurements for each panel
-                        si_post = soil_master.get_si(scc_post, g_poa)
-                        print_l(current_time(), "POST EDS SI for " + eds + ": " + str(si_post))
-                        data[eds]['si_post'] = si_post
-
-                        # WRITE DATA TO USB
-                        # write data to csv file
-                        csv_master.write_data(data[eds])
-                        print_l(current_time(), "Writing Results To CSV and TXT Files")
-                        # delay before changing to control panels
-                        time.sleep(10)
-
-                        # CTRL PANEL MEASUREMENTS
-                        for ctrl in ctrl_ids:
-                            # start the measurement process
-                            print_l(current_time(),
-                                    "Measuring Control Panels. Initiating testing procedure for " + ctrl + " panel")
-                            # check the eds_number
-                            panel_num = data[ctrl]['num']
-                            # get the date and time
-                            data[ctrl]['date_time'] = current_time()
-                            # measure global irradiance data from pyranometer
-                            irr_master = SP420.Irradiance()
-                            g_poa = irr_master.get_irradiance()
-                            data[ctrl]['gpoa'] = g_poa
-                            print_l(current_time(), "GPOA Irradiance for " + ctrl + ": " + str(g_poa))
-                            # get the panel temperature using ambient temperature
-                            amb_temp = w_read[1]
-                            pan_temp = pow_master.get_panel_temp(amb_temp, g_poa)
-                            data[ctrl]['temp'] = pan_temp
-                            # get humidity data
-                            data[ctrl]['humid'] = w_read[0]
-                            '''PRE EDS ACTIVATION MEASUREMENT'''
-                            # measure PRE EDS activation ocv and scc
-                            ocv_pre = 0
-                            scc_pre = 0
-                            [ocv_pre, scc_pre] = test_master.run_measure_CTRL(panel_num)
-                            print_l(current_time(), "PRE EDS OCV for " + ctrl + ": " + str(ocv_pre))
-                            print_l(current_time(), "PRE EDS SCC for " + ctrl + ": " + str(scc_pre))
-                            data[ctrl]['ocv_pre'] = ocv_pre
-                            data[ctrl]['scc_pre'] = scc_pre
-                            # compute the PRE EDS activation power measurements for each panel
-                            power_pre = pow_master.get_power_out(ocv_pre, scc_pre, pan_temp)
-                            print_l(current_time(), "PRE EDS Power for " + ctrl + ": " + str(power_pre))
-                            data[ctrl]['pwr_pre'] = power_pre
-                            # compute the PRE EDS activation PR measurements for each panel
-                            pr_pre = pr_master.get_pr(ocv_pre, scc_pre, pan_temp, power_pre, g_poa)
-                            print_l(current_time(), "PRE EDS PR for " + ctrl + ": " + str(pr_pre))
-                            data[ctrl]['pr_pre'] = pr_pre
-                            # compute the PRE EDS activation SI measurements for each panel
-                            si_pre = soil_master.get_si(scc_pre, g_poa)
-                            print_l(current_time(), "PRE EDS SI for " + ctrl + ": " + str(si_pre))
-                            data[ctrl]['si_pre'] = si_pre
-
-                            # NO EDS ACTIVATION AND POST MEASUREMENTS FOR CTRL PANELS
-                            print_l(current_time(), "Not Activating EDS for " + ctrl + " panel")
-
-                            # SAVE DATA TO USB
-                            # write data to csv file
-                            csv_master.write_data(data[ctrl])
-                            print_l(current_time(), "Writing Results To CSV and TXT Files")
-                            # delay before changing to next EDS panel
-                            time.sleep(10)
-
-                        # un-mount the usb drive
-                        usb_master.reset_usb_mounts()
-                        # turn of RED LED, indicating USB can be swapped
-                        GPIO.output(test_master.get_pin('outPinLEDRed'), 0)
-                        GPIO.output(test_master.get_pin('outPinLEDGreen'), 0)
-                        # time to swap USB if desired
-                        time.sleep(10)
-                    else:
-                        print("Did not pass schedule and frequency checks")
-        else:
-            # Set Activation Flags to False in eds.json at the end of the day
-            if json_reset:
+            # if weather checks pass, proceed to next check, otherwise the job stays queued and retries at the next wake up
+            if not weather_pass:
+                continue
+            print_l(current_time(), " Weather check passed. Now proceeding for time check for " + eds + " panel", 'DEBUG')
+            started = current_time()
+            # the scheduler only hands out jobs inside their window, at most once a day
+            schedule_pass = True
+            # get data for frequency check for the current eds panel
+            freq = panel_data[eds]['frequency']
+            sched = panel_data[eds]['schedule']
+            # declare panel class, which gives the frequency check
+            eds_panel = SM.ScheduleMaster(eds, freq, sched, longitude, gmt_offset,
+                                          test_master.get_config()['solarNoonMethod'], activation_store)
+            print_l(current_time()," schedule passed for " + eds + " panel", 'DEBUG')
+            frequency_pass = eds_panel.check_frequency(eds, current_time())
+            # proceed to EDS measurement and activation process
+            if schedule_pass and frequency_pass:
+                scheduler.finish(event, started, 'run')
+                print_l(current_time()," schedule and frequency passed for " + eds + " panel")
+                # turn green LED on to show automatic testing is operating
+                GPIO.output(test_master.get_pin('outPinLEDGreen'), 1)
+                # start the measurement process
+                print_l(current_time(),
+                        " Weather, schedule, and frequency checks passed. Initiating testing procedure for " + eds + " panel")
+
+                # PRE EDS ACTIVATION MEASUREMENT
+                pre_batch = sweep_master.run_sweep([eds], panel_data, irr_master, weather)
+
+                # EDS ACTIVATION
+                print_l(current_time(), "Activating EDS for " + eds + " panel")
+                job = test_master.start_activation(panel_data[eds]['num'])
                 try:
-                # load the json file
-                    with open('/home/pi/Desktop/eds.json', 'r') as file:
-                        json_file = json.load(file)
-                    # reset all is_activated into false
-                    eds_names = ['eds1', 'eds2', 'eds3', 'eds4', 'eds5']
-                    for x in eds_names:
-                        json_file[x].update({
-                            'is_activated': False
-                        })
-                    # re-write the new json file
-                    with open('/home/pi/Desktop/eds.json', 'w+') as file:
-                        json.dump(json_file, file)
-                except:
-                    SM.ScheduleMaster.check_json_file(current_time())
+                    # CTRL PANEL MEASUREMENTS while the EDS film is energized
+                    ctrl_batch = sweep_master.run_sweep(ctrl_ids, panel_data, irr_master, weather)
+                    # keep blinking, sampling irradiance and reading the button until it is done
+                    service_activation(job, irr_master)
+                finally:
+                    # never leave the EDS relay on, even if a measurement failed
+                    job.finish()
+
+                # POST EDS ACTIVATION MEASUREMENT
+                batch = sweep_master.run_sweep([eds], panel_data, irr_master, weather,
+                                               'post', {eds: pre_batch[0]}) + ctrl_batch
+
+                # SAVE DATA TO THE JOURNAL
+                save_batch(batch)
+                GPIO.output(test_master.get_pin('outPinLEDGreen'), 0)
+            else:
+                scheduler.finish(event, started, 'frequency')
+                print("Did not pass schedule and frequency checks")
+
+        if not day:
+            # Set Activation Flags to False in eds.json at the end of the day, once per night
+            if night_reset_pending:
+                # reset all is_activated into false, eds.json is only written if one was set
+                activation_store.reset_activations(current_time())
+                night_reset_pending = False
+                stop_sampling()
+                print_l(current_time(), "Night mode, activation flags reset and sensor sampling stopped", 'DEBUG')
 
         '''
         --------------------------------------------------------------------------
@@ -601,27 +532,22 @@ while True:
         1) Check for changing input on switch pin
         2) If input is changed, and input is high (activate), then begin test
         '''
-        input_state = GPIO.input(test_master.get_pin('inPinManualActivate'))
-        if input_state == True:
-            # mount the usb for data collection
-            if usb_master.check_usb() == True:
-                # mounts the usb
-                usb_master.setup_usb_mount()
-            else:
-                print_l(current_time(), "No USB Detected!")
-                usb_master.reset()
-            # turn green and red LED on to show measuring time
-            GPIO.output(test_master.get_pin('outPinLEDRed'), 1)
+        # a press seen by edge detection while the loop slept counts even if the button is already released
+        pressed = waker.take_press()
+        input_state = GPIO.input(test_master.get_pin('inPinManualActivate')) or pressed
+        # also run if the button was pressed while an EDS film was energized
+        if input_state == True or manual_request:
+            manual_request = False
+            # turn green LED on to show measuring time
             GPIO.output(test_master.get_pin('outPinLEDGreen'), 1)
             # run EDS test on selected manual EDS
             eds_num = test_master.get_pin('manualEDSNumber')
             # get weather and time for data logging
-            w_read = weather.read_humidity_temperature()
+            w_read = weather.read_humidity_temperature_time()
 
             # START SEQUENCE
             print_l(current_time(), "FORCED. Running Manual Activation Mode for EDS" + str(eds_num))
             # Get global irradiance data from pyranometer
-            irr_master = SP420.Irradiance()
             g_poa = irr_master.get_irradiance()
             print_l(current_time(), "GPOA Measurement for EDS " + str(eds_num) + ": " + str(g_poa))
             # measure PV voc and isc before EDS activation
@@ -644,7 +570,11 @@ while True:
             print_l(current_time(),
                     "Pre-EDS Manual Activation SI Calculation for EDS" + str(eds_num) + ": " + str(eds_si_before))
             # activate the EDS film
-            test_master.run_test(eds_num)
+            job = test_master.start_activation(eds_num)
+            try:
+                service_activation(job, irr_master)
+            finally:
+                job.finish()
             # measure PV voc and isc after EDS activation
             [eds_ocv_after, eds_scc_after] = test_master.run_measure_EDS(eds_num)
             print_l(current_time(), "Post-EDS Manual Activation OCV for EDS" + str(eds_num) + ": " + str(eds_ocv_after))
@@ -669,18 +599,15 @@ while True:
             man_pr_data = [eds_pr_before, eds_pr_after]
             man_si_data = [eds_si_before, eds_si_after]
 
-            # SAVE DATA TO USB
-            # write data for EDS tested
-            csv_master.write_manual_data(current_time(), w_read[1], w_read[0], g_poa, eds_num, eds_ocv_before, eds_ocv_after,
-                                         eds_scc_before, eds_scc_after, man_power_data, man_pr_data, man_si_data)
-            print_l(current_time(), "Writing Manual Testing Mode Measurements Results To CSV and TXT Files")
-            # un-mount the usb drive
-            usb_master.reset_usb_mounts()
-            # turn of RED LED, indicating USB can be swapped
-            GPIO.output(test_master.get_pin('outPinLEDRed'), 0)
+            # SAVE DATA TO THE JOURNAL
+            # row for EDS tested
+            man_row = csv_master.data_row_manual(current_time(), w_read[1], w_read[0], g_poa, eds_num, eds_ocv_before, eds_ocv_after,
+                                                 eds_scc_before, eds_scc_after, man_power_data, man_pr_data, man_si_data,
+                                                 time.localtime(w_read[2]) if w_read[2] else None)
+            save_manual(man_row)
             GPIO.output(test_master.get_pin('outPinLEDGreen'), 0)
-            # time to swap USB if desired
-            time.sleep(10)
+            # the button also copies everything journaled so far to the USB
+            drain_journal(True)
 
             # FINISH
             print_l(current_time(), "Ended Manual Activation Test of EDS" + str(eds_num))
@@ -690,6 +617,9 @@ while True:
         --------------------------------------------------------------------------
         '''
 
+        # copy journaled measurements to the USB when the drain interval has passed
+        drain_journal()
+
         # remove error if corrected
         if "FATAL CORE ERROR" in error_list:
             error_list.remove("FATAL CORE ERROR")
@@ -698,6 +628,12 @@ while True:
     except Exception as e:
         logging.exception("Bad error %s",e)
         add_error("FATAL CORE ERROR")
+        # release the SPI bus and chip select before bailing out
+        adc_master.close()
+        # last attempt at getting queued rows and log lines onto the USB
+        if usb_master.check_usb() and mount_usb():
+            csv_master.flush()
+            unmount_usb()
         raise
 
     # error handling
@@ -705,7 +641,7 @@ while True:
         e_phrase = "Current error list: "
         for err in error_list:
             e_phrase += " [" + err + "]"
-        print_l(current_time(), e_phrase)
+        print_l(current_time(), e_phrase, 'DEBUG')
 
     # blinking RED LED if error is raised
     if error_flag:
@@ -714,4 +650,10 @@ while True:
         else:
             GPIO.output(test_master.get_pin('outPinLEDRed'), 0)
 
+    # sleep until the next scheduled event, a manual button press or the heartbeat, whichever comes first
+    rtc_before = current_time()
+    slept = min(heartbeat if day else night_heartbeat, scheduler.seconds_until_next(rtc_before))
+    if waker.wait(slept):
+        slept = 0
+
             # END CORE LOOP
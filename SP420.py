@@ -8,7 +8,14 @@ Started: September 2019
 
 from serial import Serial,SerialException
 from time import sleep
+import time
+import os
+import pty
+import tty
 import struct
+import threading
+import tempfile
+import numpy as np
 
 #Commands to the SP420 Sensor
 GET_VOLT = bytes([0x55, 0x21])          #'\x55!'.encode()
@@ -19,65 +26,107 @@ GET_LOGGING_COUNT = bytes([0xf3, 0x21])  #'\xf3!'
 GET_LOGGED_ENTRY = bytes([0xf2])        #'\xf2%s!'
 ERASE_LOGGED_DATA = bytes([0xf4, 0x21])  #'\xf4!'
 
+# serial ports the pyranometer shows up on, tried in order
+DEFAULT_PORTS = ['/dev/ttyACM0', '/dev/tty.usbmodem14201']
+# after a failed connect the ports are not tried again for this many seconds
+RECONNECT_SECONDS = 60
+
 class Irradiance(object):
     
-    def __init__(self):
-        """Initializes class variables, and attempts to connect to device"""
+    def __init__(self, ports=None, reconnect_seconds=RECONNECT_SECONDS, clock=time.monotonic, sleep=time.sleep):
+        """Initializes class variables, and attempts to connect to device.
+        One instance is meant to live for the whole run and be shared by every reading."""
         self.apogee = None
         self.offset = 0.0
         self.multiplier = 0.0
+        self.ports = DEFAULT_PORTS if ports is None else ports
+        self.port = None
+        self.connects = 0
+        self.reconnect_seconds = reconnect_seconds
+        self.clock = clock
+        self.sleep = sleep
+        # clock() of the last failed connect, None while connected
+        self.last_failed = None
+        # serializes access to the port between threads
+        self.lock = threading.RLock()
         self.connect_to_device()
 
     def connect_to_device(self):
         """This function creates a Serial connection with the defined comport and attempts to read the calibration values"""
-        #Error checking the ports
-        try:
-            port = '/dev/ttyACM0' # you'll have to check your device manager and put the actual com port here
-            self.apogee = Serial(port, 115200, timeout=0.5)
-        
-        except SerialException:
-            if (port == '/dev/ttyACM0'):
-                port = '/dev/tty.usbmodem14201' #NEW PORT NAME
+        with self.lock:
+            self.disconnect()
+            #Error checking the ports
+            for port in self.ports:
                 try:
                     self.apogee = Serial(port, 115200, timeout=0.5)
+                    self.port = port
+                    break
                 except SerialException:
                     self.apogee = None
-            else:
-                #No Pyranometer Found
-                self.apogee = None
-
-        #Get the constants involved for measuring irradiance
-        try:
-            self.apogee.write(READ_CALIBRATION)
-            multiplier = self.apogee.read(5)[1:]
-            offset = self.apogee.read(4)
-            self.multiplier = struct.unpack('<f', multiplier)[0]
-            self.offset = struct.unpack('<f', offset)[0]
-
-        except IOError:
-            print("ERROR")
+            if self.apogee is None:
+                #No Pyranometer Found, said once until it connects again
+                if self.last_failed is None:
+                    print("No Pyranometer Found!")
+                self.last_failed = self.clock()
+                return False
+            self.connects += 1
+            # drop anything left over from before the reconnect
+            self.apogee.reset_input_buffer()
+            #Get the constants involved for measuring irradiance, cached until the next reconnect
+            try:
+                self.read_calibration()
+            except (IOError, struct.error):
+                print("ERROR")
+                self.disconnect()
+                self.last_failed = self.clock()
+                return False
+            if self.last_failed is not None:
+                print("Pyranometer connected on " + self.port)
+            self.last_failed = None
+            return True
+
+    def is_connected(self):
+        return self.apogee is not None
+
+    def can_reconnect(self):
+        """False for reconnect_seconds after a failed connect, so a missing sensor is not polled on every reading"""
+        return self.last_failed is None or self.clock() - self.last_failed >= self.reconnect_seconds
+
+    def disconnect(self):
+        """Closes the serial port, the next reading reconnects"""
+        with self.lock:
+            if self.apogee is not None:
+                try:
+                    self.apogee.close()
+                except (IOError, SerialException):
+                    pass
             self.apogee = None
-            
-        except AttributeError:
-            print("No Pyranometer Found!")
+
+    def read_calibration(self):
+        """Reads the multiplier and offset from the sensor, call again to refresh them on demand"""
+        with self.lock:
+            for attempt in range(2):
+                self.apogee.write(READ_CALIBRATION)
+                response = self.apogee.read(9)
+                # the sensor echoes the command byte, anything else is a stale reply from before a reconnect
+                if response[:1] == READ_CALIBRATION[:1] and len(response) == 9:
+                    break
+                self.sleep(0.1)
+                self.apogee.reset_input_buffer()
+            self.multiplier = struct.unpack('<f', response[1:5])[0]
+            self.offset = struct.unpack('<f', response[5:9])[0]
     
-    def get_irradiance(self):
+    def get_irradiance(self, number_to_average=10, number_of_seconds=1.0):
         """This function converts the voltage to irradiance"""
-        if (self.apogee == None):
-            return -1
-        
-        #Measure voltage from the pyranometer
-        voltage = self.read_voltage()
+        with self.lock:
+            #Measure voltage from the pyranometer
+            voltage = self.read_voltage(number_to_average, number_of_seconds)
 
-        if voltage == 9999:
-            # you could raise some sort of Exception here if you wanted to
-            return -1
+            if voltage is None or voltage == 9999:
+                # you could raise some sort of Exception here if you wanted to
+                return -1
 
-        irradiance = ((voltage *1000) - self.offset) * self.multiplier
-        #print("Raw Voltage: " + str(voltage))
-        #print("Offest: " + str(self.offset))
-        #print("Multiplier: " + str(self.multiplier))
-        #print(irradiance)
+            irradiance = ((voltage *1000) - self.offset) * self.multiplier
 
         #Error check, irradiance cannot be negative
         if irradiance < 0:
@@ -85,38 +134,43 @@ class Irradiance(object):
         
         return round(irradiance,3)
 
-    def read_voltage(self):
-        """This function averages 5 readings over 1 second and returns the result."""
-        if self.apogee == None:
-            try:
-                self.connect_to_device()
-            except IOError:
-                # you can raise some sort of exception here if you need to
-                return None
+    def read_voltage(self, number_to_average=10, number_of_seconds=1.0):
+        """This function averages number_to_average readings over number_of_seconds and returns the result.
+        Reconnects once if the port has gone away."""
+        with self.lock:
+            if self.apogee is None:
+                if not self.can_reconnect() or not self.connect_to_device():
+                    # you can raise some sort of exception here if you need to
+                    return None
+            voltage = self.sample_voltage(number_to_average, number_of_seconds)
+            if voltage == 9999:
+                # the device was unplugged or reset, reopen the port and try once more
+                print("Pyranometer connection lost, reconnecting")
+                if not self.connect_to_device():
+                    return None
+                voltage = self.sample_voltage(number_to_average, number_of_seconds)
+            return voltage
+
+    def sample_voltage(self, number_to_average, number_of_seconds):
         # store the responses to average
         response_list = []
-        # change to average more or less samples over the given time period
-        number_to_average = 10
-        # change to shorten or extend the time duration for each measurement
-        # be sure to leave as floating point to avoid truncation
-        number_of_seconds = 1.0
 
         for i in range(number_to_average):
             try:
                 self.apogee.write(GET_VOLT)
-                response = self.apogee.read(5)[1:]
-            except IOError:
+                response = self.apogee.read(5)
+            except (IOError, SerialException):
                 print("There is an input/output error")
                 # exception here alternatively
                 return 9999
             else:
-                if not response:
+                # skip empty, torn or stale responses (e.g. right after a reconnect)
+                if len(response) != 5 or response[:1] != GET_VOLT[:1]:
                     continue
-                # if the response is not 4 bytes long, this line will raise
-                # an exception
-                voltage = struct.unpack('<f', response)[0]
+                voltage = struct.unpack('<f', response[1:])[0]
                 response_list.append(voltage)
-                sleep(number_of_seconds/number_to_average)
+                if number_to_average > 1:
+                    self.sleep(number_of_seconds/number_to_average)
 
         #Calculate the average of the readings
         if response_list:
@@ -138,6 +192,171 @@ class Irradiance(object):
         sleep(2.0)
         print("------------------------------------------")
 
+
+class IrradianceSampler(object):
+    """Background thread polling the pyranometer at a fixed rate into a ring buffer of (timestamp, W/m2).
+    Timestamps come from clock() (time.time by default) so they line up with measurement windows."""
+
+    def __init__(self, irr_master, rate=2.0, buffer_seconds=3600, clock=time.time):
+        self.irr_master = irr_master
+        self.period = 1.0 / rate
+        self.clock = clock
+        # fixed size buffer, rows are [timestamp, irradiance], unused rows are NaN
+        self.size = max(2, int(buffer_seconds * rate))
+        self.buffer = np.full((self.size, 2), np.nan)
+        self.index = 0
+        self.count = 0
+        self.lock = threading.Lock()
+        self.stop_event = threading.Event()
+        self.thread = None
+
+    def start(self):
+        if self.thread is None or not self.thread.is_alive():
+            self.stop_event.clear()
+            self.thread = threading.Thread(target=self.run, daemon=True)
+            self.thread.start()
+
+    def stop(self):
+        self.stop_event.set()
+        if self.thread is not None:
+            self.thread.join(2.0)
+
+    def is_running(self):
+        return self.thread is not None and self.thread.is_alive()
+
+    def run(self):
+        next_tick = time.monotonic()
+        while not self.stop_event.is_set():
+            # single sample per tick, the averaging happens on the query side
+            timestamp = self.clock()
+            irradiance = self.irr_master.get_irradiance(1, 0.0)
+            if irradiance >= 0:
+                self.append(timestamp, irradiance)
+            next_tick += self.period
+            delay = next_tick - time.monotonic()
+            if delay < 0:
+                # fell behind (slow sensor or reconnect), don't try to catch up
+                next_tick = time.monotonic()
+                delay = 0
+            self.stop_event.wait(delay)
+
+    def append(self, timestamp, irradiance):
+        with self.lock:
+            self.buffer[self.index] = (timestamp, irradiance)
+            self.index = (self.index + 1) % self.size
+            self.count = min(self.count + 1, self.size)
+
+    def samples(self):
+        """Returns (timestamps, irradiance) arrays of the buffered samples, oldest first"""
+        with self.lock:
+            if self.count < self.size:
+                data = self.buffer[:self.count].copy()
+            else:
+                data = np.roll(self.buffer, -self.index, axis=0)
+        return data[:, 0], data[:, 1]
+
+    def latest(self):
+        """Most recent (timestamp, irradiance), or None if nothing was sampled yet"""
+        with self.lock:
+            if self.count == 0:
+                return None
+            row = self.buffer[(self.index - 1) % self.size]
+        return (float(row[0]), float(row[1]))
+
+    def irradiance_at(self, t):
+        """Irradiance at time t interpolated between samples, None if t is outside the buffer"""
+        times, values = self.samples()
+        if times.size == 0 or t < times[0] or t > times[-1]:
+            return None
+        return round(float(np.interp(t, times, values)), 3)
+
+    def mean_between(self, t0, t1):
+        """Mean irradiance over [t0, t1], interpolated at the midpoint if no sample falls inside"""
+        times, values = self.samples()
+        if times.size == 0:
+            return None
+        inside = (times >= t0) & (times <= t1)
+        if np.any(inside):
+            return round(float(np.mean(values[inside])), 3)
+        return self.irradiance_at((t0 + t1) / 2.0)
+
+
+class FakeSP420(object):
+    """Pseudo-terminal stand-in for the SP420, answers GET_VOLT and READ_CALIBRATION like the sensor.
+    The pty is reachable through a stable symlink (self.port) so unplug()/replug() exercise reconnects.
+    source() can return the sensor voltage to follow a simulated environment."""
+
+    def __init__(self, voltage=0.16, multiplier=5.0, offset=0.0, latency=0.0, source=None):
+        self.voltage = voltage
+        self.source = source
+        self.multiplier = multiplier
+        self.offset = offset
+        # delay before each reply, emulates the sensor's response time
+        self.latency = latency
+        self.requests = 0
+        self.master = None
+        self.slave = None
+        self.thread = None
+        self.dir = tempfile.mkdtemp(prefix='fake_sp420_')
+        self.port = os.path.join(self.dir, 'ttyACM0')
+        self.replug()
+
+    def replug(self):
+        """Creates a new pty and points the port symlink at it"""
+        self.master, self.slave = pty.openpty()
+        tty.setraw(self.slave)
+        if os.path.lexists(self.port):
+            os.remove(self.port)
+        os.symlink(os.ttyname(self.slave), self.port)
+        self.thread = threading.Thread(target=self.serve, args=(self.master,), daemon=True)
+        self.thread.start()
+
+    def unplug(self):
+        """Closes the pty, reads and writes on the open port start failing"""
+        for fd in (self.master, self.slave):
+            try:
+                os.close(fd)
+            except OSError:
+                pass
+        if os.path.lexists(self.port):
+            os.remove(self.port)
+        self.thread.join(1.0)
+
+    def close(self):
+        self.unplug()
+        os.rmdir(self.dir)
+
+    def serve(self, master):
+        buffer = b''
+        while True:
+            try:
+                chunk = os.read(master, 64)
+            except OSError:
+                return
+            if not chunk:
+                return
+            buffer += chunk
+            # commands are one byte followed by '!'
+            while b'!' in buffer:
+                command, buffer = buffer.split(b'!', 1)
+                reply = self.reply(command[-1:])
+                if reply:
+                    sleep(self.latency)
+                    try:
+                        os.write(master, reply)
+                    except OSError:
+                        return
+
+    def reply(self, command):
+        self.requests += 1
+        if command == GET_VOLT[:1]:
+            if self.source is not None:
+                self.voltage = self.source()
+            return GET_VOLT[:1] + struct.pack('<f', self.voltage)
+        if command == READ_CALIBRATION[:1]:
+            return READ_CALIBRATION[:1] + struct.pack('<f', self.multiplier) + struct.pack('<f', self.offset)
+        return b''
+
 if __name__ == "__main__":
     sample = Irradiance()
     x = sample.get_irradiance()
@@ -6,13 +6,24 @@ Started: September 2018
 Version 2: (Json Act)
 =============================
 '''
+import os
 from os import path
-from math import cos, sin
-from numpy import deg2rad
+from math import floor, ceil
+import numpy as np
+import datetime
 import json
 import time
 import subprocess
 
+# activation state of every EDS, kept on the RasPi Desktop so it survives USB swaps
+EDS_JSON_PATH = '/home/pi/Desktop/eds.json'
+# measurements are journaled on the SD card before they are drained to the USB
+JOURNAL_DIR = '/home/pi/Desktop/eds_journal'
+# yearly solar noon tables, one .npy file per site, year and method
+SOLAR_NOON_DIR = '/home/pi/Desktop/eds_solar_noon'
+# planned vs actual start time of every scheduled event
+SCHEDULE_LOG_PATH = '/home/pi/Desktop/eds_schedule.csv'
+
 EDS_SCHEDULE = {
     'eds1': {
         'schedule':['SN'],
@@ -65,6 +76,38 @@ DEFAULT_CONFIG_PARAM = {
     'maxRelativeHumidity': 60,   # percentage
     'minRelativeHumidity': 5,    # percentage
     'testDurationSeconds': 120, # (seconds) 2 minute, duration for EDS activation
+    # ADC measurement
+    'adcBurstSamples': 32, # readings averaged for each Voc/Isc measurement, 1 = single reading
+    'csvUncertainty': False, # add std and sample count columns to eds_data.csv/txt
+    'csvQueueRows': 64, # max rows held in memory before eds_data.csv/txt are written
+    'journalDrainSeconds': 3600, # how often journaled measurements are copied to the USB, the manual button drains right away
+    'recordLog': True, # write eds_data.bin, fixed width binary records of the scheduled data
+    'csvLegacyFiles': False, # also write eds_data.csv/txt on every sweep, otherwise export them from eds_data.bin with export_data.py
+    'csvIndex': True, # keep eds_data.idx (date and panel offsets into eds_data.csv) for query_data.py
+    'csvDecimals': {}, # fixed decimals per column of the data files, e.g. {'ocv_pre': 2, 'gpoa': 0}, unlisted columns as measured
+    'csvChecksum': True, # Seq and CRC32 columns on every row of new data files, checked by recover_data.py
+    # log.txt/log.jsonl on the USB
+    'logLevel': 'INFO', # DEBUG, INFO, WARNING or ERROR, lower lines are not written
+    'logBufferLines': 200, # max lines held in memory before the log files are written
+    'logFlushSeconds': 300, # write held lines at least this often
+    'logMaxBytes': 1048576, # start a new log.txt past this size, and at every new day
+    'logKeepSegments': 60, # gzipped old logs kept on the USB, 0 = all
+    'logJsonLines': True, # also write log.jsonl, one json object per line
+    # relay settling, replaces the fixed 0.5 s waits around every relay switch
+    'settleToleranceVolts': 0.005, # max change between successive raw ADC readings (~1.5 LSB)
+    'settleTimeoutSeconds': 0.5, # give up waiting and read anyway after this long
+    'settlePollSeconds': 0.005, # time between settle readings
+    'relayBreakSeconds': 0.05, # wait after a relay is released before the next switch
+    # temperature/humidity readings younger than this are reused instead of reading the AM2315 again
+    'weatherTTLSeconds': 60,
+    # the loop sleeps until the next scheduled event or a manual button press, waking at least this often (LED heartbeat)
+    'heartbeatSeconds': 30,
+    'nightHeartbeatSeconds': 300, # same at night (4PM - 9AM), when nothing is scheduled
+    'buttonPollSeconds': 1, # how often the manual button is read while sleeping if edge detection is not available
+    'scheduleGraceMinutes': 30, # a scheduled activation held up by another one still starts up to this late
+    # background pyranometer sampling
+    'irradianceSampleHz': 2, # samples per second taken by the background sampler
+    'irradianceBufferSeconds': 3600, # history kept in the ring buffer
     # indicators/switches
     # gpio pin number
     'outPinLEDGreen': 5, # GPIO 5 = pin 29
@@ -76,28 +119,15 @@ DEFAULT_CONFIG_PARAM = {
     # location data for solar noon calculation
     'degLongitude': -71.05,
     'offsetGMT': -5,
+    'solarNoonMethod': 'simple', # 'simple' (original sciencing.com formula) or 'noaa' (NOAA solar position, within a few seconds)
     }
 
-# dictionary for panel measurement, default panel data
+# panels measured by the FTU, DataManager.PanelRecord.from_template starts a measurement record from an entry
 PANEL_DATA = {
     'eds1':{
         'name':'EDS-PV1',
         'num':1,
         'type':'eds',
-        'date_time':'',
-        'temp':0,
-        'humid':0,
-        'gpoa':0,
-        'ocv_pre':0,
-        'ocv_post':0,
-        'scc_pre':0,
-        'scc_post':0,
-        'pwr_pre':0,
-        'pwr_post':0,
-        'pr_pre':0,
-        'pr_post':0,
-        'si_pre':0,
-        'si_post':0,
         'frequency':EDS_SCHEDULE['eds1']['frequency'],
         'schedule':EDS_SCHEDULE['eds1']['schedule']
     },
@@ -105,20 +135,6 @@ PANEL_DATA = {
         'name':'EDS-PV2',
         'num':2,
         'type':'eds',
-        'date_time':'',
-        'temp':0,
-        'humid':0,
-        'gpoa':0,
-        'ocv_pre':0,
-        'ocv_post':0,
-        'scc_pre':0,
-        'scc_post':0,
-        'pwr_pre':0,
-        'pwr_post':0,
-        'pr_pre':0,
-        'pr_post':0,
-        'si_pre':0,
-        'si_post':0,
         'frequency':EDS_SCHEDULE['eds2']['frequency'],
         'schedule':EDS_SCHEDULE['eds2']['schedule']
     },
@@ -126,20 +142,6 @@ PANEL_DATA = {
         'name':'EDS-PV3',
         'num':3,
         'type':'eds',
-        'date_time':'',
-        'temp':0,
-        'humid':0,
-        'gpoa':0,
-        'ocv_pre':0,
-        'ocv_post':0,
-        'scc_pre':0,
-        'scc_post':0,
-        'pwr_pre':0,
-        'pwr_post':0,
-        'pr_pre':0,
-        'pr_post':0,
-        'si_pre':0,
-        'si_post':0,
         'frequency':EDS_SCHEDULE['eds3']['frequency'],
         'schedule':EDS_SCHEDULE['eds3']['schedule']
     },
@@ -147,20 +149,6 @@ PANEL_DATA = {
         'name':'EDS-PV4',
         'num':4,
         'type':'eds',
-        'date_time':'',
-        'temp':0,
-        'humid':0,
-        'gpoa':0,
-        'ocv_pre':0,
-        'ocv_post':0,
-        'scc_pre':0,
-        'scc_post':0,
-        'pwr_pre':0,
-        'pwr_post':0,
-        'pr_pre':0,
-        'pr_post':0,
-        'si_pre':0,
-        'si_post':0,
         'frequency':EDS_SCHEDULE['eds4']['frequency'],
         'schedule':EDS_SCHEDULE['eds4']['schedule']
     },
@@ -168,20 +156,6 @@ PANEL_DATA = {
         'name':'EDS-PV5',
         'num':5,
         'type':'eds',
-        'date_time':'',
-        'temp':0,
-        'humid':0,
-        'gpoa':0,
-        'ocv_pre':0,
-        'ocv_post':0,
-        'scc_pre':0,
-        'scc_post':0,
-        'pwr_pre':0,
-        'pwr_post':0,
-        'pr_pre':0,
-        'pr_post':0,
-        'si_pre':0,
-        'si_post':0,
         'frequency':EDS_SCHEDULE['eds5']['frequency'],
         'schedule':EDS_SCHEDULE['eds5']['schedule']
     },
@@ -189,20 +163,6 @@ PANEL_DATA = {
         'name':'CTRL-PV1',
         'num':1,
         'type':'ctrl',
-        'date_time':'',
-        'temp':0,
-        'humid':0,
-        'gpoa':0,
-        'ocv_pre':0,
-        'ocv_post':'N/A',
-        'scc_pre':0,
-        'scc_post':'N/A',
-        'pwr_pre':0,
-        'pwr_post':'N/A',
-        'pr_pre':0,
-        'pr_post':'N/A',
-        'si_pre':0,
-        'si_post':'N/A',
         'frequency':'', # No Determined Frequency
         'schedule':[] # No Determined Schedule
     },
@@ -210,20 +170,6 @@ PANEL_DATA = {
         'name':'CTRL-PV2',
         'num':2,
         'type':'ctrl',
-        'date_time':'',
-        'temp':0,
-        'humid':0,
-        'gpoa':0,
-        'ocv_pre':0,
-        'ocv_post':'N/A',
-        'scc_pre':0,
-        'scc_post':'N/A',
-        'pwr_pre':0,
-        'pwr_post':'N/A',
-        'pr_pre':0,
-        'pr_post':'N/A',
-        'si_pre':0,
-        'si_post':'N/A',
         'frequency':'', # No Determined Frequency
         'schedule':[] # No Determined Schedule
     }
@@ -252,123 +198,143 @@ class StaticMaster:
         return self.panel_data
 
 
+'''
+Activation Store class
+Functionality:
+1) Holds the activation state of every EDS (is_activated, record_dt) in memory, loaded once from eds.json
+2) Writes eds.json only when the state changes, to a temp file renamed over the old one
+3) A missing, blank or unreadable eds.json is replaced with a fresh state
+'''
+class ActivationStore:
+    EDS_NAMES = ['eds1', 'eds2', 'eds3', 'eds4', 'eds5']
+    # store shared by every ScheduleMaster not given one
+    shared = None
+
+    def __init__(self, json_path=None):
+        self.json_path = EDS_JSON_PATH if json_path is None else json_path
+        self.state = None
+        # number of times eds.json was written, for testing
+        self.writes = 0
+
+    # shared store for eds.json, used by ScheduleMaster when it is not given one
+    @classmethod
+    def get(cls):
+        if cls.shared is None or cls.shared.json_path != EDS_JSON_PATH:
+            cls.shared = cls()
+        return cls.shared
+
+    # blank record_dt like eds_bones.json, the next frequency check is a first time activation
+    @classmethod
+    def fresh_state(cls):
+        return {name: {'is_activated': False, 'record_dt': ''} for name in cls.EDS_NAMES}
+
+    # read eds.json, True if it had to be created
+    def load(self, dt):
+        try:
+            with open(self.json_path, 'r') as file:
+                state = json.load(file)
+            if all(name in state for name in self.EDS_NAMES):
+                self.state = state
+                return False
+            print("\n Json file is incomplete fixed \n")
+        except (IOError, OSError):
+            print("\n json does not exist fixed \n")
+        except ValueError:
+            print("\n Json file is blank fixed \n")
+        self.state = self.fresh_state()
+        self.save()
+        return True
+
+    # write and rename, a power cut leaves the old or the new file, never a blank one
+    def save(self):
+        tmp = self.json_path + '.tmp'
+        with open(tmp, 'w') as file:
+            json.dump(self.state, file)
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(tmp, self.json_path)
+        self.writes += 1
+
+    def get_state(self, name, dt):
+        if self.state is None:
+            self.load(dt)
+        return self.state[name]
+
+    # change the state of one EDS, eds.json is written only if something changed
+    def update(self, name, dt, is_activated, record_dt=None):
+        entry = self.get_state(name, dt)
+        new = {'is_activated': is_activated, 'record_dt': entry['record_dt'] if record_dt is None else list(record_dt)}
+        if new == entry:
+            return False
+        self.state[name] = new
+        self.save()
+        return True
+
+    # set is_activated to false for every EDS (end of the day), one write at most
+    def reset_activations(self, dt):
+        if self.state is None:
+            self.load(dt)
+        changed = False
+        for name in self.EDS_NAMES:
+            if self.state[name]['is_activated']:
+                self.state[name] = dict(self.state[name], is_activated=False)
+                changed = True
+        if changed:
+            self.save()
+        return changed
+
+
 '''
 Schedule class
 Functionality:
 1) Check activation/measurement frequency
 2) Check with scheduled time for activation/measurement
-3) Stores this information in json file in Desktop of RasPi
+3) Stores this information in json file in Desktop of RasPi, through the ActivationStore
 '''
 class ScheduleMaster:
-    def __init__(self, name, frequency, schedule, longitude, gmt_off):
+    def __init__(self, name, frequency, schedule, longitude, gmt_off, solar_method='simple', store=None):
         self.panel_type = name
         self.frequency = frequency # how many activations per day/2 days
         self.schedule_time = schedule # in minutes
+        # activation state of all EDS, held in memory
+        self.store = ActivationStore.get() if store is None else store
 
         # for calculating solar noon
         self.longitude = longitude
         self.gmt_off = gmt_off
+        self.solar_method = solar_method
 
-    @staticmethod
-    def check_json_file(dt):
-        eds = {
-                'eds1':{
-                    'is_activated':False,
-                    'record_dt': dt
-                },
-                'eds2':{
-                    'is_activated':False,
-                    'record_dt': dt
-                },
-                'eds3':{
-                    'is_activated':False,
-                    'record_dt': dt
-                },
-                'eds4':{
-                    'is_activated':False,
-                    'record_dt': dt
-                },
-                'eds5':{
-                    'is_activated':False,
-                    'record_dt': dt
-                }
-            }
-        #checks if json exists
-        if not path.exists('/home/pi/Desktop/eds.json'):
-            print("\n json does not exist fixed \n")
-            with open('/home/pi/Desktop/eds.json', 'w+') as file:
-                json.dump(eds, file)
+    def check_frequency(self,name,dt):
+        state = self.store.get_state(name, dt)
+        # check if it has already activated today, if it has, return true for other activation times today
+        if state['is_activated']:
             return True
-        # checks if json is blank
-        elif path.getsize('/home/pi/Desktop/eds.json') <= 2:
-            print("\n Json file is blank fixed \n")
-            with open('/home/pi/Desktop/eds.json', 'w+') as file:
-                json.dump(eds, file)
+        # check for frequency confirmation, also check if it is first activation, meaning record will be blank
+        current_day = self.day_of_year(dt)
+        current_year = dt.tm_year
+        #Try except statement for checking if first time activation
+        try:
+            record_dt = time.struct_time(tuple(state['record_dt']))
+        except (TypeError, ValueError):
+            print("Firt time activation \n")
+            self.store.update(name, dt, True, dt)
             return True
-
-        else:
-            return False
-    
-    def check_frequency(self,name,dt):
-        # check if no json file in the desktop directory
-        if self.check_json_file(dt):
+        print("Subsequent Activations \n")
+        activation_day = self.day_of_year(record_dt)
+        activation_year = record_dt.tm_year
+        #checks to see if frequency is met
+        if current_day - activation_day >= self.frequency:
+            self.store.update(name, dt, True, dt)
+            return True
+        elif current_year - activation_year >= 1:
+            #checks for change in year
+            print("year change")
+            self.store.update(name, dt, True, dt)
             return True
         else:
-            # load the json file
-            with open('/home/pi/Desktop/eds.json', 'r') as file:
-                json_file = json.load(file)
-            # check if it has already activated today, if it has, return true for other activation times today
-            is_act = json_file[name]['is_activated']
-            if is_act:
-                return True
-            else:
-                # check for frequency confirmation, also check if it is first activation, meaning record in json will be blank
-                current_day = self.day_of_year(dt)
-                current_year = dt.tm_year
-                #Try except statement for checking if first time activation
-                try:
-                    activation_day = self.day_of_year(time.struct_time(tuple(json_file[name]['record_dt'])))
-                except:
-                    print("Firt time activation \n")
-                    json_file[name].update({
-                        'is_activated':True,
-                        'record_dt':dt
-                    })
-                    with open('/home/pi/Desktop/eds.json', 'w') as file:
-                        json.dump(json_file, file)
-                    return True
-                else:
-                    print("Subsequent Activations \n")
-                    activation_year = time.struct_time(tuple(json_file[name]['record_dt'])).tm_year
-                    #checks to see if frequency is met 
-                    if current_day - activation_day >= self.frequency:
-                        json_file[name].update({
-                            'is_activated':True,
-                            'record_dt':dt
-                        })
-                        with open('/home/pi/Desktop/eds.json', 'w') as file:
-                            json.dump(json_file, file)
-                        return True
-
-                    elif current_year - activation_year >= 1:
-                    #checks for change in year
-                            print("year change")
-                            json_file[name].update({
-                                'is_activated':True,
-                                'record_dt':dt
-                            })
-                            with open('/home/pi/Desktop/eds.json', 'w') as file:
-                                json.dump(json_file, file)
-                            return True
-
-                    else:
-                        # don't change the record_dt since did not meet frequency check
-                        json_file[name].update({
-                            'is_activated':False
-                        })
-                        with open('/home/pi/Desktop/eds.json', 'w') as file:
-                            json.dump(json_file, file)
-                        return False
+            # don't change the record_dt since did not meet frequency check
+            self.store.update(name, dt, False)
+            return False
 
 
     def check_time(self, dt):
@@ -425,13 +391,215 @@ class ScheduleMaster:
         min_day = (hour*60) + minute
         return min_day
     
-    # function to calculate solar noon time in minutes
+    # function to get solar noon time in minutes, looked up in the yearly table for the site
     def get_solar_time(self, dt):
+        return SolarNoonTable.get(self.longitude, self.gmt_off, dt.tm_year, self.solar_method).noon(dt)
+
+
+'''
+Solar Noon Table class
+Functionality:
+1) Computes solar noon (minutes after local standard midnight) for every day of a year in one numpy pass
+2) Caches the table in SOLAR_NOON_DIR per site, year and method, and in memory for the run
+3) Looks solar noon up by day of year
+'''
+class SolarNoonTable:
+    # tables already loaded in this run, (longitude, gmt_off, year, method): SolarNoonTable
+    tables = {}
+
+    def __init__(self, longitude, gmt_off, year, method='simple', cache_dir=None):
+        self.longitude = longitude
+        self.gmt_off = gmt_off
+        self.year = year
+        self.method = method
+        self.cache_dir = SOLAR_NOON_DIR if cache_dir is None else cache_dir
+        self.noon_min = self.load()
+        # plain floats, indexing a list is faster than a numpy array for single lookups
+        self.noon_list = self.noon_min.tolist()
+
+    # shared table for a site and year, loaded or computed once per run
+    @classmethod
+    def get(cls, longitude, gmt_off, year, method='simple'):
+        key = (longitude, gmt_off, year, method)
+        if key not in cls.tables:
+            cls.tables[key] = cls(longitude, gmt_off, year, method)
+        return cls.tables[key]
+
+    def cache_path(self):
+        name = 'solar_noon_' + str(self.year) + '_' + str(self.longitude) + '_' + str(self.gmt_off) + '_' + self.method + '.npy'
+        return path.join(self.cache_dir, name)
+
+    # table from the cache file, computed and saved if it is missing or unreadable
+    def load(self):
+        try:
+            table = np.load(self.cache_path())
+            if table.shape == (367,):
+                return table
+        except (OSError, ValueError):
+            pass
+        table = self.compute(self.longitude, self.gmt_off, self.year, self.method)
+        try:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            # write and rename, a power cut never leaves half a table behind
+            tmp = self.cache_path() + '.tmp'
+            with open(tmp, 'wb') as f:
+                np.save(f, table)
+            os.replace(tmp, self.cache_path())
+        except OSError:
+            print("Could not cache solar noon table in " + self.cache_dir)
+        return table
+
+    # solar noon in minutes for days 1 to 366 of the year (index 0 unused, day 366 of a common year is Jan 1st after)
+    @staticmethod
+    def compute(longitude, gmt_off, year, method='simple'):
+        day = np.arange(367, dtype=np.float64)
+        if method == 'noaa':
+            # NOAA solar position spreadsheet (Meeus), equation of time at local noon of every day
+            # julian centuries since J2000.0 (Jan 1st 2000 12:00 UT)
+            j2000 = datetime.date(year, 1, 1).toordinal() - datetime.date(2000, 1, 1).toordinal()
+            T = (j2000 + day - 1 - gmt_off / 24.0) / 36525.0
+            L0 = np.deg2rad(np.mod(280.46646 + T * (36000.76983 + T * 0.0003032), 360))
+            M = np.deg2rad(357.52911 + T * (35999.05029 - 0.0001537 * T))
+            e = 0.016708634 - T * (0.000042037 + 0.0000001267 * T)
+            eps0 = 23 + (26 + (21.448 - T * (46.815 + T * (0.00059 - T * 0.001813))) / 60) / 60
+            eps = np.deg2rad(eps0 + 0.00256 * np.cos(np.deg2rad(125.04 - 1934.136 * T)))
+            y = np.tan(eps / 2) ** 2
+            eot = 4 * np.rad2deg(y * np.sin(2 * L0) - 2 * e * np.sin(M) + 4 * e * y * np.sin(M) * np.cos(2 * L0)
+                                 - 0.5 * y * y * np.sin(4 * L0) - 1.25 * e * e * np.sin(2 * M))
+            return 720 - 4 * longitude + 60 * gmt_off - eot
         # implementation adapted from https://sciencing.com/calculate-solar-time-8612288.html
-        A = 15 * self.gmt_off
-        B = (dt.tm_yday - 81) * 360 / 365
-        C = 9.87 * sin(deg2rad(2 * B)) - 7.53 * cos(deg2rad(B)) - 1.58 * sin(deg2rad(B))
-        D = 4 * (A - self.longitude) + C
-        # return solar time offset in minutes based on 12pm
+        A = 15 * gmt_off
+        B = np.deg2rad((day - 81) * 360 / 365)
+        C = 9.87 * np.sin(2 * B) - 7.53 * np.cos(B) - 1.58 * np.sin(B)
+        D = 4 * (A - longitude) + C
+        # solar time offset in minutes based on 12pm
         return D + 720
+
+    # solar noon in minutes for the date of dt, tm_yday is worked out from the date when the clock left it unset
+    def noon(self, dt):
+        day = dt.tm_yday
+        if not 0 < day < 367:
+            day = datetime.date(dt.tm_year, dt.tm_mon, dt.tm_mday).timetuple().tm_yday
+        return self.noon_list[day]
     
+
+
+'''
+Event Scheduler class
+Functionality:
+1) Compiles the schedule of every EDS panel (fixed minutes and 'SN' solar noon) into a sorted timeline of the day's events
+2) Adds the noon measurement only sweep to the timeline
+3) Every event is a deadline, a job held up by a slow sweep still runs late within the grace window
+4) Hands out the run queue of due jobs in priority order (earliest planned start first) and how long the loop can sleep
+5) Records planned vs actual start time of every event in SCHEDULE_LOG_PATH and the log
+'''
+class EventScheduler:
+    HEADER = ['Date', 'Event', 'Panel', 'Planned', 'Actual', 'Delay(min)', 'Status']
+
+    def __init__(self, panel_data, eds_ids, longitude, gmt_off, solar_method='simple', grace_minutes=0, log=None):
+        self.panel_data = panel_data
+        self.eds_ids = eds_ids
+        self.longitude = longitude
+        self.gmt_off = gmt_off
+        self.solar_method = solar_method
+        # how many minutes after its scheduled window a job may still start
+        self.grace = grace_minutes
+        self.log = log
+        # date the timeline was compiled for
+        self.day = None
+        self.events = []
+
+    # build the timeline for the day of dt, events start from 'start' (minutes of the day) and may run until 'deadline'
+    def compile(self, dt):
+        # jobs left over from the previous day never ran
+        for event in self.events:
+            if not event['fired']:
+                self.finish(event, None, 'missed')
+        self.day = tuple(dt[0:3])
+        # measurement only sweep, 12:00 and 12:01
+        self.events = [self.event(720, 720, 721, 'noon', None)]
+        for eds in self.eds_ids:
+            panel = ScheduleMaster(eds, self.panel_data[eds]['frequency'], self.panel_data[eds]['schedule'],
+                                   self.longitude, self.gmt_off, self.solar_method)
+            for schedule in panel.schedule_time:
+                # same windows as ScheduleMaster.check_time, within 1 min of the scheduled time
+                if schedule.lower() == 'sn':
+                    solar_noon_min = panel.get_solar_time(dt)
+                    self.events.append(self.event(solar_noon_min, floor(solar_noon_min - 1) + 1,
+                                                  ceil(solar_noon_min + 1) - 1, 'activation', eds))
+                else:
+                    self.events.append(self.event(int(schedule), int(schedule), int(schedule), 'activation', eds))
+        # priority order, sort keeps the panel order for events at the same minute
+        self.events.sort(key=lambda event: event['start'])
+
+    def event(self, planned, start, end, kind, panel):
+        return {'planned': planned, 'start': start, 'end': end, 'deadline': end + self.grace, 'kind': kind,
+                'panel': panel, 'fired': False}
+
+    def check_day(self, dt):
+        if self.day != tuple(dt[0:3]):
+            self.compile(dt)
+
+    # run queue, jobs whose start has come and whose deadline has not passed, in priority order
+    def due(self, dt):
+        self.check_day(dt)
+        minute = dt.tm_hour * 60 + dt.tm_min
+        queue = []
+        for event in self.events:
+            if event['fired'] or event['start'] > minute:
+                continue
+            if self.expired(event, dt):
+                self.finish(event, dt, 'missed')
+            else:
+                queue.append(event)
+        return queue
+
+    # True once the grace window of the event is over
+    def expired(self, event, dt):
+        return dt.tm_hour * 60 + dt.tm_min > event['deadline']
+
+    # mark an event handled (not due again today) and record when it started, status 'run', 'frequency', 'night' or 'missed'
+    def finish(self, event, dt, status):
+        event['fired'] = True
+        planned = event['planned']
+        record = [str(self.day[1]) + '/' + str(self.day[2]) + '/' + str(self.day[0]), event['kind'], event['panel'] or '',
+                  self.clock_text(planned * 60)]
+        if dt is None or status == 'missed':
+            record += ['', '', status]
+            phrase = "Schedule: " + event['kind'] + " " + (event['panel'] or '') + " planned " + record[3] + " was missed"
+        else:
+            actual = dt.tm_hour * 3600 + dt.tm_min * 60 + dt.tm_sec
+            delay = round((actual - planned * 60) / 60, 2)
+            record += [self.clock_text(actual), str(delay), status]
+            phrase = ("Schedule: " + event['kind'] + " " + (event['panel'] or '') + " planned " + record[3]
+                      + ", started " + record[4] + " (" + str(delay) + " min), " + status)
+        self.write_record(record)
+        if self.log is not None:
+            self.log(phrase, 'WARNING' if status == 'missed' else 'INFO')
+        return record
+
+    @staticmethod
+    def clock_text(seconds):
+        seconds = int(round(seconds))
+        return str(seconds // 3600) + ':' + str(seconds // 60 % 60) + ':' + str(seconds % 60)
+
+    # one row per event in the schedule record, a few rows a day
+    def write_record(self, record):
+        try:
+            new = not path.exists(SCHEDULE_LOG_PATH)
+            with open(SCHEDULE_LOG_PATH, 'a') as f:
+                if new:
+                    f.write(','.join(self.HEADER) + '\n')
+                f.write(','.join(record) + '\n')
+        except (IOError, OSError):
+            print("Could not write the schedule record to " + SCHEDULE_LOG_PATH)
+
+    # seconds from dt to the start of the next event, or to midnight when the day has no more events
+    def seconds_until_next(self, dt):
+        self.check_day(dt)
+        minute = dt.tm_hour * 60 + dt.tm_min
+        now = minute * 60 + dt.tm_sec
+        for event in self.events:
+            if not event['fired'] and event['start'] > minute:
+                return event['start'] * 60 - now
+        return 24 * 60 * 60 - now
@@ -7,16 +7,14 @@ Version 2 (All in one Motherboard)
 =============================
 '''
 
-import RPi.GPIO as GPIO
+from HardwareManager import GPIO, SystemClock
 import time
 import math
 import os
 import subprocess
-import busio
-import digitalio
-import board
-import adafruit_mcp3xxx.mcp3008 as MCP 
-from adafruit_mcp3xxx.analog_in import AnalogIn
+import numpy as np
+import MCP3008
+import DataManager as DM
 
 # year days for start of each month (because the clock doesn't want to keep tm_yday for some reason)
 # don't care about leap year
@@ -26,6 +24,15 @@ Y_DAYS = [0, 31, 59, 90, 120, 151, 181, 212, 243, 273, 304, 334]
 T_TOL = 0.1
 H_TOL = 0.1
 
+# MCP3008 channel the PV voltage divider / shunt is wired to (MCP.P0)
+PV_CHANNEL = 0
+
+# ADC correction constants
+VOC_CORRECTION = 1.347213 # Motherboard throughhole revision # 1.0520(M1), 1.7369(M2)
+ISC_CORRECTION = 1.4517 #Motherboard Through hole adc revision # 1.5674(M1), 1.5927(M2)
+R2 = 5.6 #Resistor 2 value in Megaohms in Voltage divider circuit
+R1 = 1 #Resistor 1 value in Megaohms Voltage divider circuit
+
 '''
 ADC Master Class:
 Functionality:
@@ -36,36 +43,96 @@ Functionality:
 '''
 
 class ADCMaster:
-    def __init__(self):
+    def __init__(self, session=None, clock=None):
         #GPIO pin to trigger the relay, high is OCV, low is SCC
         GPIO.setup(25, GPIO.OUT)
+        # one SPI/MCP3008 session kept open for every reading
+        if session is None:
+            session = MCP3008.ADCSession()
+        self.session = session
+        # hardware clock (HardwareManager.SystemClock or SimulatedClock) for the settle waits
+        self.clock = SystemClock() if clock is None else clock
+
+    # explicit close, the session re-opens itself on the next reading
+    def close(self):
+        self.session.close()
+
+    def reopen(self):
+        self.session.reopen()
         
-    def get_ocv_PV(self):
-        spi = busio.SPI(clock=board.SCK, MISO=board.MISO, MOSI=board.MOSI)
-        cs = digitalio.DigitalInOut(board.D18)
-        mcp = MCP.MCP3008(spi, cs)
-        chan=AnalogIn(mcp, MCP.P0)
-        raw = chan.voltage
-        print('PV Raw volt read: ' + str(raw) + '[V]')
-        #correction constant
-        correction_voc = 1.347213 # Motherboard throughhole revision # 1.0520(M1), 1.7369(M2)
-        R2 = 5.6 #Resistor 2 value in Megaohms in Voltage divider circuit
-        R1 = 1 #Resistor 1 value in Megaohms Voltage divider circuit
+    # convert raw ADC volts to panel Voc, works on single readings and numpy arrays
+    def ocv_from_raw(self, raw):
         VDC = (R2 + R1) / R1
         # Since we divided voltage by 11, multiply by 11 to get actual Voc
-        return raw * VDC * correction_voc
+        return raw * VDC * VOC_CORRECTION
+
+    # convert raw ADC volts to panel Isc
+    def scc_from_raw(self, raw):
+        #SCC = Voc x 1 Ohm
+        return raw * 1 * ISC_CORRECTION
+
+    def get_ocv_PV(self):
+        raw = self.session.read_voltage(PV_CHANNEL)
+        print('PV Raw volt read: ' + str(raw) + '[V]')
+        return self.ocv_from_raw(raw)
     
     def get_scc_PV(self):
-        spi = busio.SPI(clock=board.SCK, MISO=board.MISO, MOSI=board.MOSI)
-        cs = digitalio.DigitalInOut(board.D18)
-        mcp = MCP.MCP3008(spi, cs)
-        chan=AnalogIn(mcp, MCP.P0)
-        raw = chan.voltage
+        raw = self.session.read_voltage(PV_CHANNEL)
         print('PV Raw curr read: ' + str(raw) + '[A]')
-        #correction constant
-        correction_isc = 1.4517 #Motherboard Through hole adc revision # 1.5674(M1), 1.5927(M2)
-        #SCC = Voc x 1 Ohm
-        return raw * 1 * correction_isc
+        return self.scc_from_raw(raw)
+
+    # poll the ADC until successive readings agree within tolerance [V] or timeout [s] runs out
+    # returns [seconds waited, True if settled]
+    def wait_settled(self, tolerance, timeout, poll, stable_reads=3):
+        start = self.clock.monotonic()
+        last = self.session.read_voltage(PV_CHANNEL)
+        stable = 0
+        while True:
+            self.clock.sleep(poll)
+            reading = self.session.read_voltage(PV_CHANNEL)
+            elapsed = self.clock.monotonic() - start
+            if abs(reading - last) <= tolerance:
+                stable += 1
+                if stable >= stable_reads:
+                    return [round(elapsed, 3), True]
+            else:
+                stable = 0
+            if elapsed >= timeout:
+                print("ADC did not settle within " + str(timeout) + " s, reading anyway")
+                return [round(elapsed, 3), False]
+            last = reading
+
+    # oversampled Voc, N readings in one burst summarized into statistics
+    def get_ocv_burst(self, samples):
+        raw = self.session.read_burst(PV_CHANNEL, samples)
+        return self.burst_stats(self.ocv_from_raw(raw))
+
+    # oversampled Isc, N readings in one burst summarized into statistics
+    def get_scc_burst(self, samples):
+        raw = self.session.read_burst(PV_CHANNEL, samples)
+        return self.burst_stats(self.scc_from_raw(raw))
+
+    @staticmethod
+    def burst_stats(values):
+        return {
+            'mean': float(np.mean(values)),
+            'median': float(np.median(values)),
+            'std': float(np.std(values)),
+            'min': float(np.min(values)),
+            'max': float(np.max(values)),
+            'n': int(values.size)
+        }
+
+    # scale every value statistic by a constant (sample count unchanged)
+    @staticmethod
+    def scale_stats(stats, factor):
+        scaled = {}
+        for key in stats:
+            if key == 'n':
+                scaled[key] = stats[key]
+            else:
+                scaled[key] = stats[key] * factor
+        return scaled
 
 '''
 Testing Master Class:
@@ -77,10 +144,18 @@ Functionality:
 
 class TestingMaster:
     
-    def __init__(self, config_dictionary):
+    def __init__(self, config_dictionary, adc_master=None, clock=None):
         self.okay_to_test = False
         self.test_config = config_dictionary
-        self.adc_m = ADCMaster()
+        # hardware clock for the relay delays, shared with the activation jobs
+        self.clock = SystemClock() if clock is None else clock
+        # share the ADC session with MasterManager so the bus is only opened once
+        if adc_master is None:
+            adc_master = ADCMaster(clock=self.clock)
+        self.adc_m = adc_master
+        # statistics and relay settle times of the most recent Voc/Isc measurement
+        self.last_stats = None
+        self.last_settle = None
         
     # simple getter for config dictionary
     def get_config(self):
@@ -94,10 +169,27 @@ class TestingMaster:
     def get_pin(self, key):
         return int(self.test_config[key])
 
+    # statistics ({'ocv':..., 'scc':...}) of the last run_measure_EDS/run_measure_CTRL
+    def get_last_stats(self):
+        return self.last_stats
+
+    # take the Voc or Isc reading, oversampled if adcBurstSamples is more than 1
+    def read_ocv(self):
+        samples = int(self.test_config.get('adcBurstSamples', 1))
+        if samples > 1:
+            return self.adc_m.get_ocv_burst(samples)
+        return self.adc_m.burst_stats(np.array([self.adc_m.get_ocv_PV()]))
+
+    def read_scc(self):
+        samples = int(self.test_config.get('adcBurstSamples', 1))
+        if samples > 1:
+            return self.adc_m.get_scc_burst(samples)
+        return self.adc_m.burst_stats(np.array([self.adc_m.get_scc_PV()]))
+
     # check weather against parameters
     def check_temp(self, t_curr):
         # check if the sensor is working
-        if t_curr == 'Error':
+        if t_curr is None:
             print("Temperature Sensor is not working, resume measurement without temperature values")
             return True
         else:
@@ -112,7 +204,7 @@ class TestingMaster:
         
     def check_humid(self, h_curr):
         # check if humidity sensor is working
-        if h_curr == 'Error':
+        if h_curr is None:
             print("Humidity Sensor is not working, resume measurement without humidity values")
             return True
         else:
@@ -128,97 +220,83 @@ class TestingMaster:
     # Activating all EDS panels during noon time
     def activate_eds(self, eds_ids):
         #  main test sequence to be run after checking flags in MasterManager
-        eds_duration = self.get_param('testDurationSeconds')
         # run first half of activation for all EDS panels
+        jobs = []
         for eds_num in eds_ids:
-            self.run_test_begin(eds_num)
-        # wait for EDS to activate
-        time.sleep(eds_duration)
-        # run second half to turn off EDS
-        for eds_num in eds_ids:
-            self.run_test_end(eds_num)
+            jobs.append(self.start_activation(eds_num))
+        # wait for EDS to activate, then run second half to turn off EDS
+        for job in jobs:
+            job.wait()
 
     # Activating selected EDS panel
     def activate_panel_eds(self, panel):
         #  main test sequence to be run after checking flags in MasterManager
-        eds_duration = self.get_param('testDurationSeconds')
-        # run first half of activation for desired eds panel
-        self.run_test_begin(panel)
-        # wait for EDS to activate
-        time.sleep(eds_duration)
-        # run second half to turn off EDS
-        self.run_test_end(panel)
+        self.start_activation(panel).wait()
     
     # Activating EDS to repel soiling/dust/etc
     def run_test(self, eds_num):
         #  main test sequence to be run after checking flags in MasterManager
-        test_duration = self.get_param('testDurationSeconds')
-        # run first half of test
-        self.run_test_begin(eds_num)
-        # wait for test duration
-        time.sleep(test_duration)
-        # run second half of test
-        self.run_test_end(eds_num)
+        self.start_activation(eds_num).wait()
+
+    # non-blocking activation, energizes the EDS and returns a job to poll and finish
+    def start_activation(self, eds_num):
+        job = ActivationJob(self, eds_num, self.get_param('testDurationSeconds'))
+        job.start()
+        return job
 
     # Measure Voc and Isc of EDS panel
     def run_measure_EDS(self, eds_num):
         # Get pin for PV relay
         pv_relay = self.get_pin('EDS' + str(eds_num) + 'PV')
-        # Setup GPIO pins to measure Voc and Isc of desired panel
-        GPIO.setup(pv_relay, GPIO.OUT)
-        GPIO.setup(self.get_pin('ADC'), GPIO.OUT)
-        time.sleep(0.5)
-        # OCV READ
-        # Switch the relay to read Voc
-        GPIO.setup(self.get_pin('ADC'), GPIO.IN)
-        time.sleep(0.5)
-        # Get reading
-        read_ocv = self.adc_m.get_ocv_PV()
-        # SCC READ
-        # Switch relay to read Isc
-        GPIO.setup(self.get_pin('ADC'), GPIO.OUT)
-        time.sleep(0.5)
-        # get reading
-        read_scc = self.adc_m.get_scc_PV()
-        # Default pin is LOW, no need to switch, just clean up
-        time.sleep(0.5)
-        GPIO.cleanup(self.get_pin('ADC'))
-        #GPIO.cleanup(25)
-        # Close EDS PV Relay
-        time.sleep(0.5)
-        GPIO.cleanup(pv_relay)
-        time.sleep(0.5)
-        # round the measurement results
-        return [round(read_ocv,2), round(read_scc,2)]
+        return self.run_measure_panel(pv_relay, 1)
     
     def run_measure_CTRL(self, ctrl_num):
         # Get pin for PV relay
         pv_relay = self.get_pin('CTRL' + str(ctrl_num) + 'PV')
+        return self.run_measure_panel(pv_relay, 100)
+
+    # relay sequence shared by EDS and CTRL panels, Isc is multiplied by scc_scale
+    def run_measure_panel(self, pv_relay, scc_scale):
+        break_delay = self.get_param('relayBreakSeconds')
         # Setup GPIO pins to measure Voc and Isc of desired panel
         GPIO.setup(pv_relay, GPIO.OUT)
         GPIO.setup(self.get_pin('ADC'), GPIO.OUT)
-        time.sleep(0.5)
+        self.clock.sleep(break_delay)
         # OCV READ
-        # Switch the relay to read Voc
+        # Switch the relay to read Voc, wait for the reading to settle
         GPIO.setup(self.get_pin('ADC'), GPIO.IN)
-        time.sleep(0.5)
+        ocv_settle = self.wait_settled()
         # Get reading
-        read_ocv = self.adc_m.get_ocv_PV()
+        ocv_stats = self.read_ocv()
         # SCC READ
-        # Switch relay to read Isc
+        # Switch relay to read Isc, wait for the reading to settle
         GPIO.setup(self.get_pin('ADC'), GPIO.OUT)
-        time.sleep(0.5)
+        scc_settle = self.wait_settled()
         # get reading
-        read_scc = self.adc_m.get_scc_PV()
+        scc_stats = self.read_scc()
         # Default pin is LOW, no need to switch, just clean up
-        time.sleep(0.5)
         GPIO.cleanup(self.get_pin('ADC'))
-        # Close EDS PV Relay
-        time.sleep(0.5)
+        # Close PV Relay
+        self.clock.sleep(break_delay)
         GPIO.cleanup(pv_relay)
-        time.sleep(0.5)
+        self.clock.sleep(break_delay)
+        # keep the burst statistics and settle times for the caller
+        if scc_scale != 1:
+            scc_stats = self.adc_m.scale_stats(scc_stats, scc_scale)
+        self.last_stats = {'ocv': ocv_stats, 'scc': scc_stats}
+        self.last_settle = {'ocv': ocv_settle, 'scc': scc_settle}
         # round the measurement results
-        return [round(read_ocv,2), round(read_scc*100,2)]
+        return [round(ocv_stats['mean'],2), round(scc_stats['mean'],2)]
+
+    # wait for the ADC after a relay switch using the settle parameters from the config
+    def wait_settled(self):
+        return self.adc_m.wait_settled(self.get_param('settleToleranceVolts'),
+                                       self.get_param('settleTimeoutSeconds'),
+                                       self.get_param('settlePollSeconds'))
+
+    # settle times ({'ocv': [seconds, settled], 'scc': [seconds, settled]}) of the last panel measured
+    def get_last_settle(self):
+        return self.last_settle
 
     def run_test_begin(self, eds_num):
         # runs the first half of a test (pauses on test duration to allow for indefinite testing)
@@ -227,7 +305,7 @@ class TestingMaster:
         GPIO.setup(eds_select, GPIO.OUT)
         GPIO.output(eds_select, GPIO.HIGH)
         # short delay between relay switching
-        time.sleep(0.5)
+        self.clock.sleep(0.5)
 
     def run_test_end(self, eds_num):
         # runs the second half of a test to finish from first half
@@ -236,7 +314,51 @@ class TestingMaster:
         # deactivate the EDS
         GPIO.output(eds_select, GPIO.LOW)
         GPIO.cleanup(eds_select)
-        time.sleep(0.5)
+        self.clock.sleep(0.5)
+
+'''
+Activation Job Class:
+Functionality:
+1) Switches an EDS film on (run_test_begin) and remembers when it started
+2) Lets the caller keep working while the film is energized
+3) Switches the film off (run_test_end) exactly once when finished
+'''
+
+class ActivationJob:
+    def __init__(self, test_master, eds_num, duration):
+        self.test_master = test_master
+        self.eds_num = eds_num
+        self.duration = duration
+        self.start_time = None
+        self.end_time = None
+
+    def start(self):
+        # runs the first half of the test
+        self.test_master.run_test_begin(self.eds_num)
+        self.start_time = self.test_master.clock.monotonic()
+
+    # seconds left until the activation duration has passed
+    def remaining(self):
+        if self.start_time is None:
+            return self.duration
+        return max(0.0, self.duration - (self.test_master.clock.monotonic() - self.start_time))
+
+    def is_done(self):
+        return self.start_time is not None and self.remaining() <= 0
+
+    def is_finished(self):
+        return self.end_time is not None
+
+    def finish(self):
+        # runs the second half of the test, safe to call more than once (e.g. from a finally block)
+        if self.start_time is not None and self.end_time is None:
+            self.test_master.run_test_end(self.eds_num)
+            self.end_time = self.test_master.clock.monotonic()
+
+    def wait(self):
+        # blocking version, sleeps out the rest of the activation then finishes
+        self.test_master.clock.sleep(self.remaining())
+        self.finish()
 
 '''
 Power Master Class:
@@ -262,7 +384,7 @@ class PowerMaster:
 
     def get_power_out(self,v_oc,i_sc,temp):
         # manage if temperature sensor is not working
-        if temp == 'Error':
+        if temp is None:
             p_out = v_oc * i_sc
             return round(p_out,2)
         else:
@@ -293,8 +415,8 @@ class PowerMaster:
     
     def get_panel_temp(self,amb_temp, g_poa):
         # manage if temperature sensor is not working
-        if amb_temp == 'Error':
-            return 'Error'
+        if amb_temp is None:
+            return None
         else:
             noct = 47 #This needs to be confirmed
             t_pan = amb_temp + ((noct - 20)*g_poa)/800
@@ -343,4 +465,141 @@ class Soiling:
             return round(SI,2)
         else:
             SI = (isc_soiled/gpoa)/(self.isc_clean/self.irr_clean)
-            return round(SI,2)
\ No newline at end of file
+            return round(SI,2)
+
+'''
+Sweep Master Class:
+Functionality:
+1) Reads irradiance and weather once at the start and once at the end of a sweep
+   (irradiance comes from the background sampler instead when one is running)
+2) Measures Voc and Isc of a list of panels back to back through the relay mux
+3) Computes power, PR and SI and returns one batch of panel records
+'''
+class SweepMaster:
+    def __init__(self, test_master, pow_master, pr_master, soil_master, clock=time.localtime, log=print, sampler=None):
+        self.test_master = test_master
+        self.pow_master = pow_master
+        self.pr_master = pr_master
+        self.soil_master = soil_master
+        # clock() gives the struct_time stamped on each record, log(phrase) reports progress
+        self.clock = clock
+        self.log = log
+        # optional SP420.IrradianceSampler, tags each panel with the irradiance during its ADC window
+        self.sampler = sampler
+
+    # measure a list of panel ids, stage is 'pre' or 'post' for EDS panels (CTRL panels are always 'pre')
+    # records maps panel ids to records from an earlier sweep, those are filled in place
+    def run_sweep(self, panel_ids, panel_data, irr_master, weather, stage='pre', records=None):
+        if records is None:
+            records = {}
+        # bracket the sweep with irradiance and weather readings
+        use_sampler = self.sampler is not None and self.sampler.is_running()
+        if not use_sampler:
+            g_start = irr_master.get_irradiance()
+        w_start = weather.read_humidity_temperature_time()
+        readings = []
+        for panel_id in panel_ids:
+            record = records.get(panel_id)
+            if record is None:
+                # fresh record every sweep so values never leak between sweeps
+                record = DM.PanelRecord.from_template(panel_data[panel_id])
+            panel_stage = stage if record.type == 'eds' else 'pre'
+            self.log("Measuring " + panel_id + " panel (" + panel_stage + ")")
+            if panel_stage == 'pre':
+                record.date_time = self.clock()
+            # wall clock window of the ADC readings, matches the sampler timestamps
+            window_start = self.test_master.clock.time()
+            measured = self.measure_panel(record)
+            measured['window'] = [window_start, self.test_master.clock.time()]
+            readings.append([panel_id, record, panel_stage, measured])
+        w_end = weather.read_humidity_temperature_time()
+        humid = self.bracket_mean(w_start[0], w_end[0])
+        amb_temp = self.bracket_mean(w_start[1], w_end[1])
+        # time of the newest weather reading used, cached readings can be older than the sweep
+        weather_times = [w[2] for w in [w_start, w_end] if w[2] is not None]
+        weather_dt = time.localtime(max(weather_times)) if weather_times else None
+        if use_sampler:
+            sweep_gpoa = self.sampler.mean_between(readings[0][3]['window'][0], readings[-1][3]['window'][1])
+            self.log("GPOA Irradiance for sweep: " + str(sweep_gpoa) + " (background sampler)")
+        else:
+            g_end = irr_master.get_irradiance()
+            sweep_gpoa = self.bracket_mean(g_start, g_end)
+            self.log("GPOA Irradiance for sweep: " + str(sweep_gpoa) + " (start " + str(g_start) + ", end " + str(g_end) + ")")
+        batch = []
+        for [panel_id, record, panel_stage, measured] in readings:
+            if panel_stage == 'pre':
+                # irradiance during this panel's own ADC window when the sampler has it
+                g_poa = None
+                if use_sampler:
+                    g_poa = self.sampler.mean_between(measured['window'][0], measured['window'][1])
+                if g_poa is None:
+                    g_poa = sweep_gpoa if sweep_gpoa is not None else -1
+                record.gpoa = g_poa
+                record.temp = self.pow_master.get_panel_temp(amb_temp, g_poa)
+                record.humid = humid
+                record.weather_dt = weather_dt
+            self.compute_results(panel_id, record, panel_stage, measured)
+            batch.append(record)
+        return batch
+
+    # read Voc and Isc of one panel through its PV relay
+    def measure_panel(self, record):
+        if record.type == 'eds':
+            [ocv, scc] = self.test_master.run_measure_EDS(record.num)
+        else:
+            [ocv, scc] = self.test_master.run_measure_CTRL(record.num)
+        return {
+            'ocv': ocv,
+            'scc': scc,
+            'stats': self.test_master.get_last_stats(),
+            'settle': self.test_master.get_last_settle()
+        }
+
+    # fill Voc, Isc, power, PR and SI of one stage into the record
+    def compute_results(self, panel_id, record, stage, measured):
+        ocv = measured['ocv']
+        scc = measured['scc']
+        g_poa = record.gpoa
+        pan_temp = record.temp
+        power = self.pow_master.get_power_out(ocv, scc, pan_temp)
+        pr = self.pr_master.get_pr(ocv, scc, pan_temp, power, g_poa)
+        si = self.soil_master.get_si(scc, g_poa)
+        # uncertainty of the oversampled readings
+        ocv_std = round(measured['stats']['ocv']['std'], 4)
+        scc_std = round(measured['stats']['scc']['std'], 4)
+        if stage == 'pre':
+            record.ocv_pre, record.scc_pre, record.pwr_pre, record.pr_pre, record.si_pre = ocv, scc, power, pr, si
+            record.ocv_pre_std, record.scc_pre_std = ocv_std, scc_std
+        else:
+            record.ocv_post, record.scc_post, record.pwr_post, record.pr_post, record.si_post = ocv, scc, power, pr, si
+            record.ocv_post_std, record.scc_post_std = ocv_std, scc_std
+        record.samples = measured['stats']['ocv']['n']
+        label = stage.upper()
+        self.log(label + " EDS OCV for " + panel_id + ": " + str(ocv))
+        self.log(label + " EDS SCC for " + panel_id + ": " + str(scc))
+        self.log(label + " EDS Power for " + panel_id + ": " + str(power))
+        self.log(label + " EDS PR for " + panel_id + ": " + str(pr))
+        self.log(label + " EDS SI for " + panel_id + ": " + str(si))
+        settle = measured['settle']
+        phrase = "Relay settle time for " + panel_id + ": Voc " + str(settle['ocv'][0]) + " s, Isc " + str(settle['scc'][0]) + " s"
+        if not (settle['ocv'][1] and settle['scc'][1]):
+            phrase += " (timed out)"
+        self.log(phrase)
+
+    # mark an EDS record as measurement only, no activation so no post values
+    @staticmethod
+    def no_post(record):
+        for key in ['ocv_post', 'scc_post', 'pwr_post', 'pr_post', 'si_post', 'ocv_post_std', 'scc_post_std']:
+            setattr(record, key, 'N/A')
+
+    # average of the readings at the start and end of a sweep, skipping failed sensor reads
+    @staticmethod
+    def bracket_mean(start, end):
+        valid = []
+        for value in [start, end]:
+            # None from a failed AM2315 read, -1 from a missing pyranometer
+            if value is not None and value != -1:
+                valid.append(value)
+        if not valid:
+            return start
+        return round(sum(valid) / len(valid), 3)
@@ -0,0 +1,106 @@
+import os
+import sys
+import json
+import time
+import shutil
+import random
+import signal
+import tempfile
+import subprocess
+
+# run from anywhere, the static manager lives in the main directory
+MAIN_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.append(MAIN_DIR)
+import StaticManager as SM
+
+# Crash consistency of eds.json. A writer process flips the activation state of the EDS as fast as it can
+# and is killed (SIGKILL) at a random moment, then eds.json is checked. Done for the ActivationStore
+# (write to a temp file and rename) and for the old way (open 'w+' and json.dump over the file).
+# usage: python3 activation_store_test.py [rounds]
+
+ROUNDS = int(sys.argv[1]) if len(sys.argv) > 1 else 100
+
+STORE_WRITER = '''
+import sys, time
+sys.path.append(sys.argv[2])
+import StaticManager as SM
+store = SM.ActivationStore(sys.argv[1])
+store.load(time.localtime())
+print("ready", flush=True)
+n = 0
+while True:
+    n += 1
+    store.update(SM.ActivationStore.EDS_NAMES[n % 5], time.localtime(), n % 2 == 0, time.localtime())
+'''
+
+OLD_WRITER = '''
+import sys, json, time
+state = {name: {'is_activated': False, 'record_dt': list(time.localtime())} for name in ['eds1', 'eds2', 'eds3', 'eds4', 'eds5']}
+with open(sys.argv[1], 'w+') as file:
+    json.dump(state, file)
+print("ready", flush=True)
+n = 0
+while True:
+    n += 1
+    with open(sys.argv[1], 'r') as file:
+        state = json.load(file)
+    state['eds' + str(n % 5 + 1)].update({'is_activated': n % 2 == 0, 'record_dt': list(time.localtime())})
+    with open(sys.argv[1], 'w+') as file:
+        json.dump(state, file)
+'''
+
+
+# True if the file holds the state of every EDS
+def intact(json_path):
+    try:
+        with open(json_path, 'r') as file:
+            state = json.load(file)
+        return all(name in state for name in SM.ActivationStore.EDS_NAMES)
+    except (IOError, OSError, ValueError):
+        return False
+
+
+def crash_test(name, writer):
+    json_path = os.path.join(tempfile.mkdtemp(prefix='eds_json_'), 'eds.json')
+    broken = 0
+    for _ in range(ROUNDS):
+        proc = subprocess.Popen([sys.executable, '-c', writer, json_path, MAIN_DIR], stdout=subprocess.PIPE)
+        proc.stdout.readline()
+        time.sleep(random.uniform(0, 0.02))
+        proc.send_signal(signal.SIGKILL)
+        proc.wait()
+        proc.stdout.close()
+        if not intact(json_path):
+            broken += 1
+            # start the next round from a good file, like the old blank json recovery
+            os.remove(json_path)
+    print(name + ": eds.json broken after " + str(broken) + " of " + str(ROUNDS) + " kills")
+    return broken
+
+
+store_broken = crash_test("ActivationStore (write and rename)", STORE_WRITER)
+old_broken = crash_test("Old writer (open w+ and dump)", OLD_WRITER)
+
+# a kill can leave eds.json.tmp behind, the next load must still work and ignore it
+json_path = os.path.join(tempfile.mkdtemp(prefix='eds_json_'), 'eds.json')
+store = SM.ActivationStore(json_path)
+store.load(time.localtime())
+with open(json_path + '.tmp', 'w') as f:
+    f.write('{"eds1": {"is_act')
+reloaded = SM.ActivationStore(json_path)
+print("Load with a torn eds.json.tmp left behind: " + str(not reloaded.load(time.localtime())))
+
+# frequency checks from a fresh eds_bones.json write eds.json once, for the first activation
+shutil.copy(os.path.join(MAIN_DIR, 'eds_bones.json'), json_path)
+store = SM.ActivationStore(json_path)
+store.load(time.localtime())
+writes = store.writes
+panel = SM.ScheduleMaster('eds3', 1, ['730'], -71.05, -5, store=store)
+dt = time.localtime()
+start = time.perf_counter()
+for _ in range(1000):
+    panel.check_frequency('eds3', dt)
+end = time.perf_counter()
+print("1000 frequency checks: " + str(store.writes - writes) + " eds.json writes, "
+      + str(round((end - start) * 1000, 2)) + " ms")
+print("PASS" if store_broken == 0 else "FAIL")
@@ -0,0 +1,41 @@
+import os
+import sys
+import time
+
+# run from anywhere, the ADC module lives in the main directory
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import MCP3008
+
+# Compares the old per-reading bus setup against one persistent ADC session.
+# Runs on a plain Linux box with the simulated SPI backend, no RasPi needed.
+
+READS = 200         # readings per run, one sweep is 2 readings per panel
+OPEN_DELAY = 0.002  # simulated cost of busio.SPI + DigitalInOut + MCP3008 setup
+READ_DELAY = 0.0001 # simulated cost of one SPI transfer
+
+# old behaviour: new bus, chip select and chip for every reading
+backend = MCP3008.SimulatedSPI(open_delay=OPEN_DELAY, read_delay=READ_DELAY)
+start = time.perf_counter()
+for i in range(READS):
+    session = MCP3008.ADCSession(backend)
+    session.read_voltage(0)
+    # the old code never released the handles, count them as leaked
+end = time.perf_counter()
+print("Per-read setup:     " + str(round((end - start) / READS * 1000, 3)) + " ms/read, bus opened " + str(backend.opens) + " times, closed " + str(backend.closes) + " times")
+
+# new behaviour: one session for the whole run
+backend = MCP3008.SimulatedSPI(open_delay=OPEN_DELAY, read_delay=READ_DELAY)
+start = time.perf_counter()
+with MCP3008.ADCSession(backend) as session:
+    for i in range(READS):
+        session.read_voltage(0)
+end = time.perf_counter()
+print("Persistent session: " + str(round((end - start) / READS * 1000, 3)) + " ms/read, bus opened " + str(backend.opens) + " times, closed " + str(backend.closes) + " times")
+
+# fault recovery: close the bus under the session, the next read should re-open it
+backend = MCP3008.SimulatedSPI()
+session = MCP3008.ADCSession(backend)
+session.read_voltage(0)
+backend.close()
+print("Read after fault:   " + str(round(session.read_voltage(0), 3)) + " V, bus opened " + str(backend.opens) + " times")
+session.close()
@@ -0,0 +1,54 @@
+import os
+import sys
+import time
+
+# run from anywhere, the sensor module lives in the main directory
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import AM2315
+
+# Benchmarks worst case AM2315 read latency with the fake I2C device, no sensor needed.
+# Uses the real wake/read delays, so expect this to take a minute.
+
+def run(name, device, reads):
+    sensor = AM2315.AM2315(i2c=AM2315.FakeI2C(device))
+    latencies = []
+    failures = {}
+    for i in range(reads):
+        reading = sensor.read()
+        latencies.append(reading.elapsed)
+        if not reading.ok:
+            failures[reading.error] = failures.get(reading.error, 0) + 1
+    latencies.sort()
+    print(name + ": mean " + str(round(sum(latencies) / reads, 3)) + " s, worst " + str(round(latencies[-1], 3))
+          + " s, failed reads " + str(failures) + ", status (good, bad, crc) " + str(sensor.read_status_info()))
+
+# the old _read_data retried 100 times at ~0.19 s each on I2C errors
+print("Old worst case: " + str(round(100 * (AM2315.WAKE_DELAY + AM2315.READ_DELAY + 0.01), 1)) + " s")
+
+run("Healthy sensor", AM2315.FakeI2CDevice(seed=1), 20)
+run("30% CRC errors", AM2315.FakeI2CDevice(crc_error_rate=0.3, seed=2), 20)
+run("30% timeouts", AM2315.FakeI2CDevice(timeout_rate=0.3, timeout_delay=0.01, seed=3), 20)
+run("Dead sensor", AM2315.FakeI2CDevice(timeout_rate=1.0, timeout_delay=0.01, seed=4), 5)
+
+# CRC speed, lookup table against the old bitwise loop
+def bitwise_crc(char):
+    crc = 0xFFFF
+    for l in char:
+        crc = crc ^ l
+        for i in range(1, 9):
+            if crc & 0x01:
+                crc = (crc >> 1) ^ 0xA001
+            else:
+                crc = crc >> 1
+    return crc
+
+frame = bytearray([0x03, 0x04, 0x01, 0xC2, 0x00, 0xD7])
+sensor = AM2315.AM2315(i2c=AM2315.FakeI2C(AM2315.FakeI2CDevice()))
+start = time.perf_counter()
+for i in range(10000):
+    bitwise_crc(frame)
+middle = time.perf_counter()
+for i in range(10000):
+    sensor.verify_crc(frame)
+end = time.perf_counter()
+print("CRC bitwise: " + str(round((middle - start) * 100, 2)) + " us, table: " + str(round((end - middle) * 100, 2)) + " us")
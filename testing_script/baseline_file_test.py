@@ -0,0 +1,80 @@
+import os
+import sys
+import csv
+import time
+import tempfile
+
+# run from anywhere, the data manager lives in the main directory
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+# no RasPi GPIO needed to write files
+os.environ.setdefault('EDS_HARDWARE', 'sim')
+import DataManager as DM
+import StaticManager as SM
+
+# Appends to data files started by the original code (16 column header, no Weather_Time, Seq or CRC32)
+# and checks every row still has the columns of its file's header and recover_data.py keeps all of them.
+# New files on an empty USB get the full header. Runs on any Linux machine, no USB needed.
+
+# header and first row as the original code wrote them
+BASELINE_CSV = DM.HEADER_CSV[:16]
+BASELINE_TXT = ' '.join(BASELINE_CSV)
+BASELINE_ROW = ['6/20/2026', '12:0:1', '30.1', '40.2', '990.0', 'EDS-PV1', '21.4', 'N/A', '0.68', 'N/A',
+                '13.8', 'N/A', '1.1', 'N/A', '1.0', 'N/A']
+
+
+def start_baseline_files(usb):
+    # eds_data.txt starts with the csv header, its rows are space delimited
+    for name in ['eds_data.csv', 'eds_data.txt', 'manual_data.csv']:
+        with open(os.path.join(usb, name), 'w') as f:
+            writer = csv.writer(f, delimiter=',', quotechar='"', quoting=csv.QUOTE_MINIMAL)
+            writer.writerow(BASELINE_CSV)
+            if name == 'eds_data.txt':
+                f.write(' '.join(BASELINE_ROW) + ' \n')
+            else:
+                writer.writerow(BASELINE_ROW if name == 'eds_data.csv' else BASELINE_ROW[:5] + ['1'] + BASELINE_ROW[6:])
+    with open(os.path.join(usb, 'manual_data.txt'), 'w') as f:
+        f.write(BASELINE_TXT + '\n')
+
+
+def write_rows(usb):
+    csv_master = DM.CSVMaster(usb)
+    records = []
+    for panel in SM.PANEL_DATA:
+        record = DM.PanelRecord.from_template(SM.PANEL_DATA[panel])
+        record.date_time = time.localtime()
+        records.append(record)
+    csv_master.write_batch(records)
+    csv_master.write_manual_rows([csv_master.data_row_manual(time.localtime(), 30.0, 40.0, 990.0, 1, 21.4, 21.5, 0.68, 0.69,
+                                                             [13.8, 13.9], [1.1, 1.1], [1.0, 1.0], time.localtime())])
+
+
+# rows with the wrong number of columns and the recovery summary of every data file
+def check(usb):
+    ok = True
+    for name in ['eds_data.csv', 'eds_data.txt', 'manual_data.csv', 'manual_data.txt']:
+        path = os.path.join(usb, name)
+        with open(path) as f:
+            lines = f.read().splitlines()
+        header = lines[0].split(',') if ',' in lines[0] else lines[0].split()
+        split = (lambda line: line.split()) if name.endswith('.txt') else (lambda line: line.split(','))
+        bad = [line for line in lines[1:] if len(split(line)) != len(header)]
+        result = DM.DataRecovery(path).scan()
+        print("  " + name + ": " + str(len(header)) + " columns, " + str(len(lines) - 1) + " rows, " + str(len(bad))
+              + " with other column counts, recovery keeps " + str(result['good']) + " drops " + str(result['dropped']))
+        ok = ok and not bad and result['dropped'] == 0 and result['good'] == len(lines) - 1
+    return ok
+
+
+print("Appending to original format files:")
+old_usb = tempfile.mkdtemp(prefix='eds_baseline_')
+start_baseline_files(old_usb)
+write_rows(old_usb)
+old_ok = check(old_usb)
+
+print("New files:")
+new_usb = tempfile.mkdtemp(prefix='eds_new_')
+write_rows(new_usb)
+new_ok = check(new_usb)
+
+print("PASS" if old_ok and new_ok else "FAIL")
+sys.exit(0 if old_ok and new_ok else 1)
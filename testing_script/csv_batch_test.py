@@ -0,0 +1,57 @@
+import os
+import sys
+import csv
+import time
+import tempfile
+
+# run from anywhere, the data manager lives in the main directory
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+# no RasPi GPIO needed to write files
+os.environ.setdefault('EDS_HARDWARE', 'sim')
+import DataManager as DM
+import StaticManager as SM
+
+# Compares writing a sweep row by row (old CSVMaster) against one batched write per sweep.
+# Pass the USB mount point as the first argument to measure on the real stick, defaults to a temp directory.
+
+SWEEPS = 50   # sweeps to write
+PANELS = 7    # rows per sweep, 5 EDS + 2 CTRL
+
+target = sys.argv[1] if len(sys.argv) > 1 else tempfile.mkdtemp()
+records = []
+for panel in SM.PANEL_DATA:
+    record = DM.PanelRecord.from_template(SM.PANEL_DATA[panel])
+    record.date_time = time.localtime()
+    records.append(record)
+records = records[:PANELS]
+
+# old behaviour: every row opens, appends and closes both files
+old_dir = os.path.join(target, 'csv_batch_old')
+os.makedirs(old_dir, exist_ok=True)
+old_master = DM.CSVMaster(old_dir, checksum=False)
+start = time.perf_counter()
+for i in range(SWEEPS):
+    for record in records:
+        row = old_master.data_row(record)
+        with open(old_master.txt_location, 'a') as f_txt:
+            f_txt.writelines(' '.join(row) + ' \n')
+        with open(old_master.csv_location, mode='a') as f_csv:
+            csv.writer(f_csv).writerow(row)
+end = time.perf_counter()
+print("Row by row: " + str(round((end - start) / SWEEPS * 1000, 3)) + " ms/sweep, " + str(2 * PANELS) + " file opens/sweep, no fsync")
+
+# new behaviour: the sweep is queued and written with one open and fsync per file
+new_dir = os.path.join(target, 'csv_batch_new')
+os.makedirs(new_dir, exist_ok=True)
+new_master = DM.CSVMaster(new_dir, checksum=False)
+start = time.perf_counter()
+for i in range(SWEEPS):
+    new_master.write_batch(records)
+end = time.perf_counter()
+print("Batched:    " + str(round((end - start) / SWEEPS * 1000, 3)) + " ms/sweep, 2 file opens/sweep, fsynced")
+
+# both ways must produce the same files, without the Seq and CRC32 framing the old way has no counterpart for
+same = open(old_master.csv_location).read() == open(new_master.csv_location).read()
+same = same and open(old_master.txt_location).read() == open(new_master.txt_location).read()
+print("Identical output: " + str(same))
+sys.exit(0 if same else 1)
@@ -0,0 +1,23 @@
+import os
+import sys
+
+# run from anywhere, the data manager lives in the main directory
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+# no RasPi GPIO needed to export files
+os.environ.setdefault('EDS_HARDWARE', 'sim')
+import DataManager as DM
+
+# Regenerates eds_data.csv and eds_data.txt from the binary eds_data.bin on a USB drive.
+# usage: python3 export_data.py <usb directory> [output directory] [--uncertainty] [--checksum]
+
+args = [a for a in sys.argv[1:] if not a.startswith('--')]
+if not args:
+    print("usage: python3 export_data.py <usb directory> [output directory] [--uncertainty] [--checksum]")
+    sys.exit(1)
+usb_dir = args[0]
+out_dir = args[1] if len(args) > 1 else usb_dir
+log = DM.RecordLog(os.path.join(usb_dir, 'eds_data.bin'))
+csv_path = os.path.join(out_dir, 'eds_data.csv')
+txt_path = os.path.join(out_dir, 'eds_data.txt')
+count = log.export(csv_path, txt_path, '--uncertainty' in sys.argv, '--checksum' in sys.argv)
+print("Exported " + str(count) + " records to " + csv_path + " and " + txt_path)
@@ -0,0 +1,54 @@
+import os
+import sys
+import csv
+import time
+import argparse
+from datetime import datetime
+
+# run from anywhere, the data manager lives in the main directory
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+# no RasPi GPIO needed to read files
+os.environ.setdefault('EDS_HARDWARE', 'sim')
+import DataManager as DM
+import StaticManager as SM
+
+# Pulls the rows of one panel and/or a date range out of eds_data.csv through its sidecar index (eds_data.idx).
+# The index is brought up to date first, built from scratch if the csv was copied without it.
+# usage: python3 query_data.py <usb directory or eds_data.csv> [--panel eds3] [--from 2026-06-01] [--to 2026-06-30] [--out rows.csv]
+
+def day(text):
+    return datetime.strptime(text, '%Y-%m-%d').date()
+
+parser = argparse.ArgumentParser(description="Query eds_data.csv by panel and date range")
+parser.add_argument('data', help="USB directory or path to eds_data.csv")
+parser.add_argument('--panel', help="panel id or name, e.g. eds3 or EDS-PV3 (default all panels)")
+parser.add_argument('--from', dest='start', type=day, help="first day, YYYY-MM-DD (inclusive)")
+parser.add_argument('--to', dest='end', type=day, help="last day, YYYY-MM-DD (inclusive)")
+parser.add_argument('--out', help="write the rows to this csv file instead of printing them")
+args = parser.parse_args()
+
+csv_path = os.path.join(args.data, 'eds_data.csv') if os.path.isdir(args.data) else args.data
+index = DM.CSVIndex(csv_path)
+start = time.perf_counter()
+if not index.update():
+    sys.exit(1)
+indexed = time.perf_counter()
+# the csv holds panel names, ids are looked up in the default panel data
+panel = SM.PANEL_DATA[args.panel]['name'] if args.panel in SM.PANEL_DATA else args.panel
+rows = index.query(panel, args.start, args.end)
+end = time.perf_counter()
+# header as written, with or without the uncertainty columns
+with open(csv_path) as f:
+    header = next(csv.reader(f))
+
+if args.out:
+    with open(args.out, 'w') as f:
+        writer = csv.writer(f, delimiter=',', quotechar='"', quoting=csv.QUOTE_MINIMAL)
+        writer.writerow(header)
+        writer.writerows(rows)
+else:
+    print(','.join(header))
+    for row in rows:
+        print(','.join(row))
+print(str(len(rows)) + " rows, index update " + str(round((indexed - start) * 1000, 1)) + " ms, query "
+      + str(round((end - indexed) * 1000, 1)) + " ms", file=sys.stderr)
@@ -0,0 +1,43 @@
+import os
+import sys
+import time
+import tempfile
+
+# run from anywhere, the data manager lives in the main directory
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+# no RasPi GPIO needed to write files
+os.environ.setdefault('EDS_HARDWARE', 'sim')
+import DataManager as DM
+import StaticManager as SM
+
+# Power cut while writing eds_data.bin: the file is cut off in the middle of a record, then more sweeps
+# are appended. Every complete record must still read back in order, the torn one is lost.
+# Runs on any Linux machine, no USB needed.
+
+SWEEPS = 3
+
+records = []
+for panel in SM.PANEL_DATA:
+    record = DM.PanelRecord.from_template(SM.PANEL_DATA[panel])
+    record.date_time = time.localtime()
+    records.append(record)
+
+path = os.path.join(tempfile.mkdtemp(prefix='eds_bin_'), 'eds_data.bin')
+log = DM.RecordLog(path)
+log.append(records)
+
+# cut the last record in half, like a power cut during the write
+size = os.path.getsize(path)
+with open(path, 'r+b') as f:
+    f.truncate(size - DM.RECORD_DTYPE.itemsize // 2)
+print("Cut off " + str(DM.RECORD_DTYPE.itemsize // 2) + " bytes, " + str(len(log.read())) + " complete records left")
+
+for i in range(SWEEPS):
+    log.append(records)
+data = log.read()
+expected = [r.name for r in records[:-1]] + [r.name for r in records] * SWEEPS
+panels = [name.decode(errors='replace') for name in data['panel']]
+print("Records after " + str(SWEEPS) + " more sweeps: " + str(len(data)) + " (expected " + str(len(expected)) + ")")
+ok = panels == expected and (os.path.getsize(path) - DM.RECORD_HEADER_SIZE) % DM.RECORD_DTYPE.itemsize == 0
+print("PASS" if ok else "FAIL")
+sys.exit(0 if ok else 1)
@@ -0,0 +1,39 @@
+import os
+import sys
+import time
+
+# run from anywhere, the data manager lives in the main directory
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+# no RasPi GPIO needed to read files
+os.environ.setdefault('EDS_HARDWARE', 'sim')
+import DataManager as DM
+
+# Checks a data file from a USB that was pulled while writing and writes the rows that survived to a new file.
+# Rows carry a sequence number and CRC-32 (csvChecksum), torn rows are repaired where possible or dropped,
+# and missing sequence numbers are reported. Reads one line at a time, any file size works.
+# usage: python3 recover_data.py <eds_data.csv/txt or manual_data.csv/txt> [output file]
+
+if len(sys.argv) < 2:
+    print("usage: python3 recover_data.py <data file> [output file]")
+    sys.exit(1)
+path = sys.argv[1]
+base, ext = os.path.splitext(path)
+out_path = sys.argv[2] if len(sys.argv) > 2 else base + '_recovered' + ext
+
+recovery = DM.DataRecovery(path)
+start = time.perf_counter()
+result = recovery.scan(out_path)
+end = time.perf_counter()
+
+size = os.path.getsize(path) / 1e6
+print("Scanned " + path + ": " + str(round(size, 1)) + " MB in " + str(round(end - start, 2)) + " s")
+if not result['checksummed']:
+    print("No Seq/CRC32 columns, rows were only checked by their number of columns")
+print("Rows: " + str(result['good']) + " intact, " + str(result['repaired']) + " repaired, " + str(result['dropped'])
+      + " dropped, " + str(result['repeated']) + " repeated")
+if result['checksummed']:
+    print("Last sequence number " + str(result['last_seq']) + ", " + str(result['missing']) + " missing in "
+          + str(len(result['gaps'])) + " gaps")
+    for first, last in result['gaps'][:20]:
+        print("  missing " + (str(first) if first == last else str(first) + "-" + str(last)))
+print("Recovered rows written to " + out_path)
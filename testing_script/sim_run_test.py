@@ -0,0 +1,45 @@
+import os
+import sys
+import time
+import filecmp
+import tempfile
+import subprocess
+
+# run from anywhere, the data manager lives in the main directory
+MAIN_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.append(MAIN_DIR)
+# no RasPi GPIO needed to export files
+os.environ.setdefault('EDS_HARDWARE', 'sim')
+import DataManager as DM
+
+# Runs the real control loop (MasterManager.py) on simulated hardware, no RasPi needed.
+# 1) two simulated runs with the same settings must write identical data files
+# 2) the data written by the first run is replayed through the loop as a recorded trace
+# The sweeps only write eds_data.bin, eds_data.csv is exported from it like export_data.py does.
+
+START = "2026-06-21 08:00"  # simulated start time
+HOURS = 34                  # simulated run length, covers the first scheduled day
+
+def run(mode, extra=None):
+    sim_dir = tempfile.mkdtemp(prefix='eds_' + mode + '_')
+    env = dict(os.environ)
+    env['EDS_HARDWARE'] = mode
+    env['EDS_SIM_DIR'] = sim_dir
+    if extra:
+        env.update(extra)
+    start = time.perf_counter()
+    with open(os.path.join(sim_dir, 'console.txt'), 'w') as console:
+        code = subprocess.call([sys.executable, os.path.join(MAIN_DIR, 'MasterManager.py')], env=env, cwd=sim_dir,
+                               stdout=console, stderr=subprocess.STDOUT)
+    wall = time.perf_counter() - start
+    usb = os.path.join(sim_dir, 'usb')
+    data = os.path.join(usb, 'eds_data.csv')
+    rows = DM.RecordLog(os.path.join(usb, 'eds_data.bin')).export(data, os.path.join(usb, 'eds_data.txt'))
+    print(mode + " run in " + sim_dir + ": exit code " + str(code) + ", " + str(round(wall, 2)) + " s, " + str(rows) + " data rows")
+    return data, wall
+
+first, wall = run('sim', {'EDS_SIM_START': START, 'EDS_SIM_HOURS': str(HOURS)})
+print("Simulated " + str(HOURS) + " h in " + str(round(wall, 2)) + " s (" + str(int(HOURS * 3600 / wall)) + "x real time)")
+second, wall = run('sim', {'EDS_SIM_START': START, 'EDS_SIM_HOURS': str(HOURS)})
+print("Deterministic: " + str(filecmp.cmp(first, second, shallow=False)))
+replay, wall = run('replay', {'EDS_TRACE': first})
@@ -0,0 +1,56 @@
+import os
+import sys
+import time
+
+# run from anywhere, the pyranometer module lives in the main directory
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import SP420
+
+# Checks the cached SP420 connection against the pty based fake sensor, no pyranometer needed.
+# 0.16V with a multiplier of 5 and no offset reads as 800 W/m2.
+# Reconnects use a simulated clock so the back off after a failed connect can be checked without waiting.
+
+fake = SP420.FakeSP420(voltage=0.16, multiplier=5.0, offset=0.0, latency=0.002)
+now = [0.0]
+irr_master = SP420.Irradiance([fake.port], clock=lambda: now[0])
+print("Connected, multiplier: " + str(irr_master.multiplier) + " offset: " + str(irr_master.offset))
+
+# per read latency, calibration should not be requested again
+requests = fake.requests
+start = time.perf_counter()
+for i in range(3):
+    print("Irradiance: " + str(irr_master.get_irradiance()) + " W/m2")
+end = time.perf_counter()
+print("Latency: " + str(round((end - start) / 3, 3)) + " s/reading, " + str(fake.requests - requests) + " requests, " + str(irr_master.connects) + " connection(s)")
+
+# single sample latency, the sensor itself without the 1 second averaging
+start = time.perf_counter()
+for i in range(20):
+    irr_master.read_voltage(1)
+end = time.perf_counter()
+print("Single sample: " + str(round((end - start) / 20 * 1000, 3)) + " ms")
+
+# unplug and replug the sensor, the next reading should reconnect and re-read the calibration
+fake.unplug()
+fake.replug()
+print("After replug: " + str(irr_master.get_irradiance()) + " W/m2, " + str(irr_master.connects) + " connection(s)")
+
+# unplugged sensor, reading should fail gracefully with -1
+fake.unplug()
+print("Unplugged: " + str(irr_master.get_irradiance()))
+
+
+# one reading a second for two minutes, the missing sensor is only looked for once a minute
+attempts = set([irr_master.last_failed])
+for i in range(120):
+    now[0] += 1
+    irr_master.get_irradiance(1, 0.0)
+    attempts.add(irr_master.last_failed)
+print("Reconnect attempts in 120 s unplugged: " + str(len(attempts) - 1))
+
+fake.replug()
+print("Replugged, within the back off: " + str(irr_master.get_irradiance()))
+now[0] += SP420.RECONNECT_SECONDS
+print("Replugged: " + str(irr_master.get_irradiance()) + " W/m2, " + str(irr_master.connects) + " connection(s)")
+irr_master.disconnect()
+fake.close()
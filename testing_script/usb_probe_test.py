@@ -0,0 +1,82 @@
+import os
+import sys
+import time
+import shutil
+import tempfile
+import subprocess
+
+# run from anywhere, the data manager lives in the main directory
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+# no RasPi GPIO needed to probe files
+os.environ.setdefault('EDS_HARDWARE', 'sim')
+import DataManager as DM
+
+# Checks USBProbe (sysfs/udev based USB detection) against a fake /sys, /dev/disk and /proc/mounts tree
+# and measures how long a check takes. Runs on any Linux machine, no USB needed.
+
+CHECKS = 10000
+
+tree = DM.FakeUSBTree()
+probe = DM.USBProbe(tree.root)
+
+# correctness: plug, relabel, mount and unplug the fake drive
+print("Nothing plugged in:  present=" + str(probe.present()))
+tree.plug('1A2B-3C4D', 'FTU DATA', 'vfat')
+print("Plugged in:          " + str(probe.get_state()))
+tree.mount('/media/1A2B-3C4D/FTU_DATA')
+print("Mounted at:          " + str(probe.mount_point()))
+tree.plug('5E6F-7A8B', 'FTU_2', 'exfat')
+print("Swapped drive:       " + str(probe.get_state()) + ", mounted at " + str(probe.mount_point()))
+tree.unplug()
+print("Unplugged:           present=" + str(probe.present()))
+
+# latency: cached checks only stat three paths, a full probe runs after every change
+tree.plug('1A2B-3C4D', 'FTU_DATA', 'vfat')
+probe.present()
+probes = probe.probes
+start = time.perf_counter()
+for i in range(CHECKS):
+    probe.present()
+end = time.perf_counter()
+print("Cached check:        " + str(round((end - start) / CHECKS * 1e6, 1)) + " us, " + str(probe.probes - probes) + " full probes")
+start = time.perf_counter()
+for i in range(CHECKS):
+    probe.signature = None
+    probe.present()
+end = time.perf_counter()
+print("Full probe:          " + str(round((end - start) / CHECKS * 1e6, 1)) + " us")
+
+# what the old check cost, only where blkid can run
+if shutil.which('blkid'):
+    start = time.perf_counter()
+    for i in range(20):
+        subprocess.call("blkid", shell=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    end = time.perf_counter()
+    print("blkid through shell: " + str(round((end - start) / 20 * 1e6, 1)) + " us")
+
+# hot swap: a new drive is registered and the data files follow it, no reboot
+# the mount/fstab commands are only printed here, they need root and a real drive
+commands = []
+real_call = DM.subprocess.call
+DM.subprocess.call = lambda cmd, **kwargs: commands.append(cmd)
+data_dir = tempfile.mkdtemp(prefix='usb_swap_')
+DM.USB_NAMES_PATH = os.path.join(data_dir, 'usb_names.txt')
+usb_master = DM.USBMaster(probe)
+usb_master.set_USB_name()
+usb_master.check_new_USB()
+os.makedirs(data_dir + '/first')
+csv_master = DM.CSVMaster(data_dir + '/first')
+tree.plug('5E6F-7A8B', 'FTU_2', 'exfat')
+usb_master.setup_usb_mount()
+if usb_master.get_USB_path() != csv_master.get_path():
+    os.makedirs(data_dir + usb_master.get_USB_path())
+    csv_master.set_path(data_dir + usb_master.get_USB_path())
+print("Swapped to:          " + usb_master.get_USB_path() + ", data files " + str(sorted(os.listdir(csv_master.get_path()))))
+print("Registered drives:   " + open(DM.USB_NAMES_PATH).read().replace('\n', '; '))
+print("Commands run:        " + str(len(commands)) + ", reboot: " + str(any('reboot' in cmd for cmd in commands)))
+DM.subprocess.call = real_call
+shutil.rmtree(data_dir)
+
+# the real tree of this machine, whatever is plugged in
+print("This machine:        " + str(DM.USBProbe().get_state()))
+tree.close()